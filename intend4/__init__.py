@@ -1,3 +1,5 @@
-# Only these modalities are available for modification
-ALLOWED_MODALITIES = ['bold', 'dwi']
+from intend4.fieldmap_rules import ALL_MODALITIES, DEFAULT_RULES, rule_modalities
+
+# Only these modalities are available for modification, unless a rules file is given
+ALLOWED_MODALITIES = rule_modalities(DEFAULT_RULES) + [ALL_MODALITIES]
 BIDS_DIR = '/data'   # internal mount point for users BIDS data dir
@@ -0,0 +1,126 @@
+#
+# Module to checkpoint the progress of a run, so that a run which is stopped (e.g., by
+# a batch system walltime limit) can be resumed without repeating the finished work,
+# and to keep a reusable BIDS index cache which is rebuilt only when the dataset changes.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Leave the files written by intend4 itself out of the index stamp.
+#
+import json
+import os
+import time
+
+from intend4.file_utils import fingerprint_tree
+
+
+CHECKPOINT_INTERVAL = 50               # default number of completions between checkpoint saves
+CHECKPOINT_SECONDS = 60                # maximum seconds between checkpoint saves
+INDEX_STAMP_FILE = 'intend4-index-stamp'   # file, in the index cache, identifying the indexed dataset
+
+# top-level files of the dataset left out of the index stamp: those written by intend4 itself
+# (e.g., a checkpoint or retry file kept in the dataset) and their temporary files
+INDEX_STAMP_IGNORE = ['intend4-*', '*.tmp', '.*']
+
+
+class Checkpoint(object):
+  """
+  Record of the subjects (or subject/sessions) completed by a run, along with the settings
+  of the run, the index cache location, and the retry entries (see intend4.report_skip).
+  The record is saved to the checkpoint file after every interval completions (or every
+  CHECKPOINT_SECONDS, whichever comes first) and when the run ends. Each save replaces the
+  file atomically, so that a run which is killed leaves the last complete checkpoint behind.
+  """
+
+  def __init__ (self, file_path, settings=None, interval=CHECKPOINT_INTERVAL):
+    self.file_path = file_path
+    self.settings = settings or {}     # settings which a resumed run must share, e.g. the modality
+    self.interval = interval
+    self.index_cache = None            # location of the BIDS index cache, if any
+    self.completed = set()             # completed (subject, session) pairs
+    self.retry_entries = []            # subjects (or subject/sessions) skipped or failed
+    self.unsaved = 0                   # number of completions since the last save
+    self.saved_at = time.monotonic()
+
+
+  def is_done (self, subj_id, session_id=None):
+    "Tell whether the identified subject (or subject/session) has been completed."
+    return (subj_id, session_id) in self.completed
+
+
+  def load (self):
+    """
+    Load the completed pairs, index cache location, and retry entries from the checkpoint
+    file, if it exists. Raises ValueError if the file is not a checkpoint file or if it was
+    written by a run with different settings. Returns True if the checkpoint file existed.
+    """
+    if (not os.path.exists(self.file_path)):
+      return False
+    with open(self.file_path, 'r') as checkpoint_file:
+      contents = json.load(checkpoint_file)
+    if ((not isinstance(contents, dict)) or (not isinstance(contents.get('completed'), list))):
+      raise ValueError(f"File {self.file_path} is not an intend4 checkpoint file.")
+    if (contents.get('settings') != self.settings):
+      raise ValueError(
+        f"Checkpoint file {self.file_path} was written by a run with different settings: {contents.get('settings')}")
+    self.completed = set((subj_id, session_id) for subj_id, session_id in contents['completed'])
+    self.index_cache = contents.get('index_cache')
+    self.retry_entries[:] = contents.get('retry_entries', [])
+    return True
+
+
+  def mark_done (self, subj_id, session_id=None):
+    "Record that the identified subject (or subject/session) has been completed, saving periodically."
+    self.completed.add((subj_id, session_id))
+    self.unsaved += 1
+    if ((self.unsaved >= self.interval) or
+        ((time.monotonic() - self.saved_at) >= CHECKPOINT_SECONDS)):
+      self.save()
+
+
+  def save (self):
+    "Atomically replace the checkpoint file with the current state of this checkpoint."
+    contents = {
+      'settings': self.settings,
+      'index_cache': self.index_cache,
+      'completed': sorted(self.completed, key=lambda pair: (pair[0], pair[1] or '')),
+      'retry_entries': self.retry_entries
+    }
+    temp_path = f"{self.file_path}.tmp"
+    with open(temp_path, 'w') as checkpoint_file:
+      json.dump(contents, checkpoint_file, indent=2)
+      checkpoint_file.write('\n')
+      checkpoint_file.flush()
+      os.fsync(checkpoint_file.fileno())
+    os.replace(temp_path, self.file_path)
+    self.unsaved = 0
+    self.saved_at = time.monotonic()
+
+
+def index_cache_is_current (cache_dir, stamp):
+  "Tell whether the index cache in the given directory was built for the dataset with the given stamp."
+  try:
+    with open(os.path.join(cache_dir, INDEX_STAMP_FILE), 'r') as stamp_file:
+      return (stamp_file.read().strip() == stamp)
+  except OSError:
+    return False
+
+
+def index_stamp (bids_dir, index_metadata=False, own_files=()):
+  """
+  Return a string identifying the current state of the given BIDS data directory, and the kind
+  of index, for validating an index cache: the fingerprint (see fingerprint_tree) of the directory.
+  An index without metadata depends only on the file names, so the sidecars modified by a run
+  do not invalidate it, while an index with metadata depends on the sidecar contents too.
+  The files written by intend4 itself (INDEX_STAMP_IGNORE and the given own file paths, such
+  as the checkpoint file) are left out, so that keeping them in the dataset, where they
+  appear after the first run, does not invalidate the index for a resumed run.
+  """
+  ignore = INDEX_STAMP_IGNORE + [ os.path.basename(apath) for apath in own_files if apath ]
+  digest, _ = fingerprint_tree(bids_dir, names_only=(not index_metadata), ignore=ignore)
+  kind = 'metadata' if index_metadata else 'files'
+  return f"{os.path.realpath(bids_dir)}:{kind}:{digest}"
+
+
+def write_index_stamp (cache_dir, stamp):
+  "Record that the index cache in the given directory was built for the dataset with the given stamp."
+  with open(os.path.join(cache_dir, INDEX_STAMP_FILE), 'w') as stamp_file:
+    stamp_file.write(f"{stamp}\n")
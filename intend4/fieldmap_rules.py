@@ -0,0 +1,83 @@
+#
+# Module to define the table of fieldmap rules: each rule selects the target images
+# of a modality, by suffix and other entities, and the fieldmap sidecar whose IntendedFor
+# field should list those images. The default table may be replaced by a JSON rules file.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import json
+
+
+ALL_MODALITIES = 'all'                 # modality which selects every rule in the table
+
+# the default rules: bold images are corrected by the phasediff fieldmap and
+# dwi images by the reverse phase encoded (epi) fieldmap
+DEFAULT_RULES = [
+  { 'modality': 'bold', 'target': { 'suffix': 'bold' }, 'fieldmap': { 'suffix': 'phasediff' } },
+  { 'modality': 'dwi', 'target': { 'suffix': 'dwi' }, 'fieldmap': { 'suffix': 'epi' } }
+]
+
+# filters which are set by intend4 itself, so may not appear in a rule
+RESERVED_FILTERS = ['subject', 'session', 'extension', 'target', 'return_type', 'scope']
+
+
+def load_rules (file_path):
+  """
+  Read and return the rules table from the given JSON rules file, which holds either a list
+  of rules or an object with a 'rules' list. Each rule is an object with a 'modality' name,
+  a 'target' object of filters selecting the images, and a 'fieldmap' object of filters
+  selecting the fieldmap sidecar. Both sets of filters must include a 'suffix' and may
+  include other entities, such as 'datatype', 'acquisition', or 'direction'. For example:
+    {"modality": "asl", "target": {"suffix": ["asl", "m0scan"], "datatype": "perf"},
+     "fieldmap": {"suffix": "epi", "direction": "PA"}}
+  Raises ValueError if the file does not hold a valid rules table.
+  """
+  with open(file_path, 'r') as rules_file:
+    contents = json.load(rules_file)
+  if (isinstance(contents, dict)):
+    contents = contents.get('rules')
+  return validate_rules(contents, source=f"Rules file {file_path}")
+
+
+def rule_modalities (rules):
+  "Return a list of the unique modality names of the given rules, in table order."
+  modalities = []
+  for rule in rules:
+    if (rule['modality'] not in modalities):
+      modalities.append(rule['modality'])
+  return modalities
+
+
+def select_rules (modality, rules):
+  "Return a list of the given rules which apply to the given modality (all of them for ALL_MODALITIES)."
+  if (modality == ALL_MODALITIES):
+    return list(rules)
+  return [ rule for rule in rules if (rule['modality'] == modality) ]
+
+
+def validate_filters (filters, source):
+  "Check that the given filters object of a rule is valid. Raises ValueError if it is not."
+  if ((not isinstance(filters, dict)) or (not filters.get('suffix'))):
+    raise ValueError(f"{source} must be an object with a 'suffix' filter.")
+  for name, value in filters.items():
+    if (name in RESERVED_FILTERS):
+      raise ValueError(f"{source} may not filter on '{name}'.")
+    values = value if isinstance(value, list) else [value]
+    if (not all(isinstance(val, str) for val in values)):
+      raise ValueError(f"{source} filter '{name}' must be a string or a list of strings.")
+
+
+def validate_rules (rules, source='Rules table'):
+  """
+  Check that the given rules table is a nonempty list of valid rules (see load_rules).
+  Returns the rules table or raises ValueError if it is not valid.
+  """
+  if ((not isinstance(rules, list)) or (not rules)):
+    raise ValueError(f"{source} does not hold a list of fieldmap rules.")
+  for rule in rules:
+    if ((not isinstance(rule, dict)) or (not isinstance(rule.get('modality'), str))
+        or (not rule['modality']) or (rule['modality'] == ALL_MODALITIES)):
+      raise ValueError(f"{source} holds a rule without a valid modality name: {rule}")
+    validate_filters(rule.get('target'), f"{source}: the target of rule '{rule['modality']}'")
+    validate_filters(rule.get('fieldmap'), f"{source}: the fieldmap of rule '{rule['modality']}'")
+  return rules
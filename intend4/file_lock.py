@@ -0,0 +1,166 @@
+#
+# Module to provide advisory file locking, so that concurrent runs cannot interleave
+# their modifications of the same files.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Apply the I/O throttle to the lock operations; create the lock directory on demand.
+#
+import fcntl
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+
+from intend4.throttle import METADATA_OP, throttled
+
+
+GIT_LOCK_DIR_NAME = 'intend4-locks'    # name of the default lock directory in a git directory
+LOCK_DIR_NAME = '.intend4-locks'       # name of the default lock directory in the BIDS data directory
+LOCK_FILE_EXT = '.lock'                # extension for the lock files
+LOCK_POLL_INTERVAL = 0.1               # seconds between attempts to acquire a lock with a timeout
+
+
+def acquire_lock (fd, apath, timeout=None, throttle=None):
+  """
+  Acquire an exclusive lock on the given open lock file descriptor, waiting forever
+  or raising TimeoutError if the lock is not acquired within the given timeout (in seconds).
+  Each attempt to take the lock counts as a metadata operation for the optional throttle,
+  but waiting for another run to release the lock does not hold up other operations.
+  """
+  deadline = None if (timeout is None) else (time.monotonic() + timeout)
+  while True:
+    try:
+      with throttled(throttle, METADATA_OP):
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return
+    except BlockingIOError:
+      if (deadline is None):
+        fcntl.flock(fd, fcntl.LOCK_EX)   # wait, outside the throttle, for the holder
+        return
+      if (time.monotonic() >= deadline):
+        raise TimeoutError(f"Unable to lock {apath} within {timeout} seconds.")
+      time.sleep(LOCK_POLL_INTERVAL)
+
+
+def default_lock_dir (bids_dir):
+  """
+  Return the path to the default directory which holds the lock files for the given BIDS
+  data directory, which every run that can see the dataset, in any container or on any
+  node, shares. When the dataset is in a git (or DataLad) repository, the locks are kept
+  in its git directory, out of the worktree. Otherwise they are kept in a hidden directory
+  of the dataset, which BIDS tools ignore.
+  """
+  git_dir = find_git_dir(bids_dir)
+  if (git_dir is not None):
+    return os.path.join(git_dir, GIT_LOCK_DIR_NAME)
+  return os.path.join(bids_dir, LOCK_DIR_NAME)
+
+
+@contextmanager
+def file_lock (apath, lock_dir, timeout=None, shared=False, throttle=None):
+  """
+  Context manager which holds an exclusive advisory lock guarding the given path.
+  The lock is taken on a separate lock file, kept in the given lock directory, so that
+  the guarded file itself is never opened. All the runs which modify the same files must
+  use the same lock directory. The lock file is removed when the lock is released, so
+  lock files do not accumulate. If shared is True, the lock directory and lock files are
+  made usable by all users (see make_lock_dir). If a timeout (in seconds) is given, raise
+  TimeoutError if the lock cannot be acquired within that time, otherwise wait for the lock
+  as long as necessary. The lock operations are subject to the optional I/O throttle.
+  """
+  with throttled(throttle, METADATA_OP):
+    lock_path = lock_path_for(apath, lock_dir)
+  fd = open_lock(lock_path, apath, timeout=timeout, shared=shared, throttle=throttle)
+  try:
+    yield lock_path
+  finally:
+    with throttled(throttle, METADATA_OP):
+      try:
+        os.unlink(lock_path)           # while still locked, so no other run holds this file
+      except (FileNotFoundError, PermissionError):   # sticky directory of another user
+        pass
+      fcntl.flock(fd, fcntl.LOCK_UN)
+      os.close(fd)
+
+
+def find_git_dir (apath):
+  """
+  Return the git directory of the repository containing the given path, or None if the
+  path is not within a repository. A .git file (as in a linked worktree or a submodule)
+  is followed to the git directory which it names.
+  """
+  dir_path = os.path.realpath(apath)
+  while True:
+    dot_git = os.path.join(dir_path, '.git')
+    if (os.path.isdir(dot_git)):
+      return dot_git
+    if (os.path.isfile(dot_git)):
+      with open(dot_git, 'r') as git_file:
+        line = git_file.readline().strip()
+      if (line.startswith('gitdir:')):
+        return os.path.normpath(os.path.join(dir_path, line[len('gitdir:'):].strip()))
+    parent = os.path.dirname(dir_path)
+    if (parent == dir_path):
+      return None
+    dir_path = parent
+
+
+def lock_path_for (apath, lock_dir):
+  """
+  Return the path to the lock file which guards the given path. Different paths to the
+  same file (e.g., through symbolic links) are guarded by the same lock file.
+  """
+  real_path = os.path.realpath(apath)
+  key = hashlib.sha1(real_path.encode('utf-8', 'surrogateescape')).hexdigest()
+  return os.path.join(lock_dir, f"{key}{LOCK_FILE_EXT}")
+
+
+def make_lock_dir (lock_dir, shared=False):
+  """
+  Create the given lock directory, if necessary. If shared is True (as for the default
+  lock directory), a newly created directory is made world-writeable (and sticky) so that
+  runs by different users can share it. Otherwise it is created with the default mode.
+  """
+  if (not os.path.isdir(lock_dir)):
+    os.makedirs(lock_dir, exist_ok=True)
+    if (shared):
+      try:
+        os.chmod(lock_dir, 0o1777)
+      except PermissionError:          # created concurrently by another user
+        pass
+
+
+def open_lock (lock_path, apath, timeout=None, shared=False, throttle=None):
+  """
+  Open (creating, if necessary) and exclusively lock the given lock file, which guards the
+  given path, waiting as for acquire_lock. Returns the open, locked file descriptor.
+  The lock directory is created (see make_lock_dir) only when it is found to be missing.
+  Because a lock file is removed when its lock is released, a lock acquired on a file which
+  has since been removed (or replaced) is dropped, and the new lock file is locked instead.
+  Opening and checking the lock file count as metadata operations for the optional throttle.
+  """
+  deadline = None if (timeout is None) else (time.monotonic() + timeout)
+  while True:
+    with throttled(throttle, METADATA_OP):
+      try:                             # writable, for NFS lock emulation
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o0666)
+      except FileNotFoundError:
+        make_lock_dir(os.path.dirname(lock_path), shared=shared)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o0666)
+      if (shared):
+        try:
+          os.fchmod(fd, 0o0666)
+        except PermissionError:        # created by another user
+          pass
+    try:
+      remaining = None if (deadline is None) else max(0, deadline - time.monotonic())
+      acquire_lock(fd, apath, remaining, throttle=throttle)
+      try:
+        with throttled(throttle, METADATA_OP):
+          if (os.stat(lock_path).st_ino == os.fstat(fd).st_ino):
+            return fd
+      except FileNotFoundError:
+        pass
+    except BaseException:
+      os.close(fd)
+      raise
+    os.close(fd)                       # closing the stale lock file releases its lock
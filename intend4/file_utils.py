@@ -1,18 +1,97 @@
 #
 # Module to provide general file utility functions.
 #   Written by: Tom Hicks. 1/29/2020.
-#   Last Modified: Add get_permissions method.
+#   Last Modified: Check the modifiability of files with the stat cache.
 #
+import fcntl
+import fnmatch
+import functools
+import hashlib
 import os
 import shutil
+import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+from intend4.throttle import METADATA_OP, WRITE_OP, throttled
 
-def copy_tree (from_dir, to_dir):
+
+FICLONE = 0x40049409                   # Linux ioctl request code to clone (reflink) a file
+FINGERPRINT_DIGEST_SIZE = 16           # size (in bytes) of the fingerprint digests
+SNAPSHOT_COPY_EXTENTS = ['.json']      # files really copied by a snapshot: all others are shared
+
+
+class StatCache(object):
+    """ Cache of the status (os.stat results, following symbolic links) of file paths, along with
+        their readability and writability (os.access results), to be shared by the path validation
+        helpers during a single run, so that each path is checked only once. The cache is never
+        refreshed automatically: after changing a file (e.g., its permissions), invalidate its path.
+        Missing paths are cached with a status of None. Whether a filesystem is mounted read-only
+        is also cached, per device. """
+
+    def __init__ (self):
+        self.entries = dict()               # path => (os.stat_result or None, readable, writable)
+        self.read_only_devices = dict()     # device number => whether mounted read-only
+
+
+    def entry (self, apath, throttle=None):
+        """ Return the (possibly cached) tuple of the status of the given path (or None if it
+            cannot be accessed), and whether it is readable and writable. Fetching an uncached
+            entry counts as a metadata operation for the optional throttle. """
+        if (apath not in self.entries):
+            self.entries[apath] = _path_entry(apath, throttle=throttle)
+        return self.entries[apath]
+
+
+    def invalidate (self, apath=None):
+        """ Forget the cached status of the given path, or of all paths if none is given. """
+        if (apath is None):
+            self.entries.clear()
+        else:
+            self.entries.pop(apath, None)
+
+
+    def is_read_only (self, apath, throttle=None):
+        """ Tell whether the given accessible path is on a filesystem mounted read-only. The answer
+            is cached per device, and finding it counts as a metadata operation for the optional
+            throttle. """
+        device = self.stat(apath).st_dev
+        if (device not in self.read_only_devices):
+            with throttled(throttle, METADATA_OP):
+                self.read_only_devices[device] = bool(os.statvfs(apath).f_flag & os.ST_RDONLY)
+        return self.read_only_devices[device]
+
+
+    def stat (self, apath):
+        """ Return the (possibly cached) status of the given path, or None if it cannot be accessed. """
+        return self.entry(apath)[0]
+
+
+    def stat_many (self, paths, max_workers=None, throttle=None):
+        """ Concurrently fetch and cache the status of those of the given paths which are not
+            already cached, using up to max_workers threads. Fetching the status of each path
+            counts as a metadata operation for the optional throttle. """
+        missing = list(dict.fromkeys(apath for apath in paths if (apath and (apath not in self.entries))))
+        path_entry = functools.partial(_path_entry, throttle=throttle)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for apath, entry in zip(missing, executor.map(path_entry, missing)):
+                self.entries[apath] = entry
+
+
+def copy_tree (from_dir, to_dir, snapshot=False, copy_extents=SNAPSHOT_COPY_EXTENTS):
   """
   Copy all files and subdirectories from the given source directory to
-  the given target directory.
+  the given target directory. If snapshot is True, make a cheap snapshot instead:
+  only the files with one of the given extensions (by default, the JSON sidecars which
+  may later be rewritten) are really copied. All other files are hard linked to the
+  originals or, where that is not possible, cloned by reflink (or an in-kernel copy)
+  if the filesystem supports it. Note that hard linked files share their contents
+  and permissions with the originals, so they must not be modified in place.
   """
-  shutil.copytree(from_dir, to_dir, dirs_exist_ok=True)
+  if (snapshot):
+    copy_function = functools.partial(snapshot_file, copy_extents=copy_extents)
+  else:
+    copy_function = shutil.copy2
+  shutil.copytree(from_dir, to_dir, dirs_exist_ok=True, copy_function=copy_function)
 
 
 def filename_core (apath):
@@ -22,6 +101,46 @@ def filename_core (apath):
     return os.path.basename(os.path.splitext(apath)[0])
 
 
+def fingerprint_tree (root_dir, subtree_prefix='sub-', max_workers=None, names_only=False,
+                      ignore=()):
+    """ Return a cheap fingerprint of the given directory tree as a tuple of a whole-tree
+        digest string and a dictionary mapping the name of each top-level subtree whose
+        name begins with the given prefix to the digest string for that subtree.
+        The digests combine the names, sizes, and modification times of the files
+        (not their contents), so they change whenever a file is added, removed, renamed,
+        resized, or touched. Only the top-level files and the selected subtrees contribute
+        to the whole-tree digest. Subtrees are scanned in parallel by up to max_workers
+        threads (or serially if max_workers is 1). Does not follow symbolic links.
+        If names_only is True, the digests combine only the file names, so they change
+        only when a file is added, removed, or renamed. Top-level files whose names match
+        any of the given ignore (glob) patterns are left out of the digest. """
+    top_files = []
+    subtree_names = []
+    with os.scandir(root_dir) as entries:
+        for entry in entries:
+            if (entry.is_dir(follow_symlinks=False)):
+                if (entry.name.startswith(subtree_prefix)):
+                    subtree_names.append(entry.name)
+            elif (not any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in ignore)):
+                top_files.append(_file_stat_record(entry, entry.name, names_only))
+
+    subtree_paths = [os.path.join(root_dir, name) for name in subtree_names]
+    digest_subtree = functools.partial(_digest_subtree, names_only=names_only)
+    if (max_workers == 1):
+        digests = [digest_subtree(subtree_path) for subtree_path in subtree_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = list(executor.map(digest_subtree, subtree_paths))
+    subtree_digests = dict(sorted(zip(subtree_names, digests)))
+
+    hasher = hashlib.blake2b(digest_size=FINGERPRINT_DIGEST_SIZE)
+    for record in sorted(top_files):
+        hasher.update(record)
+    for name, digest in subtree_digests.items():
+        hasher.update(f"{name}/\0{digest}\n".encode('utf-8', 'surrogateescape'))
+    return (hasher.hexdigest(), subtree_digests)
+
+
 def full_path (apath):
     """ Fully expand the given path into an absolute path. Supports the home ('~') shortcut. """
     return os.path.abspath(os.path.normpath(os.path.expanduser(apath)))
@@ -36,33 +155,45 @@ def gather_file_info (apath):
     return file_info
 
 
-def gen_file_paths (root_dir):
-    """ Generator to yield all files in the file tree under the given root directory. """
-    for root, dirs, files in os.walk(root_dir, followlinks=True):
-        for fyl in files:
-            file_path = os.path.join(root, fyl)
-            yield file_path
+def gen_file_paths (root_dir, prune=None, max_workers=None):
+    """ Generator to yield all files in the file tree under the given root directory,
+        following symbolic links but visiting each directory only once (see walk_files). """
+    for entry in walk_files(root_dir, prune=prune, max_workers=max_workers):
+        yield entry.path
 
 
-def get_permissions(file_path):
-  "Return the file OS status mode for the given filepath."
-  return os.stat(file_path).st_mode
+def get_permissions(file_path, cache=None):
+  "Return the file OS status mode for the given filepath, from the optional stat cache."
+  if (cache is None):
+    return os.stat(file_path).st_mode
+  stats = cache.stat(file_path)
+  if (stats is None):
+    raise FileNotFoundError(f"Unable to get the status of file {file_path}")
+  return stats.st_mode
 
 
-def good_dir_path (apath, writeable=False):
+def good_dir_path (apath, writeable=False, cache=None):
     """ Tell whether the given path points to a readable (and, optionally, writeable) directory
-        or not. Follows symbolic links. """
-    return (apath and os.path.isdir(apath) and
-            is_readable(apath) and
-            ((not writeable) or is_writable(apath)) )
+        or not. Follows symbolic links. Uses the results cached in the optional stat cache. """
+    if (cache is None):
+        return (apath and os.path.isdir(apath) and
+                is_readable(apath) and
+                ((not writeable) or is_writable(apath)) )
+    stats, readable, writable = _cached_entry(apath, cache)
+    return (apath and (stats is not None) and stat.S_ISDIR(stats.st_mode) and
+            readable and ((not writeable) or writable) )
 
 
-def good_file_path (apath, writeable=False):
+def good_file_path (apath, writeable=False, cache=None):
     """ Tell whether the given path points to a readable (and, optionally, writeable) file
-        or not. Follows symbolic links. """
-    return (apath and os.path.isfile(apath) and
-            is_readable(apath) and
-            ((not writeable) or is_writable(apath)) )
+        or not. Follows symbolic links. Uses the results cached in the optional stat cache. """
+    if (cache is None):
+        return (apath and os.path.isfile(apath) and
+                is_readable(apath) and
+                ((not writeable) or is_writable(apath)) )
+    stats, readable, writable = _cached_entry(apath, cache)
+    return (apath and (stats is not None) and stat.S_ISREG(stats.st_mode) and
+            readable and ((not writeable) or writable) )
 
 
 def is_acceptable_filename (filename, extents):
@@ -73,14 +204,29 @@ def is_acceptable_filename (filename, extents):
     return (filename.endswith(tuple(extents)))
 
 
-def is_readable (apath):
-    """ Tell whether given path points to a readable file or directory. Follows symbolic links. """
-    return (apath and os.access(apath, os.R_OK))
+def is_readable (apath, cache=None):
+    """ Tell whether given path points to a readable file or directory. Follows symbolic links.
+        Uses the result cached in the optional stat cache. """
+    if (cache is None):
+        return (apath and os.access(apath, os.R_OK))
+    return (apath and _cached_entry(apath, cache)[1])
 
 
-def is_writable (apath):
-    """ Tell whether given path points to a writable file or directory. Follows symbolic links. """
-    return (apath and os.access(apath, os.W_OK))
+def is_writable (apath, cache=None):
+    """ Tell whether given path points to a writable file or directory. Follows symbolic links.
+        Uses the result cached in the optional stat cache. """
+    if (cache is None):
+        return (apath and os.access(apath, os.W_OK))
+    return (apath and _cached_entry(apath, cache)[2])
+
+
+def modification_problem (apath, throttle=None, cache=None):
+    """ Return a string describing why the given file could not be rewritten in place after
+        changing its permissions to make it writable, or None if it could be. Changing the
+        permissions requires owning the file (or being the superuser). Follows symbolic links.
+        Uses the status cached in the optional stat cache (see StatCache.stat_many), with
+        each uncached status counting as a metadata operation for the optional throttle. """
+    return _modification_problem(apath, cache or StatCache(), throttle=throttle)
 
 
 def path_has_dots (apath):
@@ -91,17 +237,238 @@ def path_has_dots (apath):
     return (('.' in pieces) or ('..' in pieces))
 
 
-def validate_file_path (apath, file_extents, writable=False):
+def read_text (apath, throttle=None):
+    """ Read and return the text of the given file. Opening the file counts as a metadata
+        operation for the optional throttle. """
+    with throttled(throttle, METADATA_OP):
+        infile = open(apath, 'r')
+    with infile:
+        return infile.read()
+
+
+def rewrite_text (apath, text, writable_mode=0o0640, throttle=None):
+    """ Rewrite the given file with the given text, preserving the file permissions: the file
+        is made writable (with the given mode) for the write, then its permissions are restored.
+        The stat and chmod calls count as metadata operations, and the write as a write
+        operation, for the optional throttle. """
+    with throttled(throttle, METADATA_OP):
+        permissions = os.stat(apath).st_mode     # get current file permissions
+    with throttled(throttle, METADATA_OP):
+        os.chmod(apath, writable_mode)           # make file writable
+    with throttled(throttle, WRITE_OP):
+        with open(apath, 'w') as outfile:
+            outfile.write(text)
+    with throttled(throttle, METADATA_OP):
+        os.chmod(apath, permissions)             # restore original file permissions
+
+
+def snapshot_file (src, dst, copy_extents=SNAPSHOT_COPY_EXTENTS):
+    """ Snapshot the given source file to the given destination path, really copying only
+        files with one of the given extensions: all others are hard linked, cloned, or
+        (as a last resort) copied. Returns the destination path. """
+    if (is_acceptable_filename(src, copy_extents)):
+        return shutil.copy2(src, dst)
+    if (os.path.lexists(dst)):
+        if (os.path.exists(dst) and os.path.samefile(src, dst)):  # already linked
+            return dst
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:                         # e.g., cross-device or links unsupported
+        pass
+    if (_clone_file(src, dst)):
+        shutil.copystat(src, dst)
+        return dst
+    return shutil.copy2(src, dst)
+
+
+def validate_file_path (apath, file_extents, writable=False, cache=None):
     """ Tell whether the named file is acceptable and is readable (and writable). """
-    return (is_acceptable_filename(apath, file_extents) and good_file_path(apath, writable))
+    return (is_acceptable_filename(apath, file_extents) and good_file_path(apath, writable, cache=cache))
 
 
-def validate_path_strings (pathstrings, file_extents):
+def validate_path_strings (pathstrings, file_extents, cache=None):
     """ Return a (possibly empty) list of valid file/directory paths. """
     path_list = []
     for pathname in pathstrings:
-        if (validate_file_path(pathname, file_extents)):
+        if (validate_file_path(pathname, file_extents, cache=cache)):
             path_list.append(pathname)
-        elif (good_dir_path(pathname)):
+        elif (good_dir_path(pathname, cache=cache)):
             path_list.append(pathname)
     return path_list
+
+
+def validate_path_strings_bulk (pathstrings, file_extents, cache=None, max_workers=None):
+    """ Return a (possibly empty) list of valid file/directory paths, like validate_path_strings,
+        but first fetching the status of all the paths concurrently, using up to max_workers
+        threads, into the given (or a new) stat cache. Hides the latency of remote filesystems. """
+    if (cache is None):
+        cache = StatCache()
+    cache.stat_many(pathstrings, max_workers=max_workers)
+    return validate_path_strings(pathstrings, file_extents, cache=cache)
+
+
+def walk_files (root_dir, prune=None, follow_symlinks=True, max_workers=None, onerror=None):
+    """ Generator to yield a directory entry (os.DirEntry) for each file in the tree under
+        the given root directory, in no particular order. Each directory is visited only once,
+        identified by its device and inode numbers, so symbolic link cycles cannot cause an
+        endless walk. The optional prune predicate is called with the directory entry of each
+        subdirectory and returns True to skip that subdirectory. The directories are listed
+        concurrently by up to max_workers threads (or serially if max_workers is 1), which
+        hides the latency of remote filesystems. Errors listing a directory are passed to the
+        optional onerror function (like os.walk) and that directory is skipped. """
+    try:
+        visited = { _dir_key(os.stat(root_dir)) }
+    except OSError as ose:
+        if (onerror is not None):
+            onerror(ose)
+        return
+    if (max_workers == 1):
+        pending = [root_dir]
+        while (pending):
+            entries = _list_dir(pending.pop(), onerror)
+            yield from _walk_entries(entries, prune, follow_symlinks, visited, pending.append)
+        return
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        listings = { executor.submit(_list_dir, root_dir, onerror) }
+        def descend (dir_path):
+            listings.add(executor.submit(_list_dir, dir_path, onerror))
+        while (listings):
+            done, _ = wait(listings, return_when=FIRST_COMPLETED)
+            for listing in done:
+                listings.discard(listing)
+                yield from _walk_entries(listing.result(), prune, follow_symlinks, visited, descend)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _cached_entry (apath, cache):
+    """ Return the cached entry (see StatCache.entry) of the given path, or that of a missing path. """
+    return cache.entry(apath) if apath else (None, False, False)
+
+
+def _clone_file (src, dst):
+    """ Try to clone the given source file to the given destination path, by reflink or by
+        an in-kernel copy, returning True if successful or False if the filesystem does not
+        support either method (in which case no destination file is left behind). """
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return True
+        except OSError:
+            pass
+        try:
+            remaining = os.fstat(infile.fileno()).st_size
+            while (remaining > 0):
+                copied = os.copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+                if (copied == 0):
+                    break
+                remaining -= copied
+            if (remaining == 0):
+                return True
+        except (AttributeError, OSError):  # copy_file_range is missing or unsupported
+            pass
+    os.remove(dst)
+    return False
+
+
+def _digest_subtree (dir_path, names_only=False):
+    """ Return a digest string combining the names, sizes, and modification times (or
+        only the names) of all the files under the given directory. """
+    hasher = hashlib.blake2b(digest_size=FINGERPRINT_DIGEST_SIZE)
+    records = [ _file_stat_record(entry, os.path.relpath(entry.path, dir_path), names_only)
+                for entry in walk_files(dir_path, follow_symlinks=False, max_workers=1) ]
+    for record in sorted(records):
+        hasher.update(record)
+    return hasher.hexdigest()
+
+
+def _dir_key (stats):
+    """ Return the key identifying the directory with the given stat results: the pair
+        of its device and inode numbers. """
+    return (stats.st_dev, stats.st_ino)
+
+
+def _file_stat_record (entry, relpath, names_only=False):
+    """ Return a byte string encoding the relative path, size, and modification time
+        (or only the relative path) of the given directory entry. """
+    if (names_only):
+        return f"{relpath}\n".encode('utf-8', 'surrogateescape')
+    stats = entry.stat(follow_symlinks=False)
+    return f"{relpath}\0{stats.st_size}\0{stats.st_mtime_ns}\n".encode('utf-8', 'surrogateescape')
+
+
+def _list_dir (dir_path, onerror=None):
+    """ Return a list of the directory entries of the given directory, passing any error
+        to the optional onerror function and returning an empty list instead. """
+    try:
+        with os.scandir(dir_path) as entries:
+            return list(entries)
+    except OSError as ose:
+        if (onerror is not None):
+            onerror(ose)
+        return []
+
+
+def _modification_problem (apath, cache, throttle=None):
+    """ Return a string describing why the given file could not be rewritten in place,
+        or None if it could be (see modification_problem). """
+    stats, readable, writable = cache.entry(apath, throttle=throttle)
+    if (stats is None):
+        try:
+            os.stat(apath)                  # only to describe the problem
+        except OSError as ose:
+            return f"cannot be accessed: {ose.strerror}"
+        return "cannot be accessed"
+    if (not stat.S_ISREG(stats.st_mode)):
+        return "is not a regular file"
+    if (not readable):
+        return "is not readable"
+    if ((not writable) and cache.is_read_only(apath, throttle=throttle)):
+        return "is on a read-only filesystem"
+    euid = os.geteuid()
+    if ((euid != 0) and (stats.st_uid != euid)):
+        return "is owned by another user, so its permissions cannot be changed"
+    return None
+
+
+def _path_entry (apath, throttle=None):
+    """ Return a tuple of the status of the given path (or None if it cannot be accessed), and
+        whether it is readable and writable (according to os.access). Follows symbolic links.
+        The checks count as one metadata operation for the optional throttle. """
+    with throttled(throttle, METADATA_OP):
+        stats = _stat_or_none(apath)
+        if (stats is None):
+            return (None, False, False)
+        return (stats, os.access(apath, os.R_OK), os.access(apath, os.W_OK))
+
+
+def _stat_or_none (apath):
+    """ Return the status of the given path, following symbolic links, or None if it cannot be accessed. """
+    try:
+        return os.stat(apath)
+    except (OSError, ValueError):           # ValueError: e.g., embedded null byte
+        return None
+
+
+def _walk_entries (entries, prune, follow_symlinks, visited, descend):
+    """ Generator to yield the file entries of the given directory entries, calling the
+        given descend function with the path of each subdirectory which has not been
+        visited and is not pruned. Updates the given set of visited directory keys. """
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+        except OSError:
+            is_dir = False
+        if (not is_dir):
+            yield entry
+        elif ((prune is None) or (not prune(entry))):
+            try:
+                key = _dir_key(entry.stat(follow_symlinks=follow_symlinks))
+            except OSError:
+                continue
+            if (key not in visited):
+                visited.add(key)
+                descend(entry.path)
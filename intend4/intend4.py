@@ -1,114 +1,321 @@
 # Program to insert IntendedFor array in phasediff JSON sidecar files in order
 # to trigger fMRIPrep or QSIPrep to run SDC (Susceptibility Distortion Correction).
 #   Written by: Tom Hicks and Dianne Patterson. 4/21/21.
-#   Last Modified: Remove some redundant error msg prefixes.
+#   Last Modified: Reject sidecar text with duplicate IntendedFor keys.
 #
 import os
 import sys
 import bids
 import json
-from bids import BIDSLayout
+import queue
+import threading
+from bids import BIDSLayout, BIDSLayoutIndexer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import groupby
 
 from intend4 import ALLOWED_MODALITIES, BIDS_DIR
-from intend4.file_utils import get_permissions
-
-
+from intend4.checkpoint import index_cache_is_current, index_stamp, write_index_stamp
+from intend4.fieldmap_rules import ALL_MODALITIES, DEFAULT_RULES, rule_modalities, select_rules
+from intend4.file_lock import default_lock_dir, file_lock
+from intend4.file_utils import StatCache, modification_problem, read_text, rewrite_text
+from intend4.scan_layout import ScanLayout, list_subjects
+from intend4.vcs import commit_files, unlock_files
+
+
+CHECK_AMBIGUOUS = 'ambiguous'         # more than one fieldmap sidecar was found
+CHECK_CORRECT = 'correct'             # IntendedFor value is as expected
+CHECK_MISSING = 'missing'             # no fieldmap sidecar was found
+CHECK_STALE = 'stale'                 # IntendedFor value is absent or out of date
+CHECK_UNREADABLE = 'unreadable'       # the fieldmap sidecar could not be read
+CHECK_STATUSES = [CHECK_CORRECT, CHECK_STALE, CHECK_MISSING, CHECK_AMBIGUOUS, CHECK_UNREADABLE]
+SKIP_FAILED = 'failed'                # the fieldmap sidecar could not be read or written
+SKIP_PREFLIGHT = 'preflight'          # the fieldmap sidecar failed the preflight check
+UPDATE_DONE = 'updated'               # IntendedFor value was written to the sidecar
 IMAGE_EXT = ['nii.gz', 'nii']
-PHASEDIFF_SUFFIX = 'phasediff'
-RPE_SUFFIX = 'epi'
+PIPELINE_QUEUE_SIZE = 64              # default number of targets buffered between the pipeline stages
+PREFLIGHT_ABORT = 'abort'             # preflight problems stop the run before any writes
+PREFLIGHT_SKIP = 'skip'               # preflight problems cause those sidecars to be skipped
+PREFLIGHT_MODES = [PREFLIGHT_ABORT, PREFLIGHT_SKIP]
 SIDECAR_EXT = 'json'
 SUBJ_DIR_PREFIX = 'sub-'
 
+# messages explaining why a subject (or subject/session) was skipped, by status
+SKIP_MESSAGES = {
+  CHECK_MISSING: "{suffix} sidecar file is missing for subject {subj_id}{sess}",
+  CHECK_AMBIGUOUS: "Found more than 1 {suffix} sidecars for subject {subj_id}{sess}",
+  SKIP_FAILED: "Unable to modify {suffix} sidecar file for subject {subj_id}{sess}: {detail}",
+  SKIP_PREFLIGHT: "{suffix} sidecar file failed the preflight check for subject {subj_id}{sess}"
+}
+
+
+def check_sidecar (check, throttle=None):
+  """
+  Complete the given check of a single subject (or subject/session) by reading its
+  fieldmap sidecar, if there is exactly one, and comparing its IntendedFor value with
+  the expected value. Returns the given check dictionary with its status filled in.
+  Never modifies the sidecar. The read is subject to the optional I/O throttle.
+  """
+  sidecars = check['sidecars']
+  if (len(sidecars) < 1):
+    check['status'] = CHECK_MISSING
+  elif (len(sidecars) > 1):
+    check['status'] = CHECK_AMBIGUOUS
+  else:
+    try:
+      contents = read_sidecar(sidecars[0], throttle=throttle)
+    except (OSError, ValueError) as err:
+      check['status'] = CHECK_UNREADABLE
+      check['error'] = str(err)
+      return check
+    if (not isinstance(contents, dict)):
+      check['status'] = CHECK_UNREADABLE
+      check['error'] = f"Sidecar {sidecars[0]} does not hold a JSON object."
+      return check
+    intended_for = contents.get('IntendedFor')
+    if (isinstance(intended_for, str)):  # a single path need not be in a list
+      intended_for = [intended_for]
+    if (isinstance(intended_for, list) and all(isinstance(path, str) for path in intended_for)
+        and (sorted(intended_for) == sorted(check['expected']))):
+      check['status'] = CHECK_CORRECT
+    else:
+      check['status'] = CHECK_STALE
+  return check
+
+
+def check_subjects (modality, args):
+  """
+  For the specified subject (or all subjects), compare the expected IntendedFor value
+  with the current value in the fieldmap sidecar which would be modified for the given
+  modality, without modifying any files. The BIDS index is queried serially but the
+  sidecars are read and compared concurrently. Returns a list of check dictionaries,
+  one per subject (or subject/session) with images of the given modality.
+  """
+  with track_phase(args, 'index'):
+    layout = load_layout(args)
+
+  with track_phase(args, 'check'):
+    return check_targets(modality, args, layout, select_subjects(args, layout))
+
+
+def check_targets (modality, args, layout, subj_ids):
+  """
+  For the given subjects (or subject/sessions) with images of the given modality, compare
+  the expected IntendedFor value with the current value in the fieldmap sidecar, without
+  modifying any files. The layout is queried serially but the sidecars are read and compared
+  concurrently. Returns a list of check dictionaries, one per subject (or subject/session).
+  """
+  checks = []
+  for target in gen_targets(modality, args, layout, subj_ids):
+    target['expected'] = [] if args.get('remove') else target.pop('image_paths')
+    checks.append(target)
+
+  throttle = args.get('io_throttle')
+  with ThreadPoolExecutor(max_workers=args.get('max_workers')) as executor:
+    return list(executor.map(lambda check: check_sidecar(check, throttle=throttle), checks))
+
 
 def do_subjects(modality, args):
   """
   For the specified subject (or all subjects), find and modify the fieldmap sidecars
   which will be used to correct images with the given modality.
   """
-  # use the optionally specified BIDS data dir or default to current directory
-  bids_dir = args.get('bids_dir', BIDS_DIR)
-
-  # analyze BIDS data directory but exit if not valid to avoid changing any files
-  sys.tracebacklimit = 0
-  try:
-    layout = BIDSLayout(bids_dir, validate=True)
-  except:
-    raise RuntimeError(
-      f"BIDS validator got an error while processing the BIDS Data directory.")
+  with track_phase(args, 'index'):
+    layout = load_layout(args)
+    selected_subjects = select_subjects(args, layout)
+
+  # collect all the sidecars which will be modified, if they are needed before writing
+  vcs = args.get('vcs')
+  preflight = args.get('preflight')
+  if (vcs or preflight):
+    with track_phase(args, 'plan'):
+      sidecars = planned_sidecars(modality, args, layout, selected_subjects)
+
+  # check that every sidecar can be modified before modifying any of them
+  if (preflight):
+    with track_phase(args, 'preflight'):
+      problems = preflight_sidecars(sidecars, args)
+    sidecars = handle_preflight_problems(problems, sidecars, args)
+
+  # in version control mode, unlock all the sidecars which will be modified in one batch
+  if (vcs):
+    with track_phase(args, 'unlock'):
+      bids_dir = args.get('bids_dir', BIDS_DIR)
+      unlock_files(bids_dir, sidecars, vcs)
+
+  with track_phase(args, 'update'):
+    mod_count = 0
+    try:
+      for subj_id in selected_subjects:
+        mod_count += do_single_subject(modality, args, layout, subj_id)
+    finally:
+      save_checkpoint(args)
+
+  # in version control mode, save all the modified sidecars in a single commit
+  if (vcs):
+    with track_phase(args, 'commit'):
+      action = 'Remove' if args.get('remove') else 'Update'
+      message = args.get('vcs_message') or f"{action} IntendedFor for modality '{modality}'"
+      commit_files(bids_dir, sidecars, message, vcs)
+  return mod_count
 
-  # use the optionally specified list of subjects or default to all subjects
-  subj_ids = args.get('subj_ids')
-  if (subj_ids is not None):
-    selected_subjects = subj_ids
-  else:
-    selected_subjects = layout.get_subjects()
 
+def do_subjects_pipelined (modality, args):
+  """
+  For the specified subject (or all subjects), find and modify the fieldmap sidecars
+  which will be used to correct images with the given modality, in a two stage pipeline:
+  a producer thread scans the subject directories and queues the targets of each subject
+  (grouped by subject/session) as soon as its directory has been scanned, while the calling
+  thread modifies the sidecars of the queued targets. The bounded queue keeps the scan from
+  running far ahead of the writes. The directories are scanned directly, without BIDS validation.
+  Returns the number of sidecars modified.
+  """
+  layout = ScanLayout(args.get('bids_dir', BIDS_DIR), scan=False)
+  queue_size = args.get('queue_size') or PIPELINE_QUEUE_SIZE
+  targets = queue.Queue(maxsize=queue_size)
+  stopping = threading.Event()
+  failures = []
+
+  def produce_targets ():
+    try:
+      scanned = gen_scanned_targets(modality, args, layout, window=queue_size)
+      for _, pair_targets in groupby(scanned, key=lambda target: (target['subject'], target['session'])):
+        if (stopping.is_set()):
+          break
+        targets.put(list(pair_targets))
+    except BaseException as ex:          # handed over to the consuming thread
+      failures.append(ex)
+    finally:
+      targets.put(None)                  # marks the end of the targets
+
+  producer = threading.Thread(target=produce_targets, name='intend4-scanner', daemon=True)
   mod_count = 0
-  for subj_id in selected_subjects:
-    mod_count += do_single_subject(modality, args, layout, subj_id)
+  with track_phase(args, 'pipeline'):
+    producer.start()
+    try:
+      pair_targets = targets.get()
+      while (pair_targets is not None):
+        subj_id, session_id = pair_targets[0]['subject'], pair_targets[0]['session']
+        if (not is_completed(args, subj_id, session_id)):
+          stop_if_requested(args)
+          print_processing_message(args, subj_id, session_id)
+          for target in pair_targets:
+            if (update_and_report(target, modality, args)['status'] == UPDATE_DONE):
+              mod_count += 1
+          mark_completed(args, subj_id, session_id)
+        pair_targets = targets.get()
+    finally:
+      save_checkpoint(args)
+      stopping.set()
+      while (producer.is_alive()):       # unblock the producer, even after an error
+        try:
+          targets.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      producer.join()
+  if (failures):
+    raise failures[0]
   return mod_count
 
 
 def do_single_subject(modality, args, layout, subj_id):
   """
-  For a single subject (and optional sessions), find and modify the fieldmap sidecar
-  which will be used to correct the image with the given modality.
+  For a single subject (and optional sessions), find and modify the fieldmap sidecars
+  which will be used to correct the images with the given modality.
+  Returns the number of sidecars modified.
   """
   mod_count = 0
   sessions = sessions_for_subject(layout, subj_id)
   if (sessions):             # if there are sessions in use
     for sess_num in sessions:
-      update_fieldmap(modality, args, layout, subj_id, session_id=sess_num)
-      mod_count += 1
-  else:                      # else sessions are not being used
-    update_fieldmap(modality, args, layout, subj_id)
-    mod_count += 1
+      if ((not is_retried(args, subj_id, sess_num)) or is_completed(args, subj_id, sess_num)):
+        continue
+      stop_if_requested(args)
+      mod_count += update_fieldmap(modality, args, layout, subj_id, session_id=sess_num)
+      mark_completed(args, subj_id, sess_num)
+  elif (is_retried(args, subj_id) and (not is_completed(args, subj_id))):  # else sessions are not being used
+    stop_if_requested(args)
+    mod_count += update_fieldmap(modality, args, layout, subj_id)
+    mark_completed(args, subj_id)
   return mod_count
 
 
+def gen_scanned_targets (modality, args, layout, window=PIPELINE_QUEUE_SIZE):
+  """
+  Generator to yield the targets (see gen_targets) of the specified subjects (or all subjects)
+  in the given scanning layout, scanning each subject directory just before yielding its targets.
+  The subject directories are scanned concurrently, no more than window subjects ahead of the
+  targets yielded, and the targets are yielded in subject order.
+  """
+  subj_ids = args.get('subj_ids')
+  if (subj_ids is None):
+    subj_ids = list_subjects(layout.root)
+  subj_ids = [ subj_id for subj_id in subj_ids
+               if os.path.isdir(os.path.join(layout.root, f"{SUBJ_DIR_PREFIX}{subj_id}")) ]
+  with ThreadPoolExecutor(max_workers=args.get('max_workers')) as executor:
+    pending = deque()
+    for subj_id in subj_ids:
+      pending.append((subj_id, executor.submit(layout.scan_subject, subj_id)))
+      if (len(pending) >= window):
+        yield from scanned_targets(modality, args, layout, *pending.popleft())
+    while (pending):
+      yield from scanned_targets(modality, args, layout, *pending.popleft())
+
+
+def gen_targets (modality, args, layout, subj_ids):
+  """
+  Generator to yield the target dictionaries (see plan_targets) of each of the given subjects
+  (or subject/sessions) which has images selected by the fieldmap rules for the given modality.
+  Each target holds the subject and session IDs, the subject-relative image paths, the paths
+  of the candidate fieldmap sidecars, and the fieldmap suffix.
+  """
+  for subj_id in subj_ids:
+    for session_id in (sessions_for_subject(layout, subj_id) or [None]):
+      if (not is_retried(args, subj_id, session_id)):
+        continue
+      yield from plan_targets(modality, args, layout, subj_id, session_id=session_id)
+
+
 def get_fieldmap_suffix (modality, args=None):
   """
-  Compute the fieldmap suffix for correcting images of the given modality, allowing
-  for special cases specified by additional arguments (in the future).
+  Compute the fieldmap suffix for correcting images of the given modality, from the
+  fieldmap rules for the modality (see get_rules). Modalities whose rules name several
+  fieldmap suffixes are described by joining the suffixes with slashes.
   """
-  return PHASEDIFF_SUFFIX if (modality == 'bold') else RPE_SUFFIX
+  suffixes = []
+  for rule in get_rules(modality, args):
+    suffix = rule_fieldmap_suffix(rule)
+    if (suffix not in suffixes):
+      suffixes.append(suffix)
+  return '/'.join(suffixes)
 
 
-def get_image_paths (modality, args, layout, subj_id, session_id=None):
+def get_rules (modality, args=None):
   """
-  Return a list of modality-specific image paths for the given subject (or subject/session).
-  Assumes that the modality argument is the same string used for the BIDS file suffix
-  for that modality.
+  Return the fieldmap rules for the given modality from the fieldmap_rules table of the
+  optional arguments, which defaults to the DEFAULT_RULES table (see fieldmap_rules).
   """
-  bids_file_objects = layout.get(subject=subj_id, session=session_id,
-                                 extension=IMAGE_EXT, suffix=modality)
-  return [subjrelpath(bids_file_object.relpath) for bids_file_object in bids_file_objects]
+  return select_rules(modality, (args or {}).get('fieldmap_rules') or DEFAULT_RULES)
 
 
-def get_sidecar_and_modify (modality, args, layout, image_paths, subj_id, session_id=None):
+def handle_preflight_problems (problems, sidecars, args):
   """
-  Insert the given image paths into the appropriate sidecar data structure for
-  for identified subject (or subject/session). Then rewrite the (modified) sidecar.
-  Raise an error if more than one sidecar is found per subject (or subject/session).
+  Report the given preflight problems, a list of (sidecar path, problem) tuples. Then,
+  in abort mode, raise PermissionError to stop the run before any sidecar is modified or,
+  in skip mode, mark the problem sidecars to be skipped. Returns the list of the given
+  sidecars which remain to be modified.
   """
-  fieldmap_suffix = get_fieldmap_suffix(modality, args)
-  sidecars = layout.get(target='subject', subject=subj_id, session=session_id,
-                        suffix=fieldmap_suffix, extension=SIDECAR_EXT)
-  num_sidecars = len(sidecars)
-  if (num_sidecars < 1):
-    sess = f" in session {session_id}" if session_id else ''
-    err_msg = f"Error: {fieldmap_suffix} sidecar file is missing for subject {subj_id}{sess}. Skipping..."
-    print(err_msg, file=sys.stderr)
-    return
-  elif (num_sidecars > 1):
-    sess = f" in session {session_id}" if session_id else ''
-    err_msg = f"Error: Found more than 1 {fieldmap_suffix} sidecars for subject {subj_id}{sess}. Skipping..."
-    print(err_msg, file=sys.stderr)
-    return
-  else:
-    sidecar = sidecars[0]
-    modified_contents = modify_intended_for(image_paths, sidecar.get_dict(), remove=args.get('remove'))
-    rewrite_sidecar(modified_contents, sidecar.path)
+  if (not problems):
+    return sidecars
+  for (sidecar, problem) in problems:
+    print(f"Error: sidecar file {sidecar} {problem}.", file=sys.stderr)
+  if (args.get('preflight') == PREFLIGHT_ABORT):
+    raise PermissionError(
+      f"Preflight check found {len(problems)} sidecar files which cannot be modified. No files were modified.")
+  skipped = set(sidecar for (sidecar, _) in problems)
+  args['skip_sidecars'] = skipped
+  return [sidecar for sidecar in sidecars if (sidecar not in skipped)]
 
 
 def has_session(layout, subj_id):
@@ -116,13 +323,91 @@ def has_session(layout, subj_id):
   return subj_id in layout.get(return_type='id', target='subject', session=layout.get_sessions())
 
 
+def is_completed (args, subj_id, session_id=None):
+  "Tell whether the identified subject (or subject/session) was completed by the run being resumed."
+  checkpoint = args.get('checkpoint')
+  return (checkpoint is not None) and checkpoint.is_done(subj_id, session_id)
+
+
+def is_retried (args, subj_id, session_id=None):
+  """
+  Tell whether the identified subject (or subject/session) should be processed when
+  retrying only the entries of a retry file (see read_retry_file). Always True otherwise.
+  """
+  retry_pairs = args.get('retry_pairs')
+  return (retry_pairs is None) or ((subj_id, session_id) in retry_pairs)
+
+
+def load_layout (args):
+  """
+  Index and validate the optionally specified BIDS data directory (or the default
+  directory) and return the layout. Raises RuntimeError if the directory is not valid.
+  Unless the index_metadata argument is True, the JSON sidecars are not parsed into the
+  index: intend4 reads only the fieldmap sidecars which it modifies, when it modifies them.
+  If an index_cache directory is specified, the index is saved there and is reused by
+  later runs until the dataset changes (see checkpoint.index_stamp).
+  """
+  # use the optionally specified BIDS data dir or default to current directory
+  bids_dir = args.get('bids_dir', BIDS_DIR)
+  index_metadata = args.get('index_metadata', False)
+
+  # reuse the cached index only if it was built for the current state of the dataset
+  index_cache = args.get('index_cache')
+  reset_cache = False
+  if (index_cache):
+    os.makedirs(index_cache, exist_ok=True)
+    own_files = [args.get('checkpoint_file'), args.get('retry_file')]
+    stamp = index_stamp(bids_dir, index_metadata, own_files=own_files)
+    reset_cache = not index_cache_is_current(index_cache, stamp)
+
+  # analyze BIDS data directory but exit if not valid to avoid changing any files
+  sys.tracebacklimit = 0
+  try:
+    indexer = BIDSLayoutIndexer(validate=True, index_metadata=index_metadata)
+    layout = BIDSLayout(bids_dir, validate=True, indexer=indexer,
+                        database_path=index_cache, reset_database=reset_cache)
+  except:
+    raise RuntimeError(
+      f"BIDS validator got an error while processing the BIDS Data directory.")
+  if (reset_cache):
+    write_index_stamp(index_cache, stamp)
+  return layout
+
+
+def lock_for (apath, args, timeout=None):
+  """
+  Return a context manager which holds the advisory lock guarding the given path (see
+  file_lock.file_lock), kept in the lock_dir argument or, by default, in the default lock
+  directory of the BIDS data directory (see file_lock.default_lock_dir), which is shared by
+  all the runs on the dataset. The lock operations are subject to the io_throttle argument.
+  """
+  lock_dir = args.get('lock_dir')
+  throttle = args.get('io_throttle')
+  if (lock_dir is None):
+    if (args.get('default_lock_dir') is None):   # found once per run
+      args['default_lock_dir'] = default_lock_dir(args.get('bids_dir', BIDS_DIR))
+    return file_lock(apath, args['default_lock_dir'], timeout=timeout, shared=True,
+                     throttle=throttle)
+  return file_lock(apath, lock_dir, timeout=timeout, throttle=throttle)
+
+
+def mark_completed (args, subj_id, session_id=None):
+  "Record the identified subject (or subject/session) as completed, if checkpointing."
+  checkpoint = args.get('checkpoint')
+  if (checkpoint is not None):
+    checkpoint.mark_done(subj_id, session_id)
+
+
 def modify_intended_for (image_paths, contents, remove=False):
   """
   Modify the given contents dictionary, storing the given image paths under the
   IntendedFor key. If IntendedFor key already exists, its value is replaced by the
   given image paths. If remove flag is True, then the value is replaced by an empty list.
   Returns the sidecar contents dictionary, sorted by keywords.
+  Raises ValueError if the given contents are not a dictionary (a JSON object).
   """
+  if (not isinstance(contents, dict)):
+    raise ValueError(f"Sidecar contents must be a JSON object, not: {type(contents).__name__}")
   contents['IntendedFor'] = [] if remove else image_paths
   sorted_dict = dict(sorted(contents.items()))
   return sorted_dict
@@ -143,12 +428,162 @@ def output_JSON (data, file_path=None, **json_keywords):
     outfile.close()
 
 
-def rewrite_sidecar (modified_contents, sidecar):
+def planned_sidecars (modality, args, layout, subj_ids):
+  """
+  Return a list of the paths to the sidecars which will be modified for the given subjects:
+  i.e., the single fieldmap sidecar of each subject (or subject/session) with images.
+  """
+  return [target['sidecars'][0] for target in gen_targets(modality, args, layout, subj_ids)
+          if (len(target['sidecars']) == 1)]
+
+
+def plan_targets (modality, args, layout, subj_id, session_id=None):
+  """
+  Apply the fieldmap rules for the given modality to the identified subject (or subject/session)
+  and return a list of target dictionaries, one for each fieldmap sidecar to be modified.
+  The images of all the rules which select the same single sidecar are combined into one target,
+  so that each sidecar is modified only once. The images of a rule which selects no sidecar, or
+  more than one, form a target of their own, which is reported as missing or ambiguous.
+  """
+  targets = {}
+  for ndx, rule in enumerate(get_rules(modality, args)):
+    image_paths = rule_image_paths(rule, layout, subj_id, session_id)
+    if (not image_paths):
+      continue
+    sidecars = [sidecar.path for sidecar in rule_sidecars(rule, layout, subj_id, session_id)]
+    key = sidecars[0] if (len(sidecars) == 1) else ndx
+    target = targets.setdefault(key, {
+      'subject': subj_id,
+      'session': session_id,
+      'image_paths': [],
+      'sidecars': sidecars,
+      'fieldmap': rule_fieldmap_suffix(rule)
+    })
+    target['image_paths'].extend(image_path for image_path in image_paths
+                                 if (image_path not in target['image_paths']))
+  return list(targets.values())
+
+
+def preflight_sidecars (sidecars, args):
+  """
+  Check whether each of the given sidecar files can be modified, after concurrently
+  fetching the status of all of them into the stat cache of the run (created as the
+  stat_cache argument, if necessary). Returns a (possibly empty) list of (sidecar path,
+  problem) tuples, one for each sidecar which cannot be modified.
+  """
+  throttle = args.get('io_throttle')
+  cache = args.setdefault('stat_cache', StatCache())
+  cache.stat_many(sidecars, max_workers=args.get('max_workers'), throttle=throttle)
+  problems = [ modification_problem(sidecar, throttle=throttle, cache=cache) for sidecar in sidecars ]
+  return [(sidecar, problem) for (sidecar, problem) in zip(sidecars, problems) if problem]
+
+
+def print_processing_message (args, subj_id, session_id=None):
+  "In verbose mode, print a message saying that the identified subject (or subject/session) is being processed."
+  if (args.get('verbose')):
+    prog_name = args.get('PROG_NAME')
+    prog_prefix = f"({prog_name}): " if prog_name else ''
+    sess = f" in session {session_id}" if session_id else ''
+    print(f"{prog_prefix}Processing subject {subj_id}{sess}")
+
+
+def read_retry_file (file_path):
+  """
+  Read the given retry file (see write_retry_file) and return a tuple of the modality
+  and the list of entries it holds. Raises ValueError if the file is not a retry file.
+  """
+  with open(file_path, 'r') as retry_file:
+    contents = json.load(retry_file)
+  if ((not isinstance(contents, dict)) or (not isinstance(contents.get('entries'), list))):
+    raise ValueError(f"File {file_path} is not an intend4 retry file.")
+  for entry in contents['entries']:
+    if ((not isinstance(entry, dict)) or ('subject' not in entry)):
+      raise ValueError(f"File {file_path} holds an entry without a subject: {entry}")
+  return (contents.get('modality'), contents['entries'])
+
+
+def read_sidecar (sidecar, throttle=None):
+  "Read and return the contents dictionary of the given sidecar file."
+  return json.loads(read_text(sidecar, throttle=throttle))
+
+
+def read_sidecar_text (sidecar, throttle=None):
+  "Read and return the unparsed JSON text of the given sidecar file."
+  return read_text(sidecar, throttle=throttle)
+
+
+def report_skip (status, modality, args, subj_id, session_id=None, detail=None, fieldmap=None):
+  """
+  Print an error message saying why the identified subject (or subject/session) is being
+  skipped, and record it, with the status and reason, in the retry entries of the arguments.
+  The message names the given fieldmap suffix or, by default, that of the given modality.
+  """
+  sess = f" in session {session_id}" if session_id else ''
+  suffix = fieldmap or get_fieldmap_suffix(modality, args)
+  reason = SKIP_MESSAGES[status].format(suffix=suffix, subj_id=subj_id, sess=sess, detail=detail)
+  print(f"Error: {reason}. Skipping...", file=sys.stderr)
+  args.setdefault('retry_entries', []).append(
+    { 'subject': subj_id, 'session': session_id, 'status': status, 'reason': reason })
+
+
+def retry_pairs (entries):
+  "Return a set of the (subject, session) pairs of the given retry entries."
+  return set((entry['subject'], entry.get('session')) for entry in entries)
+
+
+def rewrite_sidecar (modified_contents, sidecar, throttle=None):
   "Convert the contents dictionary to JSON and write it back to the sidecar file."
-  permissions = get_permissions(sidecar)   # get current file permissions
-  os.chmod(sidecar, 0o0640)                # make file writable
-  output_JSON(modified_contents, file_path=sidecar)
-  os.chmod(sidecar, permissions)           # restore original file permissions
+  rewrite_sidecar_text(json.dumps(modified_contents, indent=2) + '\n', sidecar, throttle=throttle)
+
+
+def rewrite_sidecar_text (text, sidecar, throttle=None):
+  """
+  Write the given JSON text back to the sidecar file, preserving the file permissions.
+  The file operations are subject to the optional I/O throttle (see file_utils.rewrite_text).
+  """
+  rewrite_text(sidecar, text, writable_mode=0o0640, throttle=throttle)
+
+
+def rule_fieldmap_suffix (rule):
+  "Return the fieldmap suffix of the given rule, joining a list of suffixes with slashes."
+  suffix = rule['fieldmap']['suffix']
+  return '/'.join(suffix) if isinstance(suffix, list) else suffix
+
+
+def rule_image_paths (rule, layout, subj_id, session_id=None):
+  "Return a list of the subject-relative paths of the images selected by the given rule, for the given subject (or subject/session)."
+  bids_file_objects = layout.get(subject=subj_id, session=session_id, extension=IMAGE_EXT, **rule['target'])
+  return [subjrelpath(bids_file_object.relpath) for bids_file_object in bids_file_objects]
+
+
+def rule_sidecars (rule, layout, subj_id, session_id=None):
+  "Return a list of the BIDS file objects for the fieldmap sidecars selected by the given rule, for the given subject (or subject/session)."
+  return layout.get(target='subject', subject=subj_id, session=session_id,
+                    extension=SIDECAR_EXT, **rule['fieldmap'])
+
+
+def save_checkpoint (args):
+  "Save the progress of the run, if checkpointing."
+  checkpoint = args.get('checkpoint')
+  if (checkpoint is not None):
+    checkpoint.save()
+
+
+def scanned_targets (modality, args, layout, subj_id, scan):
+  """
+  Add the result of the given (future) scan of the identified subject to the given scanning
+  layout and return a list of the targets (see gen_targets) of the subject.
+  """
+  layout.add_subject(subj_id, *scan.result())
+  return list(gen_targets(modality, args, layout, [subj_id]))
+
+
+def select_subjects (args, layout):
+  "Return the optionally specified list of subject IDs or default to all subjects."
+  subj_ids = args.get('subj_ids')
+  if (subj_ids is not None):
+    return subj_ids
+  return layout.get_subjects()
 
 
 def sessions_for_subject(layout, subj_id):
@@ -156,6 +591,58 @@ def sessions_for_subject(layout, subj_id):
   return layout.get(return_type='id', target='session', subject=subj_id)
 
 
+def skip_whitespace (text, ndx):
+  "Return the index of the first non-whitespace character in the given text at or after the given index."
+  while ((ndx < len(text)) and text[ndx].isspace()):
+    ndx += 1
+  return ndx
+
+
+def splice_intended_for (text, intended_for):
+  """
+  Return a copy of the given sidecar JSON text in which only the value of the top-level
+  IntendedFor key has been replaced by the given list of paths. If there is no IntendedFor
+  key, it is appended as the last key of the top-level object. All other keys, their order,
+  the formatting of their values, and the indentation style of the text are left unchanged,
+  so that the textual difference between the original and modified sidecar is minimal.
+  Raises ValueError if the text is not a JSON object or has more than one IntendedFor key.
+  """
+  members, close_ndx = top_level_members(text)
+  if (sum(1 for member in members if (member[0] == 'IntendedFor')) > 1):
+    raise ValueError("Sidecar JSON text has more than one IntendedFor key.")
+  if (not members):                    # nothing to preserve: write a fresh object
+    return json.dumps({'IntendedFor': intended_for}, indent=2) + text[close_ndx+1:]
+
+  # the indentation of the last key, relative to the start of its line, is used for new text,
+  # unless the key does not start its line, in which case the compact form is used
+  key_start = members[-1][1]
+  line_start = text.rfind('\n', 0, key_start) + 1
+  line_prefix = text[line_start:key_start]
+  multiline = ((line_start > 0) and (len(line_prefix) - len(line_prefix.lstrip()) == len(line_prefix)))
+  member_indent = line_prefix if multiline else ''
+  value_json = json.dumps(intended_for, indent=(member_indent if multiline else None))
+  value_json = value_json.replace('\n', '\n' + member_indent)
+
+  for (key, _, value_start, value_end) in members:
+    if (key == 'IntendedFor'):
+      return text[:value_start] + value_json + text[value_end:]
+
+  value_end = members[-1][3]
+  separator = ',\n' + member_indent if multiline else ', '
+  return text[:value_end] + separator + '"IntendedFor": ' + value_json + text[value_end:]
+
+
+def stop_if_requested (args):
+  """
+  Exit (by raising SystemExit) if a stop of the run has been requested by a signal, such as
+  the SIGTERM of a batch system walltime limit (see intend4_cli.request_stop). Called only
+  between subjects (or subject/sessions), so that no sidecar is left partially rewritten.
+  """
+  signum = args.get('stop_signal')
+  if (signum is not None):
+    raise SystemExit(128 + signum)
+
+
 def subjrelpath (subjpath):
   """
   Return the subject-relative path for the given filepath string or None if the
@@ -171,28 +658,143 @@ def subjrelpath (subjpath):
     return None
 
 
+def top_level_members (text):
+  """
+  Scan the given JSON object text and return a tuple of a list of (key, key start index,
+  value start index, value end index) tuples, one for each top-level key, and the index
+  of the closing brace of the object. Raises ValueError if the text is not a JSON object.
+  """
+  decoder = json.JSONDecoder()
+  ndx = skip_whitespace(text, 0)
+  if (not text.startswith('{', ndx)):
+    raise ValueError("Sidecar JSON text does not contain a JSON object.")
+  members = []
+  ndx = skip_whitespace(text, ndx + 1)
+  if (text.startswith('}', ndx)):
+    return (members, ndx)
+  while True:
+    key_start = ndx
+    key, ndx = decoder.raw_decode(text, key_start)
+    if (not isinstance(key, str)):
+      raise ValueError("Expected a key string in sidecar JSON text.")
+    ndx = skip_whitespace(text, ndx)
+    if (not text.startswith(':', ndx)):
+      raise ValueError(f"Expected ':' after key {key} in sidecar JSON text.")
+    value_start = skip_whitespace(text, ndx + 1)
+    _, value_end = decoder.raw_decode(text, value_start)
+    members.append((key, key_start, value_start, value_end))
+    ndx = skip_whitespace(text, value_end)
+    if (text.startswith('}', ndx)):
+      return (members, ndx)
+    if (not text.startswith(',', ndx)):
+      raise ValueError(f"Expected ',' or '}}' after the value of key {key} in sidecar JSON text.")
+    ndx = skip_whitespace(text, ndx + 1)
+
+
+def track_phase (args, name):
+  """
+  Return a context manager which records the memory used by the named phase of the run,
+  if a memory tracker was given in the arguments, or which does nothing otherwise.
+  """
+  tracker = args.get('memory_tracker')
+  return tracker.phase(name) if tracker else nullcontext()
+
+
+def update_and_report (target, modality, args):
+  """
+  Modify the fieldmap sidecar of the given target (see update_target), reporting the target
+  as skipped (see report_skip) if it was not modified. Returns the target with its status
+  filled in: the SKIP_FAILED status means that the sidecar could not be read or written.
+  """
+  try:
+    update_target(target, args)
+  except (OSError, ValueError) as ex:
+    target['status'] = SKIP_FAILED
+    target['detail'] = str(ex)
+  if (target['status'] != UPDATE_DONE):
+    report_skip(target['status'], modality, args, target['subject'], target['session'],
+                detail=target.get('detail'), fieldmap=target.get('fieldmap'))
+  return target
+
+
 def update_fieldmap(modality, args, layout, subj_id, session_id=None):
   """
-  Get paths to all images for the given subject (or subject/session) with the given modality,
-  and insert them in the appropriate sidecar.
+  Apply the fieldmap rules for the given modality to the given subject (or subject/session),
+  inserting the paths of the selected images in the appropriate sidecars. All the rules are
+  applied in one pass over the index and each affected sidecar is modified only once.
+  Returns the number of sidecars modified.
   """
-  if (args.get('verbose')):
-    prog_name = args.get('PROG_NAME')
-    prog_prefix = f"({prog_name}): " if prog_name else ''
-    sess = f" in session {session_id}" if session_id else ''
-    print(f"{prog_prefix}Processing subject {subj_id}{sess}")
-  image_paths = get_image_paths(modality, args, layout, subj_id, session_id=session_id)
-  if (image_paths):
-    get_sidecar_and_modify(modality, args, layout, image_paths, subj_id, session_id=session_id)
+  print_processing_message(args, subj_id, session_id)
+  targets = plan_targets(modality, args, layout, subj_id, session_id=session_id)
+  return sum(1 for target in targets if (update_and_report(target, modality, args)['status'] == UPDATE_DONE))
+
+
+def update_target (target, args):
+  """
+  Modify the fieldmap sidecar of the given target (as generated by gen_targets), if it has
+  exactly one which did not fail the preflight check. Returns the target with its status
+  filled in: either UPDATE_DONE or the status which explains why the target was skipped.
+  """
+  sidecars = target['sidecars']
+  if (len(sidecars) < 1):
+    target['status'] = CHECK_MISSING
+  elif (len(sidecars) > 1):
+    target['status'] = CHECK_AMBIGUOUS
+  elif (sidecars[0] in args.get('skip_sidecars', ())):
+    target['status'] = SKIP_PREFLIGHT
+  else:
+    update_sidecar(target['image_paths'], sidecars[0], args)
+    target['status'] = UPDATE_DONE
+  return target
+
+
+def update_sidecar (image_paths, sidecar, args):
+  """
+  Read the given sidecar file, insert the given image paths into its contents, and rewrite it.
+  The read-modify-write is done while holding an advisory lock on the sidecar, so that
+  concurrent runs cannot interleave their changes to the same sidecar file.
+  If the keep_order argument is True, only the IntendedFor value is changed, leaving the
+  rest of the sidecar text untouched, and an unchanged sidecar is not rewritten at all.
+  The file operations are subject to the optional io_throttle argument.
+  """
+  throttle = args.get('io_throttle')
+  with lock_for(sidecar, args):
+    if (args.get('keep_order')):
+      text = read_sidecar_text(sidecar, throttle=throttle)
+      intended_for = [] if args.get('remove') else image_paths
+      modified_text = splice_intended_for(text, intended_for)
+      if (modified_text != text):
+        try:
+          json.loads(modified_text)        # never write a sidecar which cannot be parsed
+        except ValueError as ve:
+          raise ValueError(f"Modified text of sidecar {sidecar} is not valid JSON: {ve}")
+        rewrite_sidecar_text(modified_text, sidecar, throttle=throttle)
+    else:
+      contents = read_sidecar(sidecar, throttle=throttle)
+      modified_contents = modify_intended_for(image_paths, contents, remove=args.get('remove'))
+      rewrite_sidecar(modified_contents, sidecar, throttle=throttle)
 
 
-def validate_modality (modality):
+def validate_modality (modality, rules=None):
   """
    Check the validity of the given modality string which must be one
-   of the elements of the ALLOWED_MODALITIES list.
+   of the elements of the ALLOWED_MODALITIES list or, if a rules table is
+   given, one of the modalities of its rules (or ALL_MODALITIES).
    Returns the canonicalized modality string or raises ValueError if
    given an invalid modality string.
   """
-  if (modality in ALLOWED_MODALITIES):
+  allowed = ALLOWED_MODALITIES if (rules is None) else (rule_modalities(rules) + [ALL_MODALITIES])
+  if (modality in allowed):
     return modality
-  raise ValueError(f"Modality argument must be one of: {ALLOWED_MODALITIES}")
+  raise ValueError(f"Modality argument must be one of: {allowed}")
+
+
+def write_retry_file (file_path, modality, entries):
+  """
+  Write the given retry entries (see report_skip), for the given modality, to the given
+  file as JSON. The file is replaced atomically, so an interrupted run cannot leave a
+  partial retry file behind.
+  """
+  temp_path = f"{file_path}.tmp"
+  output_JSON({ 'modality': modality, 'entries': entries }, file_path=temp_path)
+  os.replace(temp_path, file_path)
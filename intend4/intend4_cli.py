@@ -1,31 +1,47 @@
 # Program to create IntendedFor array in phasediff JSON sidecar files in order
 # to trigger fMRIPrep to run SDC (Susceptibility Distortion Correction).
 #   Written by: Tom Hicks and Dianne Patterson. 4/21/21.
-#   Last Modified: Remove some redundant error msg prefixes.
+#   Last Modified: Stop between subjects, rather than exiting at once, on SIGTERM.
 #
 import argparse
+import functools
 import os
+import signal
 import sys
 import textwrap
+from contextlib import ExitStack
 
 import intend4.intend4 as in4
+from intend4.checkpoint import CHECKPOINT_INTERVAL, Checkpoint
+from intend4.fieldmap_rules import ALL_MODALITIES, load_rules
+from intend4.memory_report import MemoryTracker, format_report
+from intend4.throttle import IOThrottle, format_report as format_throttle_report
+from intend4.vcs import VCS_MODES
 from intend4 import ALLOWED_MODALITIES, BIDS_DIR
 from intend4.file_utils import good_dir_path
 
 
 BIDS_DIR_EXIT_CODE = 10
 SUBJ_NUMS_EXIT_CODE = 11
+LOCK_TIMEOUT_EXIT_CODE = 12
+CHECK_FAILED_EXIT_CODE = 13
+PERMISSIONS_EXIT_CODE = 14
+RETRY_FILE_EXIT_CODE = 15
+CHECKPOINT_EXIT_CODE = 16
+RULES_FILE_EXIT_CODE = 17
 
 PROG_NAME = 'intend4'                  # program name
+RETRY_FILE_NAME = 'intend4-retry.json'  # name of the default retry file, beside the checkpoint file
 
 
-def check_bids_dir (program_name, bids_dir):
+def check_bids_dir (program_name, bids_dir, writeable=True):
   """
-  Check that the BIDS data directory is a writeable directory.
-  If unable to find or write to the directory, then exit out.
+  Check that the BIDS data directory is a readable (and, optionally, writeable) directory.
+  If unable to find, read, or write to the directory, then exit out.
   """
-  if (not good_dir_path(bids_dir, writeable=True)):
-    helpMsg =  "A writeable BIDS data directory must be specified."
+  if (not good_dir_path(bids_dir, writeable=writeable)):
+    kind = 'writeable' if writeable else 'readable'
+    helpMsg =  f"A {kind} BIDS data directory must be specified."
     errMsg = "({}): ERROR: {} Exiting...".format(program_name, helpMsg)
     print(errMsg, file=sys.stderr)
     sys.exit(BIDS_DIR_EXIT_CODE)
@@ -43,6 +59,145 @@ def check_subj_nums (program_name, subj_nums):
     sys.exit(SUBJ_NUMS_EXIT_CODE)
 
 
+def load_retry_file (program_name, file_path, modality, args):
+  """
+  Read the given retry file and limit the run to the subjects (or subject/sessions) it holds.
+  If unable to read the file, or if it was written for another modality, then exit out.
+  """
+  try:
+    retry_modality, entries = in4.read_retry_file(file_path)
+    if ((retry_modality is not None) and (retry_modality != modality)):
+      raise ValueError(f"Retry file {file_path} was written for modality '{retry_modality}', not '{modality}'.")
+  except (OSError, ValueError) as ex:
+    errMsg = "({}): ERROR: {} Exiting...".format(program_name, ex)
+    print(errMsg, file=sys.stderr)
+    sys.exit(RETRY_FILE_EXIT_CODE)
+  args['retry_pairs'] = in4.retry_pairs(entries)
+  args['subj_ids'] = sorted(set(entry['subject'] for entry in entries))
+
+
+def load_rules_file (program_name, file_path, args):
+  """
+  Read the fieldmap rules table from the given rules file, to replace the default rules.
+  If unable to read the file, or if it does not hold a valid rules table, then exit out.
+  """
+  try:
+    args['fieldmap_rules'] = load_rules(file_path)
+  except (OSError, ValueError) as ex:
+    errMsg = "({}): ERROR: {} Exiting...".format(program_name, ex)
+    print(errMsg, file=sys.stderr)
+    sys.exit(RULES_FILE_EXIT_CODE)
+
+
+def lock_dataset (program_name, bids_dir, args, exit_stack):
+  """
+  Acquire an exclusive lock on the BIDS data directory, to be held until the given
+  exit stack is closed. If unable to acquire the lock within the optional timeout,
+  then exit out.
+  """
+  try:
+    exit_stack.enter_context(
+      in4.lock_for(bids_dir, args, timeout=args.get('lock_timeout')))
+  except TimeoutError as te:
+    errMsg = "({}): ERROR: {} Exiting...".format(program_name, te)
+    print(errMsg, file=sys.stderr)
+    sys.exit(LOCK_TIMEOUT_EXIT_CODE)
+
+
+def report_checks (program_name, checks):
+  """
+  Print one line for each of the given check results and a summary of the results.
+  Returns the number of checks which failed: i.e., found a stale or unreadable sidecar.
+  """
+  counts = dict.fromkeys(in4.CHECK_STATUSES, 0)
+  for check in checks:
+    status = check['status']
+    counts[status] += 1
+    sess = f" in session {check['session']}" if check['session'] else ''
+    sidecars = f": {', '.join(check['sidecars'])}" if check['sidecars'] else ''
+    print(f"{status}: subject {check['subject']}{sess}{sidecars}")
+  summary = ', '.join(f"{counts[status]} {status}" for status in in4.CHECK_STATUSES)
+  print(f"({program_name}): Checked {len(checks)} subjects/sessions: {summary}.")
+  return counts[in4.CHECK_STALE] + counts[in4.CHECK_UNREADABLE]
+
+
+def report_memory (program_name, args):
+  "Stop tracking memory usage and print the memory report, if one was requested."
+  tracker = args.get('memory_tracker')
+  if (tracker is not None):
+    tracker.stop()
+    print(f"({program_name}): Memory report:", file=sys.stderr)
+    print(format_report(tracker.report()), file=sys.stderr)
+
+
+def report_throttle (program_name, args):
+  "Print the number of throttled filesystem operations, and the time they waited, if throttling."
+  throttle = args.get('io_throttle')
+  if (throttle is not None):
+    print(f"({program_name}): Throttled I/O: {format_throttle_report(throttle.report())}.", file=sys.stderr)
+
+
+def request_stop (args, signum, frame):
+  """
+  Signal handler (given the run arguments, see functools.partial) which asks the run to stop
+  once the current subject (or subject/session) is done (see intend4.stop_if_requested),
+  so that the run saves its progress without leaving a sidecar partially rewritten.
+  """
+  args['stop_signal'] = signum
+
+
+def save_retry_file (program_name, modality, args):
+  """
+  Write the skipped or failed subjects (or subject/sessions) of the run to the retry file,
+  for use with --retry-from. A retry file is written when one is given. Without one, a
+  checkpointed run writes RETRY_FILE_NAME beside its checkpoint file when there were skips
+  (or when that file exists, so that it never lists subjects which have since succeeded).
+  Otherwise, nothing is written.
+  """
+  retry_file = args.get('retry_file')
+  entries = args.get('retry_entries', [])
+  if ((retry_file is None) and args.get('checkpoint_file')):
+    default_file = os.path.join(os.path.dirname(args.get('checkpoint_file')), RETRY_FILE_NAME)
+    if (entries or os.path.exists(default_file)):
+      retry_file = default_file
+  if (retry_file):
+    in4.write_retry_file(retry_file, modality, entries)
+    if (entries and args.get('verbose')):
+      print(f"({program_name}): Wrote {len(entries)} skipped subjects to retry file {retry_file}.",
+        file=sys.stderr)
+
+
+def start_checkpoint (program_name, modality, args):
+  """
+  Start checkpointing the progress of the run to the checkpoint file. When resuming, first
+  load the progress recorded by the stopped run, which must have had the same settings.
+  If unable to read the checkpoint file, then exit out.
+  """
+  settings = {
+    'modality': modality,
+    'rules': in4.get_rules(modality, args),
+    'remove': bool(args.get('remove')),
+    'bids_dir': os.path.realpath(args.get('bids_dir', BIDS_DIR))
+  }
+  checkpoint = Checkpoint(args.get('checkpoint_file'), settings=settings,
+                          interval=args.get('checkpoint_interval') or CHECKPOINT_INTERVAL)
+  if (args.get('resume')):
+    try:
+      resumed = checkpoint.load()
+    except (OSError, ValueError) as ex:
+      errMsg = "({}): ERROR: {} Exiting...".format(program_name, ex)
+      print(errMsg, file=sys.stderr)
+      sys.exit(CHECKPOINT_EXIT_CODE)
+    if (resumed and args.get('verbose')):
+      print(f"({program_name}): Resuming after {len(checkpoint.completed)} completed subjects/sessions.",
+        file=sys.stderr)
+  if (args.get('index_cache') is None):    # reuse the index cache of the stopped run
+    args['index_cache'] = checkpoint.index_cache
+  checkpoint.index_cache = args.get('index_cache')
+  args['retry_entries'] = checkpoint.retry_entries
+  args['checkpoint'] = checkpoint
+
+
 def main(argv=None):
   """
   --bids_dir directory
@@ -70,8 +225,10 @@ def main(argv=None):
 
   # set modality type
   parser.add_argument(
-    '-m', '--modality', dest='modality', choices=ALLOWED_MODALITIES, required=True,
-    help=f"Modality of the image files. Must be one of: {ALLOWED_MODALITIES}"
+    '-m', '--modality', dest='modality', required=True,
+    help=textwrap.dedent(f"""\
+      Modality of the image files. Must be one of: {ALLOWED_MODALITIES}, or a modality of the
+      rules file. The '{ALL_MODALITIES}' modality applies every fieldmap rule in one pass.""")
   )
 
   # add optional arguments
@@ -93,15 +250,200 @@ def main(argv=None):
     help='REMOVE IntendedFor entries for the selected modality [default: False].'
   )
 
+  parser.add_argument(
+    '--keep-order', '--keep_order', dest='keep_order', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Only change (or append) the IntendedFor entry, keeping the original key order and
+      formatting of each sidecar, and leave unchanged sidecars untouched [default: False].""")
+  )
+
+  parser.add_argument(
+    '--preflight', dest='preflight', choices=in4.PREFLIGHT_MODES,
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Before modifying any sidecar, check that all of them can be modified, reporting
+      every problem at once. Then either abort the run or skip the problem sidecars [default: None]""")
+  )
+
+  parser.add_argument(
+    '--vcs', dest='vcs', choices=VCS_MODES,
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Unlock all the sidecars to be modified before writing, in one batch, and save
+      them in a single commit afterwards, using the given version control system [default: None]""")
+  )
+
+  parser.add_argument(
+    '--vcs-message', '--vcs_message', dest='vcs_message',
+    default=argparse.SUPPRESS,
+    help=textwrap.dedent("(Optional) Commit message for the version control mode [default: a generated message]")
+  )
+
+  parser.add_argument(
+    '--check', dest='check', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Only CHECK the IntendedFor entries for the selected modality, without modifying any files.
+      Exits with a nonzero code if any entry is stale [default: False].""")
+  )
+
+  parser.add_argument(
+    '--rules', dest='rules_file',
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) JSON file of fieldmap rules, each mapping the images of a modality (selected by
+      suffix and other entities) to a fieldmap sidecar, to replace the default rules [default: None]""")
+  )
+
+  parser.add_argument(
+    '--pipeline', dest='pipeline', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Scan the subject directories directly (without BIDS validation) in a producer thread,
+      while modifying the sidecars of the subjects already scanned [default: False].""")
+  )
+
+  parser.add_argument(
+    '--queue-size', '--queue_size', dest='queue_size', type=int,
+    default=None,
+    help=textwrap.dedent(f"(Optional) Number of targets buffered by the pipelined mode [default: {in4.PIPELINE_QUEUE_SIZE}]")
+  )
+
+  parser.add_argument(
+    '--retry-file', '--retry_file', dest='retry_file',
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Write the subjects (or subject/sessions) which were skipped or failed, with their
+      reasons, to this JSON file, for use with --retry-from [default: None, except that a run
+      with --checkpoint writes intend4-retry.json beside its checkpoint file when subjects are skipped]""")
+  )
+
+  parser.add_argument(
+    '--retry-from', '--retry_from', dest='retry_from',
+    default=None,
+    help=textwrap.dedent("(Optional) Process exactly the subjects (or subject/sessions) in this retry file [default: None]")
+  )
+
+  parser.add_argument(
+    '--index-metadata', '--index_metadata', dest='index_metadata', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Parse the metadata of every JSON sidecar into the BIDS index, as older versions did. By default,
+      only the fieldmap sidecars being modified are read [default: False].""")
+  )
+
+  parser.add_argument(
+    '--checkpoint', dest='checkpoint_file',
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Periodically record the completed subjects (or subject/sessions) in this file, so
+      that a stopped run (e.g., by a batch system walltime limit) can be resumed. Give a path
+      within the mounted data directory (e.g., /data/intend4-checkpoint.json) [default: None]""")
+  )
+
+  parser.add_argument(
+    '--checkpoint-interval', '--checkpoint_interval', dest='checkpoint_interval', type=int,
+    default=None,
+    help=textwrap.dedent(f"(Optional) Number of completions between checkpoint saves [default: {CHECKPOINT_INTERVAL}]")
+  )
+
+  parser.add_argument(
+    '--resume', dest='resume', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Resume the run recorded in the checkpoint file, skipping the completed subjects (or
+      subject/sessions). Starts a new run if the checkpoint file does not exist [default: False].""")
+  )
+
+  parser.add_argument(
+    '--index-cache', '--index_cache', dest='index_cache',
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Directory in which to save the BIDS index, for reuse by later (or resumed) runs
+      until the dataset changes. Give a path within the mounted data directory
+      (e.g., /data/intend4-index) [default: None]""")
+  )
+
+  parser.add_argument(
+    '--max-workers', '--max_workers', dest='max_workers', type=int,
+    default=None,
+    help=textwrap.dedent("(Optional) Maximum number of concurrent worker threads [default: chosen by Python]")
+  )
+
+  parser.add_argument(
+    '--metadata-rate', '--metadata_rate', dest='metadata_rate', type=float,
+    default=None,
+    help=textwrap.dedent("""\
+      (Optional) Maximum filesystem metadata operations (stat, open, chmod) per second on the
+      sidecar files, to spare the metadata servers of a shared filesystem [default: unlimited]""")
+  )
+
+  parser.add_argument(
+    '--write-rate', '--write_rate', dest='write_rate', type=float,
+    default=None,
+    help=textwrap.dedent("(Optional) Maximum sidecar file writes per second [default: unlimited]")
+  )
+
+  parser.add_argument(
+    '--max-io', '--max_io', dest='max_io', type=int,
+    default=None,
+    help=textwrap.dedent("(Optional) Maximum number of sidecar file operations in progress at once [default: unlimited]")
+  )
+
+  parser.add_argument(
+    '--memory-report', '--memory_report', dest='memory_report', action='store_true',
+    default=False,
+    help=textwrap.dedent("""\
+      Trace memory allocations and report the peak and retained memory, and the top allocation
+      sites, for each phase of the run. Slows down the run [default: False].""")
+  )
+
+  parser.add_argument(
+    '--lock-dataset', '--lock_dataset', dest='lock_dataset', action='store_true',
+    default=False,
+    help='Hold an exclusive lock on the BIDS data directory for the whole run [default: False].'
+  )
+
+  parser.add_argument(
+    '--lock-timeout', '--lock_timeout', dest='lock_timeout', type=float,
+    default=None,
+    help=textwrap.dedent("(Optional) Seconds to wait for the dataset lock before exiting [default: wait forever]")
+  )
+
+  parser.add_argument(
+    '--lock-dir', '--lock_dir', dest='lock_dir',
+    default=argparse.SUPPRESS,
+    help=textwrap.dedent("(Optional) Directory to hold the lock files [default: intend4-locks in the git directory of a dataset repository, otherwise .intend4-locks in the BIDS data directory]")
+  )
+
   # actually parse the arguments now from the command line
   args = vars(parser.parse_args(argv))
+  if (args.get('pipeline') and (args.get('check') or args.get('preflight') or args.get('vcs'))):
+    parser.error('--pipeline cannot be combined with --check, --preflight, or --vcs')
+  if (args.get('retry_from') and (args.get('subj_ids') is not None)):
+    parser.error('--retry-from cannot be combined with --participant-label')
+  if (args.get('resume') and (not args.get('checkpoint_file'))):
+    parser.error('--resume requires --checkpoint')
+  if (args.get('checkpoint_file') and args.get('check')):
+    parser.error('--checkpoint cannot be combined with --check')
+  for rate_flag in ['metadata_rate', 'write_rate', 'max_io']:
+    if ((args.get(rate_flag) is not None) and (args.get(rate_flag) <= 0)):
+      parser.error(f"--{rate_flag.replace('_', '-')} must be greater than zero")
 
-  # check modality for validity: assumes arg parse provides valid value
-  modality = in4.validate_modality(args.get('modality'))
+  # when requested, replace the default fieldmap rules with those of the rules file
+  if (args.get('rules_file')):
+    load_rules_file(PROG_NAME, args.get('rules_file'), args)
 
-  # check that the given BIDS dir exists and is writeable
+  # check modality for validity against the fieldmap rules
+  try:
+    modality = in4.validate_modality(args.get('modality'), args.get('fieldmap_rules'))
+  except ValueError as ve:
+    parser.error(f"argument -m/--modality: invalid choice: '{args.get('modality')}'. {ve}")
+
+  # check that the given BIDS dir exists and is writeable (or just readable when checking)
   bids_dir = args.get('bids_dir', BIDS_DIR)
-  check_bids_dir(PROG_NAME, bids_dir)
+  check_bids_dir(PROG_NAME, bids_dir, writeable=(not args.get('check')))
 
   snums = args.get('subj_ids')
   check_subj_nums(PROG_NAME, snums)
@@ -115,19 +457,65 @@ def main(argv=None):
   # save the program name in args for use by called functions
   args['PROG_NAME'] = PROG_NAME
 
+  # when retrying, process only the subjects (or subject/sessions) in the retry file
+  if (args.get('retry_from')):
+    load_retry_file(PROG_NAME, args.get('retry_from'), modality, args)
+
+  # when requested, record the progress of the run, resuming from an earlier run
+  if (args.get('checkpoint_file')):
+    start_checkpoint(PROG_NAME, modality, args)
+
+  # when requested, throttle the filesystem operations on the sidecar files
+  if (any(args.get(limit) is not None for limit in ['metadata_rate', 'write_rate', 'max_io'])):
+    args['io_throttle'] = IOThrottle(metadata_rate=args.get('metadata_rate'),
+                                     write_rate=args.get('write_rate'),
+                                     max_concurrent=args.get('max_io'))
+
+  # when requested, track memory usage through the called functions
+  if (args.get('memory_report')):
+    args['memory_tracker'] = MemoryTracker()
+
+  # when only checking, report the current state of the sidecars and exit
+  if (args.get('check')):
+    checks = in4.check_subjects(modality, args)
+    report_throttle(PROG_NAME, args)
+    report_memory(PROG_NAME, args)
+    if (report_checks(PROG_NAME, checks) > 0):
+      sys.exit(CHECK_FAILED_EXIT_CODE)
+    return
+
   if (args.get('verbose')):
     action = 'Modifying' if (not args.get('remove')) else 'Removing'
     print(f"({PROG_NAME}): {action} IntendedFor field in sidecar files for modality '{modality}'.",
       file=sys.stderr)
 
-  # do the specified sidecar modifications
-  mod_count = in4.do_subjects(modality, args)
+  # do the specified sidecar modifications, holding the dataset lock if requested
+  with ExitStack() as locks:
+    if (args.get('lock_dataset')):
+      lock_dataset(PROG_NAME, bids_dir, args, locks)
+    if (args.get('checkpoint')):       # save the progress when stopped by the batch system
+      handler = functools.partial(request_stop, args)
+      locks.callback(signal.signal, signal.SIGTERM, signal.signal(signal.SIGTERM, handler))
+    try:
+      if (args.get('pipeline')):
+        mod_count = in4.do_subjects_pipelined(modality, args)
+      else:
+        mod_count = in4.do_subjects(modality, args)
+    except PermissionError as pe:
+      errMsg = "({}): ERROR: {} Exiting...".format(PROG_NAME, pe)
+      print(errMsg, file=sys.stderr)
+      sys.exit(PERMISSIONS_EXIT_CODE)
+
+  # record the skipped or failed subjects (or subject/sessions) for a later retry
+  save_retry_file(PROG_NAME, modality, args)
 
   if (args.get('verbose')):
     action = 'Modified' if (not args.get('remove')) else 'Removed'
-    fmap_type = in4.get_fieldmap_suffix(modality)
+    fmap_type = in4.get_fieldmap_suffix(modality, args)
     print(f"({PROG_NAME}): {action} IntendedFor fields in {mod_count} {fmap_type} sidecars.",
       file=sys.stderr)
+  report_throttle(PROG_NAME, args)
+  report_memory(PROG_NAME, args)
 
 
 
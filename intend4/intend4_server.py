@@ -0,0 +1,254 @@
+# Program to serve intend4 requests from a long-running process which keeps a warm index
+# of a BIDS dataset and refreshes only the subject directories which have changed.
+# Requests and responses are single lines of JSON exchanged over a Unix domain socket.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Describe the default lock directory of a dataset repository.
+#
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+import intend4.intend4 as in4
+from intend4 import BIDS_DIR
+from intend4.fieldmap_rules import load_rules
+from intend4.scan_layout import SESSION_DIR_PREFIX, SUBJ_DIR_PREFIX, ScanLayout
+
+
+ACTIONS = ['update', 'check', 'refresh', 'ping', 'shutdown']
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'intend4.sock')
+SOCKET_EXIT_CODE = 10
+
+PROG_NAME = 'intend4-server'           # program name
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  "Handle a connection by answering each line of JSON request with a line of JSON response."
+
+  def handle (self):
+    for line in self.rfile:
+      if (not line.strip()):
+        continue
+      try:
+        request = json.loads(line)
+      except ValueError as ve:
+        request = None
+        response = { 'ok': False, 'error': f"Invalid JSON request: {ve}" }
+      else:
+        if (not isinstance(request, dict)):
+          request = None
+          response = { 'ok': False, 'error': 'Invalid request: a request must be a JSON object.' }
+        else:
+          with self.server.lock:
+            response = handle_request(request, self.server.layout, self.server.args)
+      self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+      self.wfile.flush()
+      if ((request is not None) and (request.get('action') == 'shutdown')):
+        threading.Thread(target=self.server.shutdown).start()
+        return
+
+
+def handle_request (request, layout, args):
+  """
+  Perform the given request dictionary against the given (warm) layout and return a
+  response dictionary. A request holds an 'action' (one of ACTIONS), and optionally a
+  'modality', lists of 'subjects' and 'sessions' (default all), and a 'remove' flag.
+  The layout is refreshed, for the requested subjects only, before updating or checking.
+  A failure to update one sidecar does not fail the request: each result of an update
+  holds the status of its target and, if it failed, the reason (see intend4.update_and_report).
+  """
+  start = time.monotonic()
+  try:
+    action = request.get('action')
+    if (action not in ACTIONS):
+      raise ValueError(f"Action must be one of: {ACTIONS}")
+    response = { 'ok': True, 'action': action, 'results': [], 'refreshed': [] }
+    if (action in ['update', 'check', 'refresh']):
+      subj_ids = [ strip_prefix(subj, SUBJ_DIR_PREFIX) for subj in (request.get('subjects') or []) ]
+      response['refreshed'] = refresh_layout(layout, subj_ids, args)
+    if (action in ['update', 'check']):
+      modality = in4.validate_modality(request.get('modality'), args.get('fieldmap_rules'))
+      run_args = dict(args, remove=bool(request.get('remove')))
+      selected = subj_ids or layout.get_subjects()
+      sessions = [ strip_prefix(sess, SESSION_DIR_PREFIX) for sess in (request.get('sessions') or []) ]
+      if (action == 'check'):
+        results = in4.check_targets(modality, run_args, layout, selected)
+        results = [ check for check in results if ((not sessions) or (check['session'] in sessions)) ]
+      else:
+        targets = [ target for target in in4.gen_targets(modality, run_args, layout, selected)
+                    if ((not sessions) or (target['session'] in sessions)) ]
+        results = [ in4.update_and_report(target, modality, run_args) for target in targets ]
+      response['results'] = results
+  except Exception as ex:
+    response = { 'ok': False, 'error': str(ex) }
+  response['elapsed_ms'] = round((time.monotonic() - start) * 1000, 3)
+  return response
+
+
+def make_server (socket_path, layout, args):
+  """
+  Create and return a server which answers requests on the given Unix domain socket path,
+  using the given layout and base arguments. A stale socket file, which no server is
+  listening on, is replaced. Raises OSError if the path exists but is not a socket or
+  if another server is listening on it.
+  """
+  remove_stale_socket(socket_path)
+  server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+  server.daemon_threads = True
+  server.layout = layout
+  server.args = args
+  server.lock = threading.Lock()         # requests are performed one at a time
+  return server
+
+
+def refresh_layout (layout, subj_ids, args):
+  """
+  Refresh the given layout for the given subjects (or for all subjects if none are given),
+  rescanning only the subject directories which have changed. Returns a list of the IDs
+  of the rescanned subjects.
+  """
+  if (subj_ids):
+    return [ subj_id for subj_id in subj_ids if layout.refresh_subject(subj_id) ]
+  return layout.refresh(max_workers=args.get('max_workers'))
+
+
+def remove_stale_socket (socket_path):
+  """
+  Remove the given socket file if no server is listening on it. Raises OSError if the
+  path exists but is not a socket or if another server is listening on it.
+  """
+  try:
+    mode = os.lstat(socket_path).st_mode
+  except FileNotFoundError:
+    return
+  if (not stat.S_ISSOCK(mode)):
+    raise FileExistsError(f"Socket path {socket_path} exists and is not a socket.")
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    try:
+      sock.connect(socket_path)
+    except ConnectionRefusedError:       # stale: no server is listening
+      os.remove(socket_path)
+      return
+  raise FileExistsError(f"Another server is listening on socket {socket_path}.")
+
+
+def send_request (socket_path, request, timeout=None):
+  "Send the given request dictionary to the server on the given socket and return its response."
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.settimeout(timeout)
+    sock.connect(socket_path)
+    with sock.makefile('rwb') as stream:
+      stream.write((json.dumps(request) + '\n').encode('utf-8'))
+      stream.flush()
+      return json.loads(stream.readline())
+
+
+def strip_prefix (label, prefix):
+  "Return the given subject or session label without the given BIDS directory prefix."
+  return label[len(prefix):] if label.startswith(prefix) else label
+
+
+def main(argv=None):
+  """
+  --bids_dir directory
+  --socket path
+  --verbose
+  """
+
+  # the main method takes no arguments so it can be called by setuptools
+  if (argv is None):                   # if called by setuptools
+    argv = sys.argv[1:]                # then fetch the arguments from the system
+
+  # setup command line argument parsing
+  parser = argparse.ArgumentParser(
+    prog=PROG_NAME,
+    formatter_class=argparse.RawTextHelpFormatter,
+    description=textwrap.dedent(f"""\
+      {PROG_NAME}: Keeps a warm index of a BIDS data directory and serves intend4 requests
+      on a Unix domain socket. Each request is one line of JSON, for example:
+        {{"action": "update", "modality": "bold", "subjects": ["188"], "sessions": ["01"]}}
+        {{"action": "check", "modality": "dwi"}}
+      Each response is one line of JSON.""")
+  )
+
+  parser.add_argument(
+    '-v', '--verbose', dest='verbose', action='store_true',
+    default=False,
+    help='Print informational messages during processing [default: False (non-verbose mode)].'
+  )
+
+  parser.add_argument(
+    '--bids-dir', '--bids_dir', dest='bids_dir',
+    default=BIDS_DIR,
+    help=textwrap.dedent(f"(Optional) Path to BIDS data directory [default: {BIDS_DIR}]")
+  )
+
+  parser.add_argument(
+    '--socket', dest='socket_path',
+    default=DEFAULT_SOCKET,
+    help=textwrap.dedent(f"(Optional) Path of the Unix domain socket to listen on [default: {DEFAULT_SOCKET}]")
+  )
+
+  parser.add_argument(
+    '--rules', dest='rules_file',
+    default=None,
+    help=textwrap.dedent("(Optional) JSON file of fieldmap rules, to replace the default rules [default: None]")
+  )
+
+  parser.add_argument(
+    '--keep-order', '--keep_order', dest='keep_order', action='store_true',
+    default=False,
+    help='Only change (or append) the IntendedFor entry of each sidecar [default: False].'
+  )
+
+  parser.add_argument(
+    '--max-workers', '--max_workers', dest='max_workers', type=int,
+    default=None,
+    help=textwrap.dedent("(Optional) Maximum number of concurrent worker threads [default: chosen by Python]")
+  )
+
+  parser.add_argument(
+    '--lock-dir', '--lock_dir', dest='lock_dir',
+    default=argparse.SUPPRESS,
+    help=textwrap.dedent("(Optional) Directory to hold the lock files [default: intend4-locks in the git directory of a dataset repository, otherwise .intend4-locks in the BIDS data directory]")
+  )
+
+  # actually parse the arguments now from the command line
+  args = vars(parser.parse_args(argv))
+  args['PROG_NAME'] = PROG_NAME
+  socket_path = args.pop('socket_path')
+  rules_file = args.pop('rules_file')
+  if (rules_file):
+    try:
+      args['fieldmap_rules'] = load_rules(rules_file)
+    except (OSError, ValueError) as ex:
+      parser.error(str(ex))
+
+  layout = ScanLayout(args.get('bids_dir'), max_workers=args.get('max_workers'))
+  try:
+    server = make_server(socket_path, layout, args)
+  except OSError as ose:
+    errMsg = "({}): ERROR: {} Exiting...".format(PROG_NAME, ose)
+    print(errMsg, file=sys.stderr)
+    sys.exit(SOCKET_EXIT_CODE)
+  if (args.get('verbose')):
+    print(f"({PROG_NAME}): Indexed {len(layout.get_subjects())} subjects. Listening on {socket_path}",
+      file=sys.stderr)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    if (os.path.exists(socket_path)):
+      os.remove(socket_path)
+
+
+
+if __name__ == "__main__":
+  main()
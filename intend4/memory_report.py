@@ -0,0 +1,116 @@
+#
+# Module to measure the memory used by each phase of a run: the peak and retained
+# traced memory, the top allocation sites, and the peak resident set size.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import resource
+import sys
+import tracemalloc
+from contextlib import contextmanager
+
+
+MEBIBYTE = 1024 * 1024
+TOP_ALLOCATIONS = 10                   # number of top allocation sites reported per phase
+
+
+class MemoryTracker(object):
+  """
+  Record the memory used by each named phase of a run, using tracemalloc snapshots
+  taken at the start and end of the phase. Tracing starts with the first phase and
+  slows the program down, so a tracker should only be created when requested.
+  """
+
+  def __init__ (self, top_count=TOP_ALLOCATIONS):
+    self.top_count = top_count
+    self.phases = []
+    self.started_tracing = False
+
+
+  @contextmanager
+  def phase (self, name):
+    """
+    Context manager which records the peak and retained memory of the enclosed code,
+    along with the source lines which allocated the most retained memory.
+    """
+    if (not tracemalloc.is_tracing()):
+      tracemalloc.start()
+      self.started_tracing = True
+    tracemalloc.reset_peak()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    start_snapshot = tracemalloc.take_snapshot()
+    try:
+      yield
+    finally:
+      end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+      end_snapshot = tracemalloc.take_snapshot()
+      stats = end_snapshot.compare_to(start_snapshot, 'lineno')[:self.top_count]
+      self.phases.append({
+        'phase': name,
+        'peak_bytes': peak_bytes - start_bytes,
+        'retained_bytes': end_bytes - start_bytes,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'top_allocations': [
+          { 'site': str(stat.traceback[0]), 'size_diff_bytes': stat.size_diff, 'count_diff': stat.count_diff }
+          for stat in stats
+        ]
+      })
+
+
+  def report (self):
+    "Return a dictionary reporting the memory used by each phase and the overall peak RSS."
+    return { 'phases': list(self.phases), 'peak_rss_bytes': peak_rss_bytes() }
+
+
+  def stop (self):
+    "Stop tracing memory allocations, if this tracker started the tracing."
+    if (self.started_tracing):
+      tracemalloc.stop()
+      self.started_tracing = False
+
+
+def budget_violations (report, budgets):
+  """
+  Compare the given memory report against the given budgets: a dictionary mapping
+  phase names to dictionaries of limits (in bytes) for any of the phase metrics
+  (e.g., { 'index': { 'peak_bytes': 100 * MEBIBYTE } }). The special phase name
+  'run' limits the overall 'peak_rss_bytes'. Returns a (possibly empty) list of
+  messages describing the exceeded limits, so that budgets can be asserted.
+  """
+  violations = []
+  phases = { phase['phase']: phase for phase in report['phases'] }
+  phases['run'] = report
+  for phase_name, limits in budgets.items():
+    phase = phases.get(phase_name)
+    if (phase is None):
+      violations.append(f"No memory was recorded for phase '{phase_name}'.")
+      continue
+    for metric, limit in limits.items():
+      if (phase.get(metric, 0) > limit):
+        violations.append(
+          f"Phase '{phase_name}' {metric} of {phase[metric]} exceeds the budget of {limit}.")
+  return violations
+
+
+def format_report (report):
+  "Return a multi-line, human readable string describing the given memory report."
+  lines = []
+  for phase in report['phases']:
+    lines.append(f"Phase '{phase['phase']}': peak {to_mib(phase['peak_bytes'])} MiB, "
+                 f"retained {to_mib(phase['retained_bytes'])} MiB, "
+                 f"process peak RSS {to_mib(phase['peak_rss_bytes'])} MiB")
+    for alloc in phase['top_allocations']:
+      lines.append(f"    {to_mib(alloc['size_diff_bytes'])} MiB in {alloc['count_diff']} blocks: {alloc['site']}")
+  lines.append(f"Process peak RSS: {to_mib(report['peak_rss_bytes'])} MiB")
+  return '\n'.join(lines)
+
+
+def peak_rss_bytes ():
+  "Return the peak resident set size of this process, in bytes."
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss if (sys.platform == 'darwin') else max_rss * 1024   # Linux reports kilobytes
+
+
+def to_mib (num_bytes):
+  "Return the given number of bytes as a string of mebibytes, rounded to 1 decimal place."
+  return f"{num_bytes / MEBIBYTE:.1f}"
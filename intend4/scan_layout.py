@@ -0,0 +1,379 @@
+#
+# Module to provide a lightweight layout of the subject directories of a BIDS dataset,
+# built by scanning the directories directly, which can be refreshed incrementally.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Compact, interned file records and an index by subject, session, and suffix.
+#
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from intend4.file_utils import full_path
+
+
+DATASET_DESCRIPTION = 'dataset_description.json'
+SESSION_DIR_PREFIX = 'ses-'
+SUBJ_DIR_PREFIX = 'sub-'
+
+# full names of the BIDS filename entity keys, as used by pybids
+ENTITY_NAMES = {
+  'sub': 'subject', 'ses': 'session', 'task': 'task', 'acq': 'acquisition', 'ce': 'ceagent',
+  'rec': 'reconstruction', 'dir': 'direction', 'run': 'run', 'mod': 'modality', 'echo': 'echo',
+  'flip': 'flip', 'inv': 'inv', 'mt': 'mt', 'part': 'part', 'recording': 'recording',
+  'space': 'space', 'chunk': 'chunk'
+}
+
+
+class ScanFile(object):
+  """
+  Compact record of a single file found by scanning a subject directory. To keep the index
+  of a very large study small, a record holds only references to shared values: the subject ID,
+  the directory of the file relative to the subject directory, and interned tuples of the keys
+  and values of the filename entities (with the subject value left out, so that the tuples are
+  shared across subjects). The paths and the entity dictionary are rebuilt on demand.
+  """
+  __slots__ = ('root', 'subject', 'subjdir', 'keys', 'values')
+
+  def __init__ (self, root, subject, subjdir, keys, values):
+    self.root = root                   # BIDS data directory
+    self.subject = subject             # subject ID
+    self.subjdir = subjdir             # directory of the file, relative to the subject directory
+    self.keys = keys                   # filename entity keys, in filename order
+    self.values = values               # entity values (None for the subject), suffix, and extension
+
+  def __repr__ (self):
+    return f"<ScanFile filename='{self.path}'>"
+
+
+  @property
+  def entities (self):
+    "Return a dictionary of the full names and values of the entities of this file."
+    entities = { ENTITY_NAMES.get(key, key): value for key, value in zip(self.keys, self.values) }
+    entities['subject'] = self.subject
+    entities['extension'] = self.values[-1]
+    if (self.values[-2] is not None):
+      entities['suffix'] = self.values[-2]
+    datatype = datatype_for(self.subjdir)
+    if (datatype is not None):
+      entities['datatype'] = datatype
+    return entities
+
+
+  @property
+  def filename (self):
+    "Return the name of this file, rebuilt from its entities."
+    parts = [ f"{key}-{self.subject if (value is None) else value}"
+              for key, value in zip(self.keys, self.values) ]
+    if (self.values[-2] is not None):
+      parts.append(self.values[-2])
+    return f"{'_'.join(parts)}.{self.values[-1]}"
+
+
+  def get (self, name, default=None):
+    "Return the value of the named entity of this file, or the default if it has no such entity."
+    if (name == 'subject'):
+      return self.subject
+    if (name == 'extension'):
+      return self.values[-1]
+    if (name == 'suffix'):
+      return default if (self.values[-2] is None) else self.values[-2]
+    if (name == 'datatype'):
+      datatype = datatype_for(self.subjdir)
+      return default if (datatype is None) else datatype
+    for ndx in range(len(self.keys) - 1, -1, -1):   # the last value of a repeated key wins
+      if (ENTITY_NAMES.get(self.keys[ndx], self.keys[ndx]) == name):
+        return self.values[ndx]
+    return default
+
+
+  @property
+  def path (self):
+    "Return the absolute path of this file."
+    return os.path.join(self.root, self.relpath)
+
+
+  @property
+  def relpath (self):
+    "Return the path of this file relative to the BIDS data directory."
+    return os.path.join(f"{SUBJ_DIR_PREFIX}{self.subject}", self.subjpath)
+
+
+  @property
+  def subjpath (self):
+    "Return the path of this file relative to its subject directory, as returned by subjrelpath."
+    return os.path.join(self.subjdir, self.filename)
+
+
+class ScanLayout(object):
+  """
+  Layout of the subject directories of a BIDS dataset, built by scanning the directories
+  directly, without validation or metadata indexing. It supports the subset of the pybids
+  BIDSLayout interface used by intend4, so it can be passed wherever a layout is expected.
+  The scan records the modification time of every directory, so that a refresh only
+  rescans the subjects whose directories have gained, lost, or renamed entries.
+  The files are held in compact records (see ScanFile), which are also indexed by subject,
+  session, and suffix, so that the lookups made by intend4 do not search all the files.
+  """
+
+  def __init__ (self, root, max_workers=None, scan=True):
+    self.root = full_path(root)
+    if (not os.path.isfile(os.path.join(self.root, DATASET_DESCRIPTION))):
+      raise RuntimeError(f"BIDS data directory {self.root} has no {DATASET_DESCRIPTION} file.")
+    self.subjects = dict()             # subject ID => list of ScanFiles
+    self.dir_mtimes = dict()           # subject ID => dictionary of directory path => mtime
+    self.index = dict()                # subject ID => dictionary of (session, suffix) => list of ScanFiles
+    self.shared = dict()               # tuple => the same tuple, shared by all the ScanFiles
+    if (scan):
+      self.refresh(max_workers=max_workers)
+
+
+  def add_subject (self, subj_id, files, dir_mtimes):
+    "Add (or replace) the given files and directory modification times of the identified subject."
+    index = dict()
+    for scan_file in files:
+      index.setdefault((scan_file.get('session'), scan_file.get('suffix')), []).append(scan_file)
+    self.subjects[subj_id] = files
+    self.dir_mtimes[subj_id] = dir_mtimes
+    self.index[subj_id] = index
+
+
+  def files_for (self, subject=None):
+    "Return a list of all the files of the given subject (or list of subjects), or of all subjects."
+    if (isinstance(subject, str)):
+      return self.subjects.get(subject, [])
+    subj_ids = subject if (subject is not None) else self.subjects.keys()
+    return [ scan_file for subj_id in subj_ids for scan_file in self.subjects.get(subj_id, []) ]
+
+
+  def forget_subject (self, subj_id):
+    "Remove the identified subject from the layout."
+    self.subjects.pop(subj_id, None)
+    self.dir_mtimes.pop(subj_id, None)
+    self.index.pop(subj_id, None)
+
+
+  def get (self, return_type='object', target=None, extension=None, **filters):
+    """
+    Return a list of the files matching the given entity filters or, if the return type is
+    'id', a sorted list of the unique values of the target entity for those files. A filter
+    value may be a string, a list of strings, or None (to select files without that entity).
+    Filtering by a single subject, session (or None), and suffix is answered from the index.
+    """
+    if (extension is not None):
+      filters['extension'] = normalize_extension(extension)
+    results = [ scan_file for scan_file in self.indexed_files(filters)
+                if matches_filters(scan_file, filters) ]
+    if (return_type == 'id'):
+      return sorted(set(scan_file.get(target) for scan_file in results
+                        if (scan_file.get(target) is not None)))
+    return results
+
+
+  def get_sessions (self):
+    "Return a sorted list of all the session IDs in the dataset."
+    return self.get(return_type='id', target='session')
+
+
+  def get_subjects (self):
+    "Return a sorted list of all the subject IDs in the dataset."
+    return sorted(self.subjects.keys())
+
+
+  def indexed_files (self, filters):
+    """
+    Return a list of the files which could match the given entity filters: those under a single
+    key of the index when the filters select a single subject, session (or None), and suffix;
+    otherwise all the files of the selected subjects.
+    """
+    subject = filters.get('subject')
+    suffix = filters.get('suffix')
+    session = filters.get('session')
+    if (isinstance(subject, str) and isinstance(suffix, str) and
+        ('session' in filters) and ((session is None) or isinstance(session, str))):
+      return self.index.get(subject, {}).get((session, suffix), [])
+    return self.files_for(subject)
+
+
+  def make_file (self, subj_id, subjdir, filename):
+    """
+    Return a compact record of the named file, in the given directory of the identified subject,
+    or None if the filename does not follow the BIDS pattern or names a different subject.
+    """
+    parts = split_filename(filename)
+    if (parts is None):
+      return None
+    keys, values, suffix, extension = parts
+    subjects = [ value for key, value in zip(keys, values) if (ENTITY_NAMES.get(key, key) == 'subject') ]
+    if ((not subjects) or (subjects[-1] != subj_id)):
+      return None
+    values = [ (None if ((key == 'sub') and (value == subj_id)) else sys.intern(value))
+               for key, value in zip(keys, values) ]
+    values.append(None if (suffix is None) else sys.intern(suffix))
+    values.append(sys.intern(extension))
+    return ScanFile(self.root, subj_id, subjdir, self.share(tuple(sys.intern(key) for key in keys)),
+                    self.share(tuple(values)))
+
+
+  def refresh (self, max_workers=None):
+    """
+    Rescan the subject directories which are new or have changed since the last scan
+    (using up to max_workers threads) and forget the subjects which have disappeared.
+    Returns a sorted list of the IDs of the rescanned subjects.
+    """
+    subj_ids = list_subjects(self.root)
+    for subj_id in set(self.subjects) - set(subj_ids):
+      self.forget_subject(subj_id)
+    changed = sorted(subj_id for subj_id in subj_ids if self.subject_changed(subj_id))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      scans = list(executor.map(self.scan_subject, changed))
+    for subj_id, (files, dir_mtimes) in zip(changed, scans):
+      self.add_subject(subj_id, files, dir_mtimes)
+    return changed
+
+
+  def refresh_subject (self, subj_id):
+    """
+    Rescan the directory of the identified subject, if it has changed since the last scan,
+    or forget the subject if its directory has disappeared. Returns True if rescanned.
+    """
+    if (not os.path.isdir(os.path.join(self.root, f"{SUBJ_DIR_PREFIX}{subj_id}"))):
+      self.forget_subject(subj_id)
+      return False
+    if (not self.subject_changed(subj_id)):
+      return False
+    self.add_subject(subj_id, *self.scan_subject(subj_id))
+    return True
+
+
+  def scan_subject (self, subj_id):
+    """
+    Scan the directory of the identified subject, its session directories, and their data type
+    directories. Returns a tuple of the list of the files found and a dictionary of the
+    modification times of the scanned directories.
+    """
+    subj_path = os.path.join(self.root, f"{SUBJ_DIR_PREFIX}{subj_id}")
+    files = []
+    dir_mtimes = dict()
+    pending = [ ('', 0) ]              # directories relative to the subject directory, with depths
+    while (pending):
+      subjdir, depth = pending.pop()
+      dir_path = os.path.join(subj_path, subjdir) if subjdir else subj_path
+      dir_mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+      subjdir = sys.intern(subjdir)     # shared by all the files in the directory
+      with os.scandir(dir_path) as entries:
+        for entry in entries:
+          if (entry.name.startswith('.')):
+            continue
+          if (entry.is_dir()):
+            reldir = os.path.join(subjdir, entry.name)
+            if ((depth == 0) and entry.name.startswith(SESSION_DIR_PREFIX)):
+              pending.append((reldir, depth + 1))
+            elif (depth < 2):
+              pending.append((reldir, 2))   # data type directory: not descended further
+          else:
+            scan_file = self.make_file(subj_id, subjdir, entry.name)
+            if (scan_file is not None):
+              files.append(scan_file)
+    files.sort(key=lambda scan_file: scan_file.subjpath)
+    return (files, dir_mtimes)
+
+
+  def share (self, value):
+    "Return the shared copy of the given (hashable) value, so that equal values are stored once."
+    return self.shared.setdefault(value, value)
+
+
+  def subject_changed (self, subj_id):
+    "Tell whether any directory of the identified subject has changed since it was last scanned."
+    dir_mtimes = self.dir_mtimes.get(subj_id)
+    if (dir_mtimes is None):
+      return True
+    try:
+      return any((os.stat(dir_path).st_mtime_ns != mtime) for dir_path, mtime in dir_mtimes.items())
+    except FileNotFoundError:
+      return True
+
+
+def datatype_for (subjdir):
+  """
+  Return the data type of the files in the given directory, relative to a subject directory:
+  the name of the data type directory, or None for the subject and session directories.
+  """
+  if (not subjdir):
+    return None
+  parts = subjdir.split(os.sep)
+  if ((len(parts) == 1) and parts[0].startswith(SESSION_DIR_PREFIX)):
+    return None
+  return parts[-1]
+
+
+def list_subjects (root):
+  "Return a sorted list of the IDs of the subjects which have directories in the given BIDS directory."
+  with os.scandir(root) as entries:
+    return sorted(entry.name[len(SUBJ_DIR_PREFIX):] for entry in entries
+                  if (entry.name.startswith(SUBJ_DIR_PREFIX) and entry.is_dir()))
+
+
+def matches_filters (entities, filters):
+  "Tell whether the given file entities (a dictionary or ScanFile) satisfy all of the given entity filters."
+  for name, value in filters.items():
+    entity = entities.get(name)
+    if (value is None):
+      if (entity is not None):
+        return False
+    elif (isinstance(value, (list, tuple, set))):
+      if (entity not in value):
+        return False
+    elif (entity != value):
+      return False
+  return True
+
+
+def normalize_extension (extension):
+  "Return the given file extension (or list of extensions) without any leading dots."
+  if (isinstance(extension, (list, tuple, set))):
+    return [ ext.lstrip('.') for ext in extension ]
+  return extension.lstrip('.')
+
+
+def parse_filename (filename):
+  """
+  Parse the given BIDS filename into a dictionary of its entities, suffix, and extension
+  (without a leading dot). Returns None if the filename does not follow the BIDS
+  'key-value_key-value_suffix.extension' pattern.
+  """
+  parts = split_filename(filename)
+  if (parts is None):
+    return None
+  keys, values, suffix, extension = parts
+  entities = { 'extension': extension }
+  if (suffix is not None):
+    entities['suffix'] = suffix
+  for key, value in zip(keys, values):
+    entities[ENTITY_NAMES.get(key, key)] = value
+  return entities
+
+
+def split_filename (filename):
+  """
+  Split the given BIDS filename into a tuple of the list of its entity keys (as abbreviated
+  in the filename), the list of its entity values, its suffix (or None), and its extension
+  (without a leading dot). Returns None if the filename does not follow the BIDS
+  'key-value_key-value_suffix.extension' pattern.
+  """
+  stem, dot, extension = filename.partition('.')
+  if (not dot):
+    return None
+  parts = stem.split('_')
+  suffix = None
+  if ('-' not in parts[-1]):           # the last part is the suffix, if it is not an entity
+    suffix = parts.pop()
+  keys = []
+  values = []
+  for part in parts:
+    key, dash, value = part.partition('-')
+    if ((not dash) or (not key) or (not value)):
+      return None
+    keys.append(key)
+    values.append(value)
+  return (keys, values, suffix, extension)
@@ -0,0 +1,98 @@
+#
+# Module to throttle filesystem operations, limiting the rate of metadata operations
+# (e.g., stat, open, chmod) and of writes, and the number of operations in progress,
+# so that a run does not overload the metadata servers of a shared parallel filesystem.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+METADATA_OP = 'metadata'               # kind of operation: stat, open, chmod, etc.
+WRITE_OP = 'write'                     # kind of operation: writing file contents
+IO_OPS = [METADATA_OP, WRITE_OP]
+
+
+class IOThrottle(object):
+  """
+  Throttle for filesystem operations: each operation takes a token from the rate limiter
+  for its kind (if that kind is limited) and a slot from the concurrency budget (if there is
+  one). The time spent waiting is recorded, per kind, for reporting. Thread-safe.
+  """
+
+  def __init__ (self, metadata_rate=None, write_rate=None, max_concurrent=None):
+    self.buckets = {
+      METADATA_OP: TokenBucket(metadata_rate) if metadata_rate else None,
+      WRITE_OP: TokenBucket(write_rate) if write_rate else None
+    }
+    self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+    self.lock = threading.Lock()
+    self.counts = dict.fromkeys(IO_OPS, 0)
+    self.waits = dict.fromkeys(IO_OPS, 0.0)
+
+
+  @contextmanager
+  def operation (self, kind):
+    "Context manager which waits until an operation of the given kind may proceed."
+    start = time.monotonic()
+    if (self.slots is not None):
+      self.slots.acquire()
+    try:
+      bucket = self.buckets[kind]
+      if (bucket is not None):
+        bucket.acquire()
+      waited = time.monotonic() - start
+      with self.lock:
+        self.counts[kind] += 1
+        self.waits[kind] += waited
+      yield
+    finally:
+      if (self.slots is not None):
+        self.slots.release()
+
+
+  def report (self):
+    "Return a dictionary reporting the number of operations, and the seconds spent waiting, per kind."
+    with self.lock:
+      return { kind: { 'count': self.counts[kind], 'wait_seconds': self.waits[kind] } for kind in IO_OPS }
+
+
+class TokenBucket(object):
+  """
+  Rate limiter which allows the given number of operations per second, on average, with
+  bursts of up to one second's worth of operations. Thread-safe: concurrent callers reserve
+  successive tokens, then sleep (outside the lock) until their tokens are due.
+  """
+
+  def __init__ (self, rate):
+    self.rate = float(rate)
+    self.capacity = max(1.0, self.rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+
+  def acquire (self):
+    "Take one token, waiting until it is available. Returns the number of seconds waited."
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + ((now - self.updated) * self.rate))
+      self.updated = now
+      self.tokens -= 1
+      delay = (-self.tokens / self.rate) if (self.tokens < 0) else 0.0
+    if (delay > 0):
+      time.sleep(delay)
+    return delay
+
+
+def format_report (report):
+  "Return a one line, human readable string describing the given throttle report."
+  return ', '.join(f"{report[kind]['count']} {kind} operations waited {report[kind]['wait_seconds']:.2f}s"
+                   for kind in IO_OPS)
+
+
+def throttled (throttle, kind):
+  "Return a context manager which applies the given (possibly absent) throttle to an operation of the given kind."
+  return nullcontext() if (throttle is None) else throttle.operation(kind)
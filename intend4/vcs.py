@@ -0,0 +1,71 @@
+#
+# Module to integrate sidecar modifications with git or DataLad version control:
+# all the sidecars of a run are unlocked in one batch and saved in a single commit.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import os
+import subprocess
+
+
+MAX_PATHS_PER_CALL = 1000              # keep command lines well under the system limits
+VCS_MODES = ['git', 'datalad']         # the supported version control modes
+
+
+def commit_files (repo_dir, paths, message, vcs):
+  """
+  Record the current contents of the given files, in the repository containing the
+  given directory, in a single commit with the given message. Does nothing if none
+  of the files have changed. Raises RuntimeError if the version control command fails.
+  """
+  relpaths = repo_relpaths(repo_dir, paths)
+  if (not relpaths):
+    return
+  if (vcs == 'datalad'):
+    run_vcs(repo_dir, ['datalad', 'save', '-m', message, '--'] + relpaths)
+  else:
+    pathspec = '\0'.join(relpaths)
+    run_vcs(repo_dir, ['git', 'add', '--pathspec-from-file=-', '--pathspec-file-nul'], pathspec)
+    staged = run_vcs(repo_dir, ['git', 'diff', '--cached', '--name-only', '--relative', '-z'])
+    if (set(staged.stdout.split('\0')).intersection(relpaths)):
+      run_vcs(repo_dir,
+        ['git', 'commit', '-m', message, '--pathspec-from-file=-', '--pathspec-file-nul'], pathspec)
+
+
+def repo_relpaths (repo_dir, paths):
+  "Return the given file paths relative to the given repository directory."
+  return [os.path.relpath(path, repo_dir) for path in paths]
+
+
+def run_vcs (repo_dir, command, stdin_text=None, check=True):
+  """
+  Run the given version control command in the given directory, feeding it the optional
+  standard input text. Raises RuntimeError if the command cannot be run or, when checking,
+  if it fails. Returns the completed process.
+  """
+  try:
+    result = subprocess.run(command, cwd=repo_dir, input=stdin_text,
+                            capture_output=True, text=True)
+  except OSError as ose:
+    raise RuntimeError(f"Unable to run version control command '{command[0]}': {ose}")
+  if (check and (result.returncode != 0)):
+    raise RuntimeError(
+      f"Version control command '{' '.join(command[:2])}' failed: {result.stderr.strip()}")
+  return result
+
+
+def unlock_files (repo_dir, paths, vcs):
+  """
+  Unlock the given files, in the repository containing the given directory, so that they
+  can be modified. DataLad unlocks all of the files, while plain git only needs to unlock
+  the locked (symbolically linked) git-annex files. The files are unlocked in as few
+  batched calls as possible. Raises RuntimeError if the version control command fails.
+  """
+  if (vcs == 'datalad'):
+    relpaths = repo_relpaths(repo_dir, paths)
+    command = ['datalad', 'unlock', '--']
+  else:
+    relpaths = repo_relpaths(repo_dir, [path for path in paths if os.path.islink(path)])
+    command = ['git', 'annex', 'unlock', '--']
+  for start in range(0, len(relpaths), MAX_PATHS_PER_CALL):
+    run_vcs(repo_dir, command + relpaths[start:start+MAX_PATHS_PER_CALL])
@@ -10,18 +10,30 @@ PROG=$(basename $0)
 IMG=hickst/intend4
 
 help () {
-  echo "Usage: $PROG [-h] {bold,dwi} [--participant-label [SUBJ_IDS ...]] [--remove]"
+  echo "Usage: $PROG [-h] {bold,dwi,all} [--participant-label [SUBJ_IDS ...]] [--remove] [--rules RULES_FILE]"
+  echo "       [--checkpoint CHECKPOINT_FILE [--resume]] [--index-cache INDEX_CACHE]"
   echo ''
   echo 'intend4: Adds or removes "IntendedFor" info to the JSON sidecars, for one or more subjects.'
   echo ''
   echo 'required argument:'
-  echo '  {bold,dwi}        Modality of the image files. Must be one of: ["bold", "dwi"]'
+  echo '  {bold,dwi,all}    Modality of the image files. Must be one of: ["bold", "dwi", "all"],'
+  echo '                    or a modality of the rules file. "all" applies every rule in one pass.'
   echo ''
   echo 'optional arguments:'
   echo '  -h, --help        Show this help message and exit'
   echo '  --participant-label [SUBJ_IDS ...], --participant_label [SUBJ_IDS ...]'
   echo '                    (Optional) Space-separated subject number(s) to process'
   echo '  --remove          REMOVE IntendedFor entries for the selected modality [default: False].'
+  echo '  --rules RULES_FILE'
+  echo '                    (Optional) JSON file of fieldmap rules, to replace the default rules.'
+  echo '                    Give its path within the data directory, which is mounted at /data.'
+  echo '  --checkpoint CHECKPOINT_FILE'
+  echo '                    (Optional) File recording the completed subjects, so that a stopped run can be resumed.'
+  echo '                    Give its path within the data directory, which is mounted at /data.'
+  echo '  --resume          Skip the subjects recorded as completed in the checkpoint file [default: False].'
+  echo '  --index-cache INDEX_CACHE'
+  echo '                    (Optional) Directory in which to save the BIDS index, for reuse by later runs.'
+  echo '                    Give its path within the data directory, which is mounted at /data.'
   echo ''
   echo ''
   echo 'Examples:'
@@ -36,6 +48,15 @@ help () {
   echo ''
   echo '  Modify the phasediff fieldmap JSON files for just subjects 078 and 215:'
   echo "    > $PROG bold --participant-label 078 215"
+  echo ''
+  echo '  Apply every rule of a fieldmap rules file (in the data directory) in one pass:'
+  echo "    > $PROG all --rules /data/intend4-rules.json"
+  echo ''
+  echo '  Checkpoint a long run, so that a job stopped at its walltime limit can be resumed by the next job:'
+  echo "    > $PROG bold --checkpoint /data/intend4-checkpoint.json --index-cache /data/intend4-index --resume"
+  echo ''
+  echo '  Limit the load on the shared filesystem metadata servers (operations per second, operations at once):'
+  echo "    > $PROG bold --metadata-rate 200 --write-rate 50 --max-io 8"
 }
 
 if [ $# -lt 1  -o "$1" = "-h" -o "$1" = "--help" ]
@@ -48,8 +69,8 @@ fi
 
 MODALITY=$1
 shift
-if [ "$MODALITY" != 'bold' -a "$MODALITY" != 'dwi' ]; then
-  echo "$PROG: ERROR: First argument must be a valid modality: one of 'bold' or 'dwi'."
+if [ -z "$MODALITY" -o "${MODALITY#-}" != "$MODALITY" ]; then
+  echo "$PROG: ERROR: First argument must be a modality: 'bold', 'dwi', 'all', or a modality of the rules file."
   echo ""
   help
   exit 2
@@ -7,6 +7,7 @@ setup(
     entry_points={
         'console_scripts': [
             'intend4 = intend4.intend4_cli:main',
+            'intend4-server = intend4.intend4_server:main',
         ]
     },
 )
@@ -0,0 +1,83 @@
+# Tests for the checkpoint module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Test that the files written by intend4 do not change the index stamp.
+#
+import json
+import os
+import pytest
+import tempfile
+
+import intend4.checkpoint as cp
+from intend4.file_utils import copy_tree
+from tests import TEST_RESOURCES_DIR
+
+
+class TestCheckpoint(object):
+
+  bids_test_dir = f"{TEST_RESOURCES_DIR}/data"
+  settings = { 'modality': 'bold', 'remove': False }
+
+  def test_save_load(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      checkpoint_file = os.path.join(tmpdir, 'checkpoint.json')
+      checkpoint = cp.Checkpoint(checkpoint_file, settings=self.settings, interval=2)
+      checkpoint.index_cache = os.path.join(tmpdir, 'index')
+      checkpoint.mark_done('188')
+      assert not os.path.exists(checkpoint_file)
+      checkpoint.mark_done('219', 'ctbs')                  # the interval triggers a save
+      checkpoint.retry_entries.append({ 'subject': '078', 'session': None, 'status': 'missing' })
+      checkpoint.mark_done('078')
+      with open(checkpoint_file) as infile:
+        assert json.load(infile)['completed'] == [ ['188', None], ['219', 'ctbs'] ]
+      checkpoint.save()
+      assert not os.path.exists(f"{checkpoint_file}.tmp")
+
+      resumed = cp.Checkpoint(checkpoint_file, settings=self.settings)
+      assert resumed.load() is True
+      assert resumed.completed == { ('188', None), ('219', 'ctbs'), ('078', None) }
+      assert resumed.is_done('219', 'ctbs') and not resumed.is_done('219', 'itbs')
+      assert resumed.index_cache == checkpoint.index_cache
+      assert resumed.retry_entries == checkpoint.retry_entries
+
+
+  def test_load_bad(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      checkpoint_file = os.path.join(tmpdir, 'checkpoint.json')
+      assert cp.Checkpoint(checkpoint_file).load() is False
+      cp.Checkpoint(checkpoint_file, settings=self.settings).save()
+      with pytest.raises(ValueError, match='different settings'):
+        cp.Checkpoint(checkpoint_file, settings=dict(self.settings, remove=True)).load()
+      with open(checkpoint_file, 'w') as outfile:
+        json.dump([], outfile)
+      with pytest.raises(ValueError, match='is not an intend4 checkpoint file'):
+        cp.Checkpoint(checkpoint_file).load()
+
+
+  def test_index_stamp(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      stamp = cp.index_stamp(bids_dir)
+      assert stamp != cp.index_stamp(bids_dir, index_metadata=True)
+      assert not cp.index_cache_is_current(tmpdir, stamp)
+      cp.write_index_stamp(tmpdir, stamp)
+      assert cp.index_cache_is_current(tmpdir, stamp)
+
+      # modifying a sidecar changes only the stamp of an index with metadata
+      metadata_stamp = cp.index_stamp(bids_dir, index_metadata=True)
+      sidecar = os.path.join(bids_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      with open(sidecar, 'a') as outfile:
+        outfile.write('\n')
+      assert cp.index_stamp(bids_dir) == stamp
+      assert cp.index_stamp(bids_dir, index_metadata=True) != metadata_stamp
+
+
+      # the files written by intend4 itself do not change the stamp
+      for name in ['intend4-retry.json', 'run.ckpt', 'run.ckpt.tmp']:
+        open(os.path.join(bids_dir, name), 'w').close()
+      own_files = [os.path.join(bids_dir, 'run.ckpt')]
+      assert cp.index_stamp(bids_dir, own_files=own_files) == stamp
+      assert cp.index_stamp(bids_dir) != stamp
@@ -0,0 +1,63 @@
+# Tests for the fieldmap rules module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import json
+import os
+import pytest
+import tempfile
+
+import intend4.fieldmap_rules as fr
+
+
+class TestFieldmapRules(object):
+
+  rules = [
+    { 'modality': 'sbref', 'target': { 'suffix': 'sbref', 'datatype': 'func' },
+      'fieldmap': { 'suffix': 'epi', 'direction': 'PA' } },
+    { 'modality': 'asl', 'target': { 'suffix': ['asl', 'm0scan'], 'datatype': 'perf' },
+      'fieldmap': { 'suffix': 'epi', 'acquisition': 'asl' } },
+    { 'modality': 'asl', 'target': { 'suffix': 'asl' }, 'fieldmap': { 'suffix': 'm0scan' } }
+  ]
+
+  def test_load_rules(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      rules_file = os.path.join(tmpdir, 'rules.json')
+      with open(rules_file, 'w') as outfile:
+        json.dump({ 'rules': self.rules }, outfile)
+      assert fr.load_rules(rules_file) == self.rules
+      with open(rules_file, 'w') as outfile:
+        json.dump(self.rules, outfile)
+      assert fr.load_rules(rules_file) == self.rules
+      with open(rules_file, 'w') as outfile:
+        json.dump({ 'modality': 'bold' }, outfile)
+      with pytest.raises(ValueError, match='does not hold a list of fieldmap rules'):
+        fr.load_rules(rules_file)
+
+
+  def test_rule_modalities(self):
+    assert fr.rule_modalities(fr.DEFAULT_RULES) == ['bold', 'dwi']
+    assert fr.rule_modalities(self.rules) == ['sbref', 'asl']
+
+
+  def test_select_rules(self):
+    assert fr.select_rules('asl', self.rules) == self.rules[1:]
+    assert fr.select_rules(fr.ALL_MODALITIES, self.rules) == self.rules
+    assert fr.select_rules('bold', self.rules) == []
+
+
+  def test_validate_rules(self):
+    assert fr.validate_rules(fr.DEFAULT_RULES) == fr.DEFAULT_RULES
+    with pytest.raises(ValueError, match='does not hold a list'):
+      fr.validate_rules([])
+    with pytest.raises(ValueError, match='without a valid modality name'):
+      fr.validate_rules([ { 'modality': 'all', 'target': { 'suffix': 'bold' }, 'fieldmap': { 'suffix': 'epi' } } ])
+    with pytest.raises(ValueError, match="the target of rule 'bold' must be an object with a 'suffix'"):
+      fr.validate_rules([ { 'modality': 'bold', 'target': { 'datatype': 'func' }, 'fieldmap': { 'suffix': 'epi' } } ])
+    with pytest.raises(ValueError, match="may not filter on 'session'"):
+      fr.validate_rules([ { 'modality': 'bold', 'target': { 'suffix': 'bold' },
+                            'fieldmap': { 'suffix': 'epi', 'session': '01' } } ])
+    with pytest.raises(ValueError, match="filter 'run' must be a string or a list of strings"):
+      fr.validate_rules([ { 'modality': 'bold', 'target': { 'suffix': 'bold', 'run': 1 },
+                            'fieldmap': { 'suffix': 'epi' } } ])
@@ -0,0 +1,134 @@
+# Tests for the advisory file locking module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Test the throttling of the lock operations.
+#
+import os
+import pytest
+import tempfile
+import threading
+
+import intend4.file_lock as fl
+from intend4.throttle import IOThrottle, METADATA_OP
+
+
+class TestFileLock(object):
+
+  def test_default_lock_dir(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      os.makedirs(bids_dir)
+      lock_dir = fl.default_lock_dir(bids_dir)
+      assert lock_dir == os.path.join(bids_dir, fl.LOCK_DIR_NAME)
+      assert os.path.basename(lock_dir).startswith('.')   # hidden, so ignored by BIDS
+
+      # in a repository, the locks are kept in the git directory, out of the worktree
+      git_dir = os.path.join(os.path.realpath(tmpdir), '.git')
+      os.makedirs(git_dir)
+      assert fl.default_lock_dir(bids_dir) == os.path.join(git_dir, fl.GIT_LOCK_DIR_NAME)
+
+
+  def test_find_git_dir(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      worktree = os.path.join(os.path.realpath(tmpdir), 'worktree')
+      os.makedirs(os.path.join(worktree, 'sub-188'))
+      assert fl.find_git_dir(worktree) is None
+      with open(os.path.join(worktree, '.git'), 'w') as git_file:
+        git_file.write('gitdir: ../repo.git/worktrees/worktree\n')
+      git_dir = os.path.join(os.path.realpath(tmpdir), 'repo.git', 'worktrees', 'worktree')
+      assert fl.find_git_dir(os.path.join(worktree, 'sub-188')) == git_dir
+
+
+  def test_file_lock(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      lock_dir = os.path.join(tmpdir, 'locks')
+      target = os.path.join(tmpdir, 'target.json')
+      with fl.file_lock(target, lock_dir=lock_dir) as lock_path:
+        assert os.path.isfile(lock_path)
+        assert os.path.dirname(lock_path) == lock_dir
+      assert not os.path.exists(target)   # the guarded file is never created
+      assert os.listdir(lock_dir) == []   # the released lock file is removed
+
+
+  def test_file_lock_shared(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      lock_dir = fl.default_lock_dir(tmpdir)
+      target = os.path.join(tmpdir, 'target.json')
+      with fl.file_lock(target, lock_dir, shared=True) as lock_path:
+        assert (os.stat(lock_dir).st_mode & 0o1777) == 0o1777
+        assert (os.stat(lock_path).st_mode & 0o0666) == 0o0666
+
+
+  def test_file_lock_throttle(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      throttle = IOThrottle(max_concurrent=1)
+      lock_dir = os.path.join(tmpdir, 'locks')
+      target = os.path.join(tmpdir, 'target.json')
+      with fl.file_lock(target, lock_dir, throttle=throttle):
+        assert os.path.isdir(lock_dir)     # created on demand
+      # finding, opening, locking, checking, and releasing the lock file
+      assert throttle.report()[METADATA_OP]['count'] == 5
+
+
+  def test_file_lock_timeout(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      target = os.path.join(tmpdir, 'target.json')
+      with fl.file_lock(target, lock_dir=tmpdir):
+        with pytest.raises(TimeoutError, match='Unable to lock'):
+          with fl.file_lock(target, lock_dir=tmpdir, timeout=0.2):
+            pass
+      # once released, the lock can be acquired again
+      with fl.file_lock(target, lock_dir=tmpdir, timeout=0.2):
+        pass
+
+
+  def test_file_lock_waiter(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      target = os.path.join(tmpdir, 'target.json')
+      holders = []
+      def hold_lock ():
+        with fl.file_lock(target, tmpdir, timeout=5) as lock_path:
+          holders.append(os.path.isfile(lock_path))
+      with fl.file_lock(target, tmpdir):
+        waiter = threading.Thread(target=hold_lock)
+        waiter.start()
+        waiter.join(0.3)
+        assert waiter.is_alive()           # waiting for the lock
+      waiter.join(5)
+      # the waiter dropped the removed lock file and locked a new one
+      assert holders == [True]
+      assert os.listdir(tmpdir) == []
+
+
+  def test_lock_path_for(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      target = os.path.join(tmpdir, 'target.json')
+      link = os.path.join(tmpdir, 'link.json')
+      open(target, 'a').close()
+      os.symlink(target, link)
+      assert fl.lock_path_for(target, tmpdir) == fl.lock_path_for(link, tmpdir)
+      assert fl.lock_path_for(target, tmpdir) != fl.lock_path_for(tmpdir, tmpdir)
+      assert fl.lock_path_for(target, tmpdir).endswith(fl.LOCK_FILE_EXT)
+
+
+  def test_make_lock_dir(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      lock_dir = os.path.join(tmpdir, 'locks')
+      fl.make_lock_dir(lock_dir)
+      assert os.path.isdir(lock_dir)
+      assert (os.stat(lock_dir).st_mode & 0o1002) == 0   # a user's directory is not shared
+      fl.make_lock_dir(lock_dir)          # existing directory is fine
+
+
+  def test_make_lock_dir_shared(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      lock_dir = os.path.join(tmpdir, 'locks')
+      fl.make_lock_dir(lock_dir, shared=True)
+      assert os.path.isdir(lock_dir)
+      assert (os.stat(lock_dir).st_mode & 0o1777) == 0o1777
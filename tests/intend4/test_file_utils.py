@@ -1,12 +1,14 @@
 # Tests for the file utilities module.
 #   Written by: Tom Hicks. 5/22/2020.
-#   Last Modified: Fix magic number assumption in test_get_permissions.
+#   Last Modified: Test checking the modifiability of files with the stat cache.
 #
 import os
+import pytest
 import tempfile
 from pathlib import Path
 
 import intend4.file_utils as utils
+from intend4.throttle import IOThrottle
 from tests import TEST_DATA_DIR, TEST_RESOURCES_DIR
 
 
@@ -35,6 +37,44 @@ class TestFileUtils(object):
       assert len(tmp_files) == len(tr_files)
 
 
+  def test_copy_tree_snapshot(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      utils.copy_tree(TEST_DATA_DIR, tmpdir, snapshot=True)
+      src_paths = sorted(os.path.relpath(p, TEST_DATA_DIR) for p in utils.gen_file_paths(TEST_DATA_DIR))
+      tmp_paths = sorted(os.path.relpath(p, tmpdir) for p in utils.gen_file_paths(tmpdir))
+      assert tmp_paths == src_paths
+
+      same_device = (os.stat(TEST_DATA_DIR).st_dev == os.stat(tmpdir).st_dev)
+      for relpath in src_paths:
+        src_stat = os.stat(os.path.join(TEST_DATA_DIR, relpath))
+        tmp_stat = os.stat(os.path.join(tmpdir, relpath))
+        assert tmp_stat.st_size == src_stat.st_size
+        if (relpath.endswith('.json')):   # sidecars are always real copies
+          assert tmp_stat.st_ino != src_stat.st_ino
+        elif (same_device):               # everything else is hard linked
+          assert tmp_stat.st_ino == src_stat.st_ino
+
+      # snapshotting again over an existing snapshot is harmless
+      utils.copy_tree(TEST_DATA_DIR, tmpdir, snapshot=True)
+
+
+  def test_snapshot_file(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      src = os.path.join(tmpdir, 'image.nii.gz')
+      with open(src, 'w') as outfile:
+        outfile.write('not really an image')
+      dst = os.path.join(tmpdir, 'copy.nii.gz')
+      assert utils.snapshot_file(src, dst) == dst
+      assert os.path.samefile(src, dst)
+      assert utils.snapshot_file(src, dst) == dst
+
+      dst_json = os.path.join(tmpdir, 'copy.json')
+      utils.snapshot_file(src, dst_json, copy_extents=['.json', '.gz'])
+      assert not os.path.samefile(src, dst_json)
+
+
   def test_filename_core(self):
     assert utils.filename_core(None) == ''
     assert utils.filename_core('') == ''
@@ -43,6 +83,58 @@ class TestFileUtils(object):
     assert utils.filename_core('/tmp/somefile.py') == 'somefile'
 
 
+  def test_fingerprint_tree(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      utils.copy_tree(TEST_DATA_DIR, tmpdir)
+      digest, subj_digests = utils.fingerprint_tree(tmpdir)
+      print(f"DIGEST={digest}, SUBJ_DIGESTS={subj_digests}")
+      assert digest is not None
+      assert list(subj_digests.keys()) == ['sub-078', 'sub-188', 'sub-219']
+      assert len(set(subj_digests.values())) == 3
+
+      # serial and parallel scans must agree
+      assert utils.fingerprint_tree(tmpdir, max_workers=1) == (digest, subj_digests)
+
+      # touching a file changes only the digests which cover it
+      sidecar = os.path.join(tmpdir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      stats = os.stat(sidecar)
+      os.utime(sidecar, ns=(stats.st_atime_ns, stats.st_mtime_ns + 1000))
+      new_digest, new_subj_digests = utils.fingerprint_tree(tmpdir)
+      assert new_digest != digest
+      assert new_subj_digests['sub-188'] != subj_digests['sub-188']
+      assert new_subj_digests['sub-078'] == subj_digests['sub-078']
+      assert new_subj_digests['sub-219'] == subj_digests['sub-219']
+
+
+  def test_fingerprint_tree_names_only(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      utils.copy_tree(TEST_DATA_DIR, tmpdir)
+      digest, _ = utils.fingerprint_tree(tmpdir, names_only=True)
+      sidecar = os.path.join(tmpdir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      with open(sidecar, 'a') as outfile:
+        outfile.write('\n')
+      assert utils.fingerprint_tree(tmpdir, names_only=True)[0] == digest
+      os.rename(sidecar, f"{sidecar}.bak")
+      assert utils.fingerprint_tree(tmpdir, names_only=True)[0] != digest
+
+
+  def test_fingerprint_tree_ignore(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      utils.copy_tree(TEST_DATA_DIR, tmpdir)
+      digest, _ = utils.fingerprint_tree(tmpdir, ignore=['*.tmp'])
+      open(os.path.join(tmpdir, 'checkpoint.json.tmp'), 'w').close()
+      assert utils.fingerprint_tree(tmpdir, ignore=['*.tmp'])[0] == digest
+      assert utils.fingerprint_tree(tmpdir)[0] != digest
+
+
+  def test_fingerprint_tree_nodir(self):
+    with pytest.raises(FileNotFoundError):
+      utils.fingerprint_tree(self.fylPath)
+
+
   def test_full_path(self):
     home = str(Path.home())
     assert utils.full_path('~') == home
@@ -200,6 +292,88 @@ class TestFileUtils(object):
     assert utils.is_acceptable_filename('BAD.ONE.gz', FILE_EXTS) is False
 
 
+  def test_modification_problem(self):
+    assert utils.modification_problem(self.fylPath).startswith('cannot be accessed')
+    assert utils.modification_problem(self.tmpPath) == 'is not a regular file'
+    with tempfile.TemporaryDirectory() as tmpdir:
+      testfile = os.path.join(tmpdir, 'sidecar.json')
+      Path(testfile).touch(mode=0o444)
+      assert utils.modification_problem(testfile) is None   # owned, so chmod is possible
+
+
+  def test_modification_problem_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfiles = [ os.path.join(tmpdir, name) for name in ['one.json', 'two.json'] ]
+      for testfile in testfiles:
+        Path(testfile).touch(mode=0o444)
+      throttle = IOThrottle()
+      cache = utils.StatCache()
+      cache.stat_many(testfiles, throttle=throttle)
+      assert throttle.report()['metadata']['count'] == 2
+      for testfile in testfiles:
+        assert utils.modification_problem(testfile, throttle=throttle, cache=cache) is None
+        assert cache.is_read_only(testfile, throttle=throttle) is False
+      # the statuses are cached, and the filesystem of both files is checked only once
+      assert throttle.report()['metadata']['count'] == 3
+      assert len(cache.read_only_devices) == 1
+
+
+  def test_read_rewrite_text(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'sidecar.json')
+      Path(testfile).write_text('{}\n')
+      os.chmod(testfile, 0o444)
+      throttle = IOThrottle(metadata_rate=1000, write_rate=1000, max_concurrent=2)
+      utils.rewrite_text(testfile, '{ "IntendedFor": [] }\n', throttle=throttle)
+      assert utils.read_text(testfile, throttle=throttle) == '{ "IntendedFor": [] }\n'
+      assert utils.get_permissions(testfile) & 0o777 == 0o444      # permissions restored
+      report = throttle.report()
+      assert report['metadata']['count'] == 4
+      assert report['write']['count'] == 1
+
+
+  def test_stat_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'sidecar.json')
+      cache = utils.StatCache()
+      assert utils.good_file_path(testfile, cache=cache) is False
+      Path(testfile).touch(mode=0o644)
+      assert utils.good_file_path(testfile, cache=cache) is False      # cached as missing
+      cache.invalidate(testfile)
+      assert utils.good_file_path(testfile, True, cache=cache) is True
+      assert utils.good_dir_path(tmpdir, True, cache=cache) is True
+      assert utils.is_readable(testfile, cache=cache) is True
+      os.chmod(testfile, 0o400)
+      assert utils.get_permissions(testfile, cache=cache) & 0o777 == 0o644
+      cache.invalidate()
+      assert utils.get_permissions(testfile, cache=cache) & 0o777 == 0o400
+      with pytest.raises(FileNotFoundError):
+        utils.get_permissions(self.fylPath, cache=cache)
+
+
+  def test_access_uses_os_access(self, monkeypatch):
+    "Access is decided by os.access (so ACLs and read-only mounts count), with or without a cache."
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'sidecar.json')
+      Path(testfile).touch(mode=0o644)
+      access = os.access
+      monkeypatch.setattr(os, 'access', lambda apath, mode: (mode != os.W_OK) and access(apath, mode))
+      cache = utils.StatCache()
+      for kwargs in [ {}, { 'cache': cache } ]:
+        assert utils.is_readable(testfile, **kwargs)
+        assert not utils.is_writable(testfile, **kwargs)
+        assert utils.good_file_path(testfile, **kwargs)
+        assert not utils.good_file_path(testfile, True, **kwargs)
+        assert not utils.good_dir_path(tmpdir, True, **kwargs)
+      monkeypatch.setattr(os, 'access', access)
+      assert not utils.is_writable(testfile, cache=cache)           # cached result
+      assert utils.is_writable(testfile)
+
+
   def test_path_has_dots(self):
     assert utils.path_has_dots('.') is True
     assert utils.path_has_dots('..') is True
@@ -256,3 +430,43 @@ class TestFileUtils(object):
     assert self.bold_test_fyl in pathlst
     assert '/images/JADES/NONE.fits' not in pathlst
     assert self.empty_test_fyl not in pathlst
+
+
+  def test_walk_files(self):
+    expected = sorted(os.path.join(root, fyl) for root, dirs, files in os.walk(TEST_DATA_DIR) for fyl in files)
+    for max_workers in [ 1, 4 ]:
+      paths = sorted(entry.path for entry in utils.walk_files(TEST_DATA_DIR, max_workers=max_workers))
+      assert paths == expected
+
+
+  def test_walk_files_cycle(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      os.makedirs(os.path.join(tmpdir, 'a', 'b'))
+      Path(os.path.join(tmpdir, 'a', 'b', 'data.txt')).touch()
+      os.symlink(tmpdir, os.path.join(tmpdir, 'a', 'b', 'up'))     # cycle back to the root
+      os.symlink(os.path.join(tmpdir, 'a'), os.path.join(tmpdir, 'alias'))
+      for max_workers in [ 1, None ]:
+        paths = [ os.path.relpath(path, tmpdir)
+                  for path in utils.gen_file_paths(tmpdir, max_workers=max_workers) ]
+        assert paths == [ os.path.join('a', 'b', 'data.txt') ] or paths == [ os.path.join('alias', 'b', 'data.txt') ]
+
+
+  def test_walk_files_prune(self):
+    errors = []
+    entries = list(utils.walk_files(TEST_DATA_DIR, prune=lambda entry: entry.name.startswith('sub-')))
+    assert [ entry.name for entry in entries ] == [ 'dataset_description.json' ]
+    assert list(utils.walk_files(self.fylPath, onerror=errors.append)) == []
+    assert len(errors) == 1
+
+
+  def test_validate_path_strings_bulk(self):
+    FILE_EXTENTS = ['.tsv', '.TSV']
+    testpaths = [ '.', '/NoSuch', self.tmpPath, self.empty_test_fyl, self.bold_test_fyl, '', None ]
+    cache = utils.StatCache()
+    pathlst = utils.validate_path_strings_bulk(testpaths, FILE_EXTENTS, cache=cache, max_workers=4)
+    print("PATHLIST={}".format(pathlst))
+    assert pathlst == utils.validate_path_strings(testpaths, FILE_EXTENTS)
+    assert pathlst == [ '.', self.tmpPath, self.bold_test_fyl ]
+    assert '/NoSuch' in cache.entries and cache.stat('/NoSuch') is None
+
@@ -1,14 +1,21 @@
 # Tests of the IntendedFor module.
 #   Written by: Tom Hicks and Dianne Patterson. 10/19/2021.
-#   Last Modified: Add tests for do_single_subject, some other uncovered lines.
+#   Last Modified: Test rejecting sidecar text with duplicate IntendedFor keys.
 #
+import json
 import os
 import pytest
+import shutil
+import subprocess
 import tempfile
 
 from bids import BIDSLayout
 from sqlalchemy import except_all
 import intend4.intend4 as in4
+from intend4.checkpoint import INDEX_STAMP_FILE, Checkpoint
+from intend4.file_utils import copy_tree
+from intend4.memory_report import MEBIBYTE, MemoryTracker, budget_violations
+from intend4.throttle import IOThrottle, METADATA_OP
 
 from unittest.mock import MagicMock
 from tests import TEST_RESOURCES_DIR
@@ -26,8 +33,75 @@ class TestIntend4(object):
   bads_test_dir = f"{TEST_RESOURCES_DIR}/baddata"
 
   contents = { "contents": "fake JSON contents" }
+  rules = [
+    { 'modality': 'bold', 'target': { 'suffix': 'bold' }, 'fieldmap': { 'suffix': 'epi', 'direction': 'PA' } },
+    { 'modality': 'dwi', 'target': { 'suffix': 'dwi', 'datatype': 'dwi' }, 'fieldmap': { 'suffix': 'epi' } },
+    { 'modality': 'T1w', 'target': { 'suffix': 'T1w' }, 'fieldmap': { 'suffix': 'fieldmap' } }
+  ]
   # dsdescr_fyl = f"{TEST_DATA_DIR}/dataset_description.json"
 
+  def test_check_sidecar(self):
+    sidecar = os.path.join(self.bids_test_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+    check = in4.check_sidecar({ 'sidecars': [], 'expected': [] })
+    assert check['status'] == in4.CHECK_MISSING
+    check = in4.check_sidecar({ 'sidecars': [sidecar, sidecar], 'expected': [] })
+    assert check['status'] == in4.CHECK_AMBIGUOUS
+    check = in4.check_sidecar({ 'sidecars': [sidecar], 'expected': [] })
+    assert check['status'] == in4.CHECK_STALE   # no IntendedFor key at all
+    check = in4.check_sidecar({ 'sidecars': ['/tmp/NoSuch.json'], 'expected': [] })
+    assert check['status'] == in4.CHECK_UNREADABLE
+    assert 'error' in check
+
+
+  def test_check_sidecar_bad_types(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      sidecar = os.path.join(tmpdir, 'sidecar.json')
+      expected = ['func/some_bold.nii.gz']
+      in4.output_JSON([1], file_path=sidecar)
+      check = in4.check_sidecar({ 'sidecars': [sidecar], 'expected': expected })
+      assert check['status'] == in4.CHECK_UNREADABLE
+      assert 'does not hold a JSON object' in check['error']
+      for value in [5, {'a': 1}, [1, 'func/some_bold.nii.gz']]:
+        in4.output_JSON({ 'IntendedFor': value }, file_path=sidecar)
+        check = in4.check_sidecar({ 'sidecars': [sidecar], 'expected': expected })
+        assert check['status'] == in4.CHECK_STALE
+      in4.output_JSON({ 'IntendedFor': 'func/some_bold.nii.gz' }, file_path=sidecar)
+      check = in4.check_sidecar({ 'sidecars': [sidecar], 'expected': expected })
+      assert check['status'] == in4.CHECK_CORRECT
+
+
+  def test_check_subjects(self, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      args = { 'bids_dir': bids_dir }
+      checks = in4.check_subjects('bold', args)
+      assert len(checks) == 4            # 2 subjects plus 1 subject with 2 sessions
+      assert all(check['status'] == in4.CHECK_STALE for check in checks)
+
+      in4.do_subjects('bold', args)
+      checks = in4.check_subjects('bold', args)
+      assert all(check['status'] == in4.CHECK_CORRECT for check in checks)
+      sessions = [check['session'] for check in checks if check['subject'] == '219']
+      assert sorted(sessions) == ['ctbs', 'itbs']
+
+      # the remove flag expects empty IntendedFor values
+      args['remove'] = True
+      checks = in4.check_subjects('bold', args)
+      assert all(check['status'] == in4.CHECK_STALE for check in checks)
+
+
+  def test_check_subjects_ambiguous(self):
+    args = { 'bids_dir': self.bads_test_dir, 'max_workers': 1 }
+    checks = in4.check_subjects('bold', args)
+    assert len(checks) == 1
+    assert checks[0]['status'] == in4.CHECK_AMBIGUOUS
+    assert len(checks[0]['sidecars']) > 1
+
+
   def test_do_subjects_badbids(self, popdir):
     with tempfile.TemporaryDirectory() as tmpdir:
       print(f"tmpdir={tmpdir}")
@@ -37,6 +111,54 @@ class TestIntend4(object):
       assert 'BIDS validator got an error while processing the BIDS Data directory' in str(rte)
 
 
+  def test_load_layout_metadata(self):
+    image = f"{self.bids_test_dir}/sub-188/fmap/sub-188_phasediff.nii.gz"
+    layout = in4.load_layout({ 'bids_dir': self.bids_test_dir })
+    assert layout.get_metadata(image) == {}               # sidecars are not parsed by default
+    layout = in4.load_layout({ 'bids_dir': self.bids_test_dir, 'index_metadata': True })
+    assert layout.get_metadata(image).get('EchoTime1') == 0.00492
+
+
+  def test_load_layout_index_cache(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      index_cache = os.path.join(tmpdir, 'index')
+      args = { 'bids_dir': bids_dir, 'index_cache': index_cache }
+      layout = in4.load_layout(args)
+      assert os.path.isfile(os.path.join(index_cache, INDEX_STAMP_FILE))
+      assert len(layout.get_subjects()) == 3
+
+      # the cached index is reused while the dataset file names are unchanged
+      stamps = []
+      monkeypatch.setattr(in4, 'write_index_stamp', lambda cache_dir, stamp: stamps.append(stamp))
+      in4.do_subjects('bold', args)
+      assert in4.load_layout(args).get_subjects() == ['078', '188', '219']
+      assert stamps == []
+
+      shutil.rmtree(os.path.join(bids_dir, 'sub-078'))
+      assert in4.load_layout(args).get_subjects() == ['188', '219']
+      assert len(stamps) == 1
+
+
+  def test_do_subjects_checkpoint(self, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      checkpoint = Checkpoint(os.path.join(tmpdir, 'checkpoint.json'))
+      checkpoint.completed = { ('219', 'ctbs'), ('188', None) }
+      args = { 'bids_dir': bids_dir, 'checkpoint': checkpoint }
+      assert in4.do_subjects('dwi', args) == 2           # 078 and 219 itbs
+      assert checkpoint.completed == { ('078', None), ('188', None), ('219', 'ctbs'), ('219', 'itbs') }
+      with open(checkpoint.file_path) as infile:
+        assert len(json.load(infile)['completed']) == 4
+      checks = in4.check_subjects('dwi', { 'bids_dir': bids_dir })
+      assert [ check['status'] for check in checks ] == [ 'correct', 'stale', 'stale', 'correct' ]
+
+
   def test_do_subjects_count(self):
     do_ss = in4.do_single_subject
     mm = MagicMock()
@@ -51,10 +173,216 @@ class TestIntend4(object):
     assert mm.call_count == 3
 
 
+  @pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+  def test_do_subjects_vcs(self, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(bids_dir)
+      for command in [ 'init -q', 'config user.name Test', 'config user.email test@example.com',
+                       'add .', 'commit -q -m Initial' ]:
+        subprocess.run(['git'] + command.split(), check=True)
+
+      args = { 'bids_dir': bids_dir, 'vcs': 'git', 'vcs_message': 'Set IntendedFor' }
+      in4.do_subjects('dwi', args)
+      log = subprocess.run(['git', 'log', '--format=%s'], capture_output=True, text=True).stdout
+      assert log.splitlines() == ['Set IntendedFor', 'Initial']
+      changed = subprocess.run(['git', 'show', '--name-only', '--format=', 'HEAD'],
+                               capture_output=True, text=True).stdout.split()
+      assert len(changed) == 4
+      assert all(path.endswith('_epi.json') for path in changed)
+      status = subprocess.run(['git', 'status', '--porcelain', '--ignored'],
+                              capture_output=True, text=True).stdout
+      assert status == ''                # the lock files are kept out of the worktree
+      assert os.path.isdir(os.path.join(bids_dir, '.git', 'intend4-locks'))
+
+
+  def test_do_subjects_preflight_abort(self, capsys, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      monkeypatch.setattr(in4, 'modification_problem',
+        lambda path, throttle=None, cache=None: 'is not writable' if ('sub-219' in path) else None)
+      args = { 'bids_dir': bids_dir, 'preflight': in4.PREFLIGHT_ABORT }
+      with pytest.raises(PermissionError, match='found 2 sidecar files which cannot be modified'):
+        in4.do_subjects('bold', args)
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert syserr.count('is not writable') == 2
+      checks = in4.check_subjects('bold', { 'bids_dir': bids_dir })
+      assert all(check['status'] == in4.CHECK_STALE for check in checks)   # nothing written
+
+
+  def test_do_subjects_preflight_skip(self, capsys, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      monkeypatch.setattr(in4, 'modification_problem',
+        lambda path, throttle=None, cache=None: 'is not writable' if ('sub-219' in path) else None)
+      in4.do_subjects('bold', { 'bids_dir': bids_dir, 'preflight': in4.PREFLIGHT_SKIP })
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert syserr.count('failed the preflight check for subject 219') == 2
+      checks = in4.check_subjects('bold', { 'bids_dir': bids_dir })
+      statuses = { check['subject']: check['status'] for check in checks }
+      assert statuses == { '078': in4.CHECK_CORRECT, '188': in4.CHECK_CORRECT, '219': in4.CHECK_STALE }
+
+
+  def test_do_subjects_pipelined(self, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      args = { 'bids_dir': bids_dir, 'queue_size': 1, 'max_workers': 2 }
+      assert in4.do_subjects_pipelined('dwi', args) == 4
+      checks = in4.check_subjects('dwi', { 'bids_dir': bids_dir })
+      assert all(check['status'] == in4.CHECK_CORRECT for check in checks)
+
+
+  def test_do_subjects_pipelined_stop(self, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      # a stop requested during the first subject/session takes effect before the next one
+      update_and_report = in4.update_and_report
+      def stopping_update (target, modality, args):
+        args['stop_signal'] = 15
+        return update_and_report(target, modality, args)
+      monkeypatch.setattr(in4, 'update_and_report', stopping_update)
+      args = { 'bids_dir': bids_dir, 'queue_size': 1 }
+      with pytest.raises(SystemExit) as se:
+        in4.do_subjects_pipelined('dwi', args)
+      assert se.value.code == 143
+      checks = in4.check_subjects('dwi', { 'bids_dir': bids_dir })
+      assert [ check['status'] for check in checks ].count(in4.CHECK_CORRECT) == 1
+
+
+  def test_do_subjects_pipelined_missing(self, capsys, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      for sidecar in in4.planned_sidecars('bold', { 'subj_ids': ['219'] }, in4.ScanLayout(bids_dir), ['219']):
+        os.remove(sidecar)
+      args = { 'bids_dir': bids_dir, 'subj_ids': ['219', '188', '999'] }
+      assert in4.do_subjects_pipelined('bold', args) == 1
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'phasediff sidecar file is missing for subject 219' in syserr
+
+
+  def test_do_subjects_pipelined_error(self, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      def bad_scan (self, subj_id):
+        raise OSError(f"cannot scan {subj_id}")
+      monkeypatch.setattr(in4.ScanLayout, 'scan_subject', bad_scan)
+      with pytest.raises(OSError, match='cannot scan'):
+        in4.do_subjects_pipelined('bold', { 'bids_dir': bids_dir, 'queue_size': 1 })
+
+
+  def test_do_subjects_retry_entries(self, capsys, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      update_sidecar = in4.update_sidecar
+      def failing_update (image_paths, sidecar, args):
+        if ('sub-219' in sidecar):
+          raise OSError('disk is full')
+        update_sidecar(image_paths, sidecar, args)
+      monkeypatch.setattr(in4, 'update_sidecar', failing_update)
+      args = { 'bids_dir': bids_dir }
+      in4.do_subjects('dwi', args)
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert syserr.count('Unable to modify epi sidecar file for subject 219') == 2
+      entries = args['retry_entries']
+      assert len(entries) == 2
+      assert all(entry['status'] == in4.SKIP_FAILED for entry in entries)
+      assert all(entry['reason'].endswith('disk is full') for entry in entries)
+
+      # retrying processes exactly the failed subject/sessions
+      monkeypatch.setattr(in4, 'update_sidecar', update_sidecar)
+      retry_file = os.path.join(tmpdir, 'retry.json')
+      in4.write_retry_file(retry_file, 'dwi', entries)
+      modality, retry_entries = in4.read_retry_file(retry_file)
+      assert modality == 'dwi'
+      assert retry_entries == entries
+      pairs = in4.retry_pairs(retry_entries)
+      retry_args = { 'bids_dir': bids_dir, 'subj_ids': ['219'], 'retry_pairs': pairs }
+      targets = list(in4.gen_targets('dwi', retry_args, in4.ScanLayout(bids_dir), ['219']))
+      assert set((target['subject'], target['session']) for target in targets) == pairs
+      in4.do_subjects('dwi', retry_args)
+      assert 'retry_entries' not in retry_args
+      checks = in4.check_subjects('dwi', { 'bids_dir': bids_dir })
+      assert all(check['status'] == in4.CHECK_CORRECT for check in checks)
+
+
+  def test_read_retry_file_bad(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      retry_file = os.path.join(tmpdir, 'retry.json')
+      in4.output_JSON([ 'not', 'entries' ], file_path=retry_file)
+      with pytest.raises(ValueError, match='is not an intend4 retry file'):
+        in4.read_retry_file(retry_file)
+
+
+  def test_preflight_sidecars(self):
+    sidecar = os.path.join(self.bids_test_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+    assert in4.preflight_sidecars([sidecar], {}) == []
+    args = { 'max_workers': 2, 'io_throttle': IOThrottle() }
+    problems = in4.preflight_sidecars([sidecar, '/tmp/NoSuch.json', '/tmp'], args)
+    assert [ path for (path, _) in problems ] == ['/tmp/NoSuch.json', '/tmp']
+    # the statuses are fetched once, into the stat cache of the run
+    assert set(args['stat_cache'].entries) == set([sidecar, '/tmp/NoSuch.json', '/tmp'])
+    assert args['io_throttle'].report()[METADATA_OP]['count'] == 3
+
+
+  def test_planned_sidecars(self):
+    testlayout = BIDSLayout(self.bids_test_dir, validate=True)
+    sidecars = in4.planned_sidecars('bold', {}, testlayout, ['078', '219'])
+    assert len(sidecars) == 3
+    assert all(sidecar.endswith('_phasediff.json') for sidecar in sidecars)
+
+    testlayout = BIDSLayout(self.bads_test_dir, validate=True)
+    assert in4.planned_sidecars('bold', {}, testlayout, ['188']) == []   # ambiguous
+
+
+  def test_do_subjects_memory_budget(self, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      tracker = MemoryTracker()
+      try:
+        in4.do_subjects('bold', { 'bids_dir': bids_dir, 'memory_tracker': tracker })
+      finally:
+        tracker.stop()
+      report = tracker.report()
+      assert [ phase['phase'] for phase in report['phases'] ] == ['index', 'update']
+      budgets = { 'index': { 'peak_bytes': 200 * MEBIBYTE },
+                  'update': { 'peak_bytes': 50 * MEBIBYTE, 'retained_bytes': 10 * MEBIBYTE } }
+      assert budget_violations(report, budgets) == []
+
+
   def test_do_single_subject_no_sess(self):
     up_fm = in4.update_fieldmap
     args = { 'bids_dir': self.bids_test_dir, 'subj_ids': ['188'] }
-    in4.update_fieldmap = MagicMock()
+    in4.update_fieldmap = MagicMock(return_value=1)
     cnt = in4.do_subjects('bold', args)
     in4.update_fieldmap = up_fm
     assert cnt == 1
@@ -63,7 +391,7 @@ class TestIntend4(object):
   def test_do_single_subject_sess(self):
     up_fm = in4.update_fieldmap
     args = { 'bids_dir': self.bids_test_dir, 'subj_ids': ['219'] }
-    in4.update_fieldmap = MagicMock()
+    in4.update_fieldmap = MagicMock(return_value=1)
     cnt = in4.do_subjects('bold', args)
     in4.update_fieldmap = up_fm
     assert cnt == 2
@@ -72,47 +400,95 @@ class TestIntend4(object):
   def test_get_fieldmap_suffix(self):
     assert in4.get_fieldmap_suffix('bold') == "phasediff"
     assert in4.get_fieldmap_suffix('dwi') == "epi"
+    assert in4.get_fieldmap_suffix('all') == "phasediff/epi"
+    assert in4.get_fieldmap_suffix('all', { 'fieldmap_rules': self.rules }) == "epi/fieldmap"
+
+
+  def test_plan_targets(self):
+    "Rules which select the same sidecar are combined into one target."
+    args = { 'fieldmap_rules': self.rules }
+    for layout in [ in4.ScanLayout(self.bids_test_dir), BIDSLayout(self.bids_test_dir, validate=True) ]:
+      targets = in4.plan_targets('all', args, layout, '188')
+      assert len(targets) == 2
+      assert targets[0]['sidecars'] == [ f"{self.bids_test_dir}/sub-188/fmap/sub-188_dir-PA_epi.json" ]
+      assert targets[0]['fieldmap'] == 'epi'
+      assert len(targets[0]['image_paths']) == 6
+      assert targets[0]['image_paths'][-1] == 'dwi/sub-188_acq-AP_dwi.nii.gz'
+      assert targets[1] == {
+        'subject': '188', 'session': None, 'image_paths': [ 'anat/sub-188_T1w.nii.gz' ],
+        'sidecars': [], 'fieldmap': 'fieldmap' }
+      assert in4.plan_targets('dwi', args, layout, '188')[0]['image_paths'] == [ 'dwi/sub-188_acq-AP_dwi.nii.gz' ]
+
+
+  def test_do_subjects_all_rules(self, capsys, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, 'data')
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      rewritten = []
+      update_sidecar = in4.update_sidecar
+      def counting_update (image_paths, sidecar, args):
+        rewritten.append(sidecar)
+        update_sidecar(image_paths, sidecar, args)
+      monkeypatch.setattr(in4, 'update_sidecar', counting_update)
+      args = { 'bids_dir': bids_dir, 'fieldmap_rules': self.rules }
+      assert in4.do_subjects('all', args) == 4
+      assert len(rewritten) == len(set(rewritten)) == 4     # each epi sidecar is written once
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'fieldmap sidecar file is missing for subject 188' in syserr
+      assert all(entry['status'] == in4.CHECK_MISSING for entry in args['retry_entries'])
+      contents = in4.read_sidecar(os.path.join(bids_dir, 'sub-219/ses-ctbs/fmap/sub-219_ses-ctbs_dir-PA_epi.json'))
+      assert contents['IntendedFor'] == [
+        'ses-ctbs/func/sub-219_ses-ctbs_task-rest_run-01_bold.nii.gz',
+        'ses-ctbs/func/sub-219_ses-ctbs_task-rest_run-02_bold.nii.gz',
+        'ses-ctbs/dwi/sub-219_ses-ctbs_acq-AP_dwi.nii.gz' ]
 
 
-  def test_get_sidecar_and_modify_lt1(self, capsys):
+  def test_update_fieldmap_missing(self, capsys):
     """
     There are 3 conditions to test: if num_sidecars < 1 => error; if num_sidecars > 1 => error;
     else there is one sidecar and it works.
     """
     testlayout = BIDSLayout(self.bids_test_dir, validate=True)
-    in4.get_sidecar_and_modify('bold', {}, testlayout, [], '666')
+    assert in4.update_fieldmap('T1w', { 'fieldmap_rules': self.rules }, testlayout, '188') == 0
     _, syserr = capsys.readouterr()
     print(f"CAPTURED SYS.ERR:\n{syserr}")
-    assert 'sidecar file is missing for subject 666' in syserr
+    assert 'fieldmap sidecar file is missing for subject 188' in syserr
 
 
-  def test_get_sidecar_and_modify_gt1(self, capsys):
+  def test_update_fieldmap_ambiguous(self, capsys):
     """
     There are 3 conditions to test: if num_sidecars < 1 => error; if num_sidecars > 1 => error;
     else there is one sidecar and it works.
     """
     testlayout = BIDSLayout(self.bads_test_dir, validate=True)
-    in4.get_sidecar_and_modify('bold', {}, testlayout, [], '188')
+    assert in4.update_fieldmap('bold', {}, testlayout, '188') == 0
     _, syserr = capsys.readouterr()
     print(f"CAPTURED SYS.ERR:\n{syserr}")
     assert 'Found more than 1' in syserr
     assert 'sidecars for subject 188' in syserr
 
 
-  def test_get_sidecar_and_modify_eq1(self, capsys, popdir):
+  def test_update_fieldmap_one(self, capsys, popdir):
     """
     There are 3 conditions to test: if num_sidecars < 1 => error; if num_sidecars > 1 => error;
     else there is one sidecar and it works.
     """
     with tempfile.TemporaryDirectory() as tmpdir:
       print(f"tmpdir={tmpdir}")
-      os.system(f"cp -Rp {self.bids_test_dir} {tmpdir}")
+      copy_tree(self.bids_test_dir, os.path.join(tmpdir, 'data'), snapshot=True)
       os.chdir(tmpdir)
-      testlayout = BIDSLayout(os.path.join(tmpdir, 'data'), validate=True)
-      in4.get_sidecar_and_modify('bold', {}, testlayout, [], '188')
+      bids_dir = os.path.join(tmpdir, 'data')
+      testlayout = BIDSLayout(bids_dir, validate=True)
+      assert in4.update_fieldmap('bold', { 'bids_dir': bids_dir }, testlayout, '188') == 1
+      args = { 'bids_dir': bids_dir, 'fieldmap_rules': self.rules }
+      assert in4.update_fieldmap('all', args, testlayout, '188') == 1
       _, syserr = capsys.readouterr()
       print(f"CAPTURED SYS.ERR:\n{syserr}")
-      assert syserr == ''
+      assert 'fieldmap sidecar file is missing' in syserr
+      assert 'phasediff' not in syserr
 
 
   def test_has_session(self):
@@ -157,6 +533,74 @@ class TestIntend4(object):
       assert fileperm == mod_perm
 
 
+  def test_read_sidecar(self):
+    sidecar = os.path.join(self.bids_test_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+    contents = in4.read_sidecar(sidecar)
+    assert type(contents) == dict
+    assert len(contents) > 0
+
+
+  def test_update_sidecar(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'testcontent.json')
+      in4.output_JSON({'Zkey': 1, 'Akey': 2}, file_path=testfile)
+      os.chmod(testfile, 0o0444)
+      args = { 'lock_dir': os.path.join(tmpdir, 'locks') }
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, args)
+      contents = in4.read_sidecar(testfile)
+      assert contents.get('IntendedFor') == ['func/some_bold.nii.gz']
+      assert list(contents.keys()) == ['Akey', 'IntendedFor', 'Zkey']
+      assert (os.stat(testfile).st_mode & 0o0777) == 0o0444
+
+      args['remove'] = True
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, args)
+      assert in4.read_sidecar(testfile).get('IntendedFor') == []
+
+
+  def test_update_sidecar_default_lock_dir(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'testcontent.json')
+      in4.output_JSON({'Akey': 2}, file_path=testfile)
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, { 'bids_dir': tmpdir })
+      lock_dir = os.path.join(tmpdir, '.intend4-locks')
+      assert os.path.isdir(lock_dir)
+      assert os.listdir(lock_dir) == []  # the released lock file is removed
+
+
+  def test_update_sidecar_throttle(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'testcontent.json')
+      in4.output_JSON({'Akey': 2}, file_path=testfile)
+      throttle = IOThrottle()
+      args = { 'bids_dir': tmpdir, 'io_throttle': throttle }
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, args)
+      # 5 for the lock, 1 to read the sidecar, and 3 to rewrite it
+      assert throttle.report()[METADATA_OP]['count'] == 9
+      assert args['default_lock_dir'] == os.path.join(tmpdir, '.intend4-locks')
+
+
+  def test_update_and_report_not_object(self, capsys):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      sidecar = os.path.join(tmpdir, 'sub-188_phasediff.json')
+      in4.output_JSON([1], file_path=sidecar)
+      with pytest.raises(ValueError, match='must be a JSON object'):
+        in4.modify_intended_for(['func/some_bold.nii.gz'], [1])
+      for keep_order in [False, True]:
+        target = { 'subject': '188', 'session': None, 'fieldmap': 'phasediff',
+                   'image_paths': ['func/some_bold.nii.gz'], 'sidecars': [sidecar] }
+        args = { 'bids_dir': tmpdir, 'keep_order': keep_order }
+        in4.update_and_report(target, 'bold', args)
+        assert target['status'] == in4.SKIP_FAILED
+        assert len(args['retry_entries']) == 1
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Unable to modify phasediff sidecar file for subject 188' in syserr
+
+
   def test_output_JSON_stdout(self, capsys):
     in4.output_JSON({'test': 'This should be in the output'})
     sysout, _ = capsys.readouterr()
@@ -164,6 +608,93 @@ class TestIntend4(object):
     assert 'This should be in the output' in sysout
 
 
+  def test_splice_intended_for_insert(self):
+    text = '{\n\t"Zkey": 0.00001,\n\t"Akey": [\n\t\t1,\n\t\t2\n\t]\n}\n'
+    spliced = in4.splice_intended_for(text, ['func/a.nii.gz'])
+    print(f"SPLICED:\n{spliced}")
+    assert spliced.startswith(text[:-3])  # only appended to the original text
+    assert spliced.endswith('\t],\n\t"IntendedFor": [\n\t\t"func/a.nii.gz"\n\t]\n}\n')
+    assert list(json.loads(spliced).keys()) == ['Zkey', 'Akey', 'IntendedFor']
+
+
+  def test_splice_intended_for_replace(self):
+    text = '{\n  "Zkey": 1e-05,\n  "IntendedFor": [\n    "old.nii"\n  ],\n  "Akey": 2\n}'
+    spliced = in4.splice_intended_for(text, [])
+    assert spliced == '{\n  "Zkey": 1e-05,\n  "IntendedFor": [],\n  "Akey": 2\n}'
+    assert in4.splice_intended_for(spliced, ['old.nii']) == text
+
+
+  def test_splice_intended_for_compact(self):
+    assert in4.splice_intended_for('{"a": 1}', ['x']) == '{"a": 1, "IntendedFor": ["x"]}'
+    assert json.loads(in4.splice_intended_for('{}', ['x'])) == {'IntendedFor': ['x']}
+
+
+  def test_splice_intended_for_multikey_line(self):
+    spliced = in4.splice_intended_for('{\n  "a": 1, "b": 2\n}\n', ['f/x.nii.gz'])
+    assert spliced == '{\n  "a": 1, "b": 2, "IntendedFor": ["f/x.nii.gz"]\n}\n'
+    spliced = in4.splice_intended_for('{\n  "a": 1, "IntendedFor": ["x"]\n}', ['y', 'z'])
+    assert spliced == '{\n  "a": 1, "IntendedFor": ["y", "z"]\n}'
+
+
+  def test_splice_intended_for_leading_newline(self):
+    spliced = in4.splice_intended_for('\n{"a":1}', ['x'])
+    assert spliced == '\n{"a":1, "IntendedFor": ["x"]}'
+    assert json.loads(spliced) == {'a': 1, 'IntendedFor': ['x']}
+
+
+  def test_update_sidecar_keep_order_invalid(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'sidecar.json')
+      with open(testfile, 'w') as outfile:
+        outfile.write('{"a": 1}\n')
+      monkeypatch.setattr(in4, 'splice_intended_for', lambda text, intended_for: '{"a": 1,, }')
+      with pytest.raises(ValueError, match='is not valid JSON'):
+        in4.update_sidecar(['x'], testfile, { 'keep_order': True, 'lock_dir': tmpdir })
+      assert in4.read_sidecar_text(testfile) == '{"a": 1}\n'
+
+
+  def test_splice_intended_for_bad(self):
+    with pytest.raises(ValueError):
+      in4.splice_intended_for('["not", "an", "object"]', ['x'])
+    with pytest.raises(ValueError):
+      in4.splice_intended_for('{"a": 1 "b": 2}', ['x'])
+
+
+  def test_splice_intended_for_duplicate(self):
+    with pytest.raises(ValueError, match='more than one IntendedFor key'):
+      in4.splice_intended_for('{"IntendedFor": [], "IntendedFor": ["old"]}', ['x'])
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      sidecar = os.path.join(tmpdir, 'sub-188_phasediff.json')
+      text = '{"IntendedFor": [], "IntendedFor": ["old"]}\n'
+      with open(sidecar, 'w') as outfile:
+        outfile.write(text)
+      target = { 'subject': '188', 'session': None, 'fieldmap': 'phasediff',
+                 'image_paths': ['func/some_bold.nii.gz'], 'sidecars': [sidecar] }
+      in4.update_and_report(target, 'bold', { 'bids_dir': tmpdir, 'keep_order': True })
+      assert target['status'] == in4.SKIP_FAILED
+      assert in4.read_sidecar_text(sidecar) == text     # left unchanged
+
+
+  def test_update_sidecar_keep_order(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      testfile = os.path.join(tmpdir, 'testcontent.json')
+      with open(testfile, 'w') as outfile:
+        outfile.write('{\n\t"Zkey": 1,\n\t"Akey": 2\n}\n')
+      args = { 'lock_dir': os.path.join(tmpdir, 'locks'), 'keep_order': True }
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, args)
+      contents = in4.read_sidecar(testfile)
+      assert list(contents.keys()) == ['Zkey', 'Akey', 'IntendedFor']
+      assert in4.read_sidecar_text(testfile).startswith('{\n\t"Zkey": 1,\n\t"Akey": 2,\n')
+
+      # an unchanged sidecar is not rewritten
+      os.utime(testfile, ns=(0, 0))
+      in4.update_sidecar(['func/some_bold.nii.gz'], testfile, args)
+      assert os.stat(testfile).st_mtime_ns == 0
+
+
   def test_subjrelpath_good(self):
     "Valid subject paths."
     assert in4.subjrelpath('sub-188/dwi/sub-188_acq-AP_dwi.nii.gz') == 'dwi/sub-188_acq-AP_dwi.nii.gz'
@@ -184,6 +715,8 @@ class TestIntend4(object):
   def test_validate_modality_good(self):
     assert in4.validate_modality('bold') == 'bold'
     assert in4.validate_modality('dwi') == 'dwi'
+    assert in4.validate_modality('all') == 'all'
+    assert in4.validate_modality('T1w', self.rules) == 'T1w'
 
 
   def test_validate_modality_fail(self):
@@ -204,3 +737,6 @@ class TestIntend4(object):
 
     with pytest.raises(ValueError, match='Modality argument must be one of'):
       in4.validate_modality('Bold')
+
+    with pytest.raises(ValueError, match='Modality argument must be one of'):
+      in4.validate_modality('T1w')
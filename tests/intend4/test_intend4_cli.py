@@ -1,15 +1,20 @@
 # Tests of the IntendedFor CLI module.
 #   Written by: Tom Hicks and Dianne Patterson. 12/7/2021.
-#   Last Modified: Update tests for required modality flag.
+#   Last Modified: Test that a run stopped by SIGTERM finishes the current subject/session.
 #
+import json
 import os
 import pytest
+import re
+import signal
 import sys
 import tempfile
 
 from tests import TEST_RESOURCES_DIR
 from intend4 import BIDS_DIR
 import intend4.intend4_cli as cli
+from intend4.file_lock import file_lock
+from intend4.file_utils import copy_tree
 
 DATA_SUBDIR = 'data'                   # subdirectory name for data root dir in temp directories
 SYSEXIT_ERROR_CODE = 2                 # seems to be error exit code from argparse
@@ -54,6 +59,38 @@ class TestIntend4CLI(object):
       assert True
 
 
+  def test_main_check(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      with pytest.raises(SystemExit) as se:
+        cli.main(['-m', 'dwi', '--bids-dir', bids_dir, '--check'])
+      assert se.value.code == cli.CHECK_FAILED_EXIT_CODE
+      sysout, _ = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      assert 'stale: subject 219 in session ctbs' in sysout
+      assert 'Checked 4 subjects/sessions: 0 correct, 4 stale' in sysout
+
+      cli.main(['-m', 'dwi', '--bids-dir', bids_dir])
+      cli.main(['-m', 'dwi', '--bids-dir', bids_dir, '--check'])
+      sysout, _ = capsys.readouterr()
+      assert 'Checked 4 subjects/sessions: 4 correct, 0 stale' in sysout
+
+
+  def test_main_check_readonly(self, capsys, clear_argv):
+    """
+    Checking only requires a readable BIDS data directory.
+    """
+    cli.check_bids_dir('TEST', self.bids_test_dir, writeable=False)
+    with pytest.raises(SystemExit) as se:
+      cli.check_bids_dir('TEST', '/tmp/NoSuchDir', writeable=False)
+    assert se.value.code == cli.BIDS_DIR_EXIT_CODE
+    _, syserr = capsys.readouterr()
+    assert 'A readable BIDS data directory must be specified' in syserr
+
+
   def test_main_no_modality(self, capsys, clear_argv):
     with pytest.raises(SystemExit) as se:
       sys.argv = ['intend4']
@@ -141,7 +178,7 @@ class TestIntend4CLI(object):
   def test_main_verbose(self, capsys, clear_argv, popdir):
     with tempfile.TemporaryDirectory() as tmpdir:
       print(f"tmpdir={tmpdir}")
-      os.system(f"cp -Rp {self.bids_test_dir} {tmpdir}")
+      copy_tree(self.bids_test_dir, os.path.join(tmpdir, DATA_SUBDIR), snapshot=True)
       os.chdir(tmpdir)
       sys.argv = ['intend4', '-v', '-m', 'bold', '--bids-dir', os.path.join(tmpdir, DATA_SUBDIR), '--participant-label', '188']
       cli.main()
@@ -149,3 +186,291 @@ class TestIntend4CLI(object):
       print(f"CAPTURED SYS.ERR:\n{syserr}")
       assert "IntendedFor field in sidecar files for modality 'bold'" in syserr
       assert 'IntendedFor fields in' in syserr
+
+
+  def test_main_lock_timeout(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      copy_tree(self.bids_test_dir, os.path.join(tmpdir, DATA_SUBDIR), snapshot=True)
+      os.chdir(tmpdir)
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      lock_dir = os.path.join(tmpdir, 'locks')
+      sys.argv = ['intend4', '-m', 'bold', '--bids-dir', bids_dir, '--lock-dir', lock_dir,
+                  '--lock-dataset', '--lock-timeout', '0.2']
+      with file_lock(bids_dir, lock_dir=lock_dir):
+        with pytest.raises(SystemExit) as se:
+          cli.main()
+      assert se.value.code == cli.LOCK_TIMEOUT_EXIT_CODE
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Unable to lock' in syserr
+
+      # with the lock released, the run proceeds
+      cli.main()
+
+
+  def test_main_memory_report(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      cli.main(['-m', 'bold', '--bids-dir', bids_dir, '--memory-report'])
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Memory report:' in syserr
+      assert "Phase 'index': peak" in syserr
+      assert "Phase 'update': peak" in syserr
+      assert 'Process peak RSS:' in syserr
+
+
+  def test_main_throttle(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      cli.main(['-m', 'bold', '--bids-dir', bids_dir, '--metadata-rate', '1000',
+                '--write-rate', '1000', '--max-io', '2'])
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Throttled I/O:' in syserr
+      assert re.search(r'Throttled I/O: [1-9]\d* metadata operations waited [\d.]+s, [1-9]\d* write operations', syserr)
+
+
+  def test_main_throttle_bad_rate(self, capsys, clear_argv):
+    with pytest.raises(SystemExit) as se:
+      cli.main(['-m', 'bold', '--write-rate', '0'])
+    assert se.value.code == SYSEXIT_ERROR_CODE
+    _, syserr = capsys.readouterr()
+    assert '--write-rate must be greater than zero' in syserr
+
+
+  def test_main_preflight_abort(self, capsys, clear_argv, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      monkeypatch.setattr(cli.in4, 'modification_problem', lambda path, throttle=None, cache=None: 'is not writable')
+      with pytest.raises(SystemExit) as se:
+        cli.main(['-m', 'dwi', '--bids-dir', bids_dir, '--preflight', 'abort'])
+      assert se.value.code == cli.PERMISSIONS_EXIT_CODE
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'found 4 sidecar files which cannot be modified' in syserr
+
+
+  def test_main_pipeline(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      cli.main(['-v', '-m', 'dwi', '--bids-dir', bids_dir, '--pipeline', '--queue-size', '2'])
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Processing subject 219' in sysout
+      assert 'Modified IntendedFor fields in 4 epi sidecars.' in syserr
+
+
+  def test_main_pipeline_check(self, capsys, clear_argv):
+    with pytest.raises(SystemExit) as se:
+      cli.main(['-m', 'dwi', '--bids-dir', self.bids_test_dir, '--pipeline', '--check'])
+    assert se.value.code == 2
+    _, syserr = capsys.readouterr()
+    print(f"CAPTURED SYS.ERR:\n{syserr}")
+    assert '--pipeline cannot be combined with' in syserr
+
+
+  def test_main_retry(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      sidecar = os.path.join(bids_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      os.rename(sidecar, f"{sidecar}.hidden")
+      retry_file = os.path.join(tmpdir, 'retry.json')
+      cli.main(['-m', 'bold', '--bids-dir', bids_dir, '--retry-file', retry_file])
+      with open(retry_file) as infile:
+        retry = json.load(infile)
+      print(f"RETRY FILE:\n{retry}")
+      assert retry['modality'] == 'bold'
+      assert [ (entry['subject'], entry['status']) for entry in retry['entries'] ] == [ ('188', 'missing') ]
+
+      # after fixing the data, retry only the skipped subject, leaving an empty retry file
+      os.rename(f"{sidecar}.hidden", sidecar)
+      capsys.readouterr()
+      cli.main(['-v', '-m', 'bold', '--bids-dir', bids_dir, '--retry-from', retry_file, '--retry-file', retry_file])
+      sysout, _ = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      assert 'Processing subject 188' in sysout
+      assert 'Processing subject 219' not in sysout
+      with open(retry_file) as infile:
+        assert json.load(infile)['entries'] == []
+
+
+  def test_main_retry_default(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      retry_file = os.path.join(tmpdir, cli.RETRY_FILE_NAME)
+      cli.main(['-m', 'bold', '--bids-dir', bids_dir])
+      assert not os.path.exists(retry_file)            # opt-in without a checkpoint
+
+      # a checkpointed run writes the default retry file beside its checkpoint file
+      sidecar = os.path.join(bids_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      os.rename(sidecar, f"{sidecar}.hidden")
+      checkpoint_file = os.path.join(tmpdir, 'checkpoint.json')
+      capsys.readouterr()
+      cli.main(['-v', '-m', 'bold', '--bids-dir', bids_dir, '--checkpoint', checkpoint_file])
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert f"Wrote 1 skipped subjects to retry file {retry_file}" in syserr
+      with open(retry_file) as infile:
+        assert [ entry['subject'] for entry in json.load(infile)['entries'] ] == ['188']
+
+      # a later run without skips empties the existing default retry file
+      os.rename(f"{sidecar}.hidden", sidecar)
+      os.remove(checkpoint_file)
+      cli.main(['-m', 'bold', '--bids-dir', bids_dir, '--checkpoint', checkpoint_file])
+      with open(retry_file) as infile:
+        assert json.load(infile)['entries'] == []
+
+
+  def test_main_retry_modality(self, capsys, clear_argv):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      retry_file = os.path.join(tmpdir, 'retry.json')
+      cli.in4.write_retry_file(retry_file, 'dwi', [])
+      with pytest.raises(SystemExit) as se:
+        cli.main(['-m', 'bold', '--bids-dir', self.bids_test_dir, '--retry-from', retry_file])
+      assert se.value.code == cli.RETRY_FILE_EXIT_CODE
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert "was written for modality 'dwi'" in syserr
+
+
+  def test_main_checkpoint_resume(self, capsys, clear_argv, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      checkpoint_file = os.path.join(tmpdir, 'checkpoint.json')
+      index_cache = os.path.join(tmpdir, 'index')
+      argv = ['-v', '-m', 'dwi', '--bids-dir', bids_dir, '--checkpoint', checkpoint_file]
+
+      # stop the first run, as a walltime limit would, during the second subject/session:
+      # the run finishes that subject/session before exiting
+      update_fieldmap = cli.in4.update_fieldmap
+      calls = []
+      def stopping_update (modality, args, layout, subj_id, session_id=None):
+        calls.append((subj_id, session_id))
+        if (len(calls) == 2):
+          os.kill(os.getpid(), signal.SIGTERM)
+        return update_fieldmap(modality, args, layout, subj_id, session_id=session_id)
+      monkeypatch.setattr(cli.in4, 'update_fieldmap', stopping_update)
+      with pytest.raises(SystemExit) as se:
+        cli.main(argv + ['--index-cache', index_cache])
+      assert se.value.code == 128 + signal.SIGTERM
+      assert len(calls) == 2
+      assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL   # the handler is restored
+      with open(checkpoint_file) as infile:
+        checkpoint = json.load(infile)
+      assert checkpoint['completed'] == [ list(pair) for pair in calls ]
+      assert checkpoint['index_cache'] == index_cache
+
+      # the resumed run skips the completed work and reuses the index cache
+      monkeypatch.setattr(cli.in4, 'update_fieldmap', update_fieldmap)
+      capsys.readouterr()
+      cli.main(argv + ['--resume'])
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Resuming after 2 completed subjects/sessions.' in syserr
+      assert sysout.count('Processing subject') == 2
+      for subj_id, session_id in calls:
+        assert f"Processing subject {subj_id}\n" not in sysout
+      with open(checkpoint_file) as infile:
+        assert len(json.load(infile)['completed']) == 4
+      assert cli.in4.check_subjects('dwi', { 'bids_dir': bids_dir })[0]['status'] == 'correct'
+
+
+  def test_main_resume_files_in_dataset(self, clear_argv, monkeypatch, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      sidecar = os.path.join(bids_dir, 'sub-188', 'fmap', 'sub-188_phasediff.json')
+      os.remove(sidecar)                 # a skip, so a default retry file is written too
+      checkpoint_file = os.path.join(bids_dir, 'run.ckpt')
+      index_cache = os.path.join(bids_dir, 'intend4-index')
+      argv = ['-m', 'bold', '--bids-dir', bids_dir, '--checkpoint', checkpoint_file,
+              '--index-cache', index_cache]
+      cli.main(argv)
+      assert os.path.isfile(checkpoint_file)
+      assert os.path.isfile(os.path.join(bids_dir, cli.RETRY_FILE_NAME))
+
+      # the files written by the first run, in the dataset, do not invalidate the index cache
+      stamps = []
+      monkeypatch.setattr(cli.in4, 'write_index_stamp', lambda cache_dir, stamp: stamps.append(stamp))
+      cli.main(argv + ['--resume'])
+      assert stamps == []
+
+
+  def test_main_resume_mismatch(self, capsys, clear_argv):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      checkpoint_file = os.path.join(tmpdir, 'checkpoint.json')
+      cli.Checkpoint(checkpoint_file, settings={ 'modality': 'dwi' }).save()
+      with pytest.raises(SystemExit) as se:
+        cli.main(['-m', 'bold', '--bids-dir', self.bids_test_dir, '--checkpoint', checkpoint_file, '--resume'])
+      assert se.value.code == cli.CHECKPOINT_EXIT_CODE
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'was written by a run with different settings' in syserr
+
+
+  def test_main_rules(self, capsys, clear_argv, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      bids_dir = os.path.join(tmpdir, DATA_SUBDIR)
+      copy_tree(self.bids_test_dir, bids_dir, snapshot=True)
+      os.chdir(tmpdir)
+      rules_file = os.path.join(tmpdir, 'rules.json')
+      rules = [
+        { 'modality': 'bold', 'target': { 'suffix': 'bold' }, 'fieldmap': { 'suffix': 'phasediff' } },
+        { 'modality': 'T1w', 'target': { 'suffix': 'T1w' }, 'fieldmap': { 'suffix': 'epi', 'direction': 'PA' } }
+      ]
+      with open(rules_file, 'w') as outfile:
+        json.dump({ 'rules': rules }, outfile)
+      cli.main(['-v', '-m', 'all', '--bids-dir', bids_dir, '--rules', rules_file])
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'IntendedFor fields in 8 phasediff/epi sidecars.' in syserr
+      contents = cli.in4.read_sidecar(os.path.join(bids_dir, 'sub-188/fmap/sub-188_dir-PA_epi.json'))
+      assert contents['IntendedFor'] == ['anat/sub-188_T1w.nii.gz']
+
+      with pytest.raises(SystemExit) as se:     # the default modalities are replaced
+        cli.main(['-m', 'dwi', '--bids-dir', bids_dir, '--rules', rules_file])
+      assert se.value.code == SYSEXIT_ERROR_CODE
+
+
+  def test_main_rules_bad(self, capsys, clear_argv):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      rules_file = os.path.join(tmpdir, 'rules.json')
+      with open(rules_file, 'w') as outfile:
+        json.dump([ { 'modality': 'bold', 'target': { 'suffix': 'bold' } } ], outfile)
+      with pytest.raises(SystemExit) as se:
+        cli.main(['-m', 'bold', '--bids-dir', self.bids_test_dir, '--rules', rules_file])
+      assert se.value.code == cli.RULES_FILE_EXIT_CODE
+      _, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert "the fieldmap of rule 'bold' must be an object with a 'suffix' filter" in syserr
@@ -0,0 +1,137 @@
+# Tests of the intend4 server module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Add tests for failed updates, bad requests, and socket reuse.
+#
+import os
+import pytest
+import socket
+import tempfile
+import threading
+
+import intend4.intend4 as in4
+import intend4.intend4_server as srv
+from intend4.file_utils import copy_tree
+from intend4.scan_layout import ScanLayout
+from tests import TEST_RESOURCES_DIR
+
+
+@pytest.fixture
+def server_dir():
+  "Yield a temporary directory holding a snapshot of the test data and a running server."
+  with tempfile.TemporaryDirectory() as tmpdir:
+    bids_dir = os.path.join(tmpdir, 'data')
+    copy_tree(f"{TEST_RESOURCES_DIR}/data", bids_dir, snapshot=True)
+    socket_path = os.path.join(tmpdir, 'test.sock')
+    args = { 'bids_dir': bids_dir, 'lock_dir': os.path.join(tmpdir, 'locks') }
+    server = srv.make_server(socket_path, ScanLayout(bids_dir), args)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      yield (bids_dir, socket_path)
+    finally:
+      server.shutdown()
+      thread.join()
+      server.server_close()
+
+
+class TestIntend4Server(object):
+
+  def test_handle_request_bad(self):
+    layout = ScanLayout(f"{TEST_RESOURCES_DIR}/data")
+    response = srv.handle_request({ 'action': 'explode' }, layout, {})
+    assert response['ok'] is False
+    assert 'Action must be one of' in response['error']
+    response = srv.handle_request({ 'action': 'check', 'modality': 'T1w' }, layout, {})
+    assert response['ok'] is False
+    assert 'Modality argument must be one of' in response['error']
+
+
+  def test_serve_update_and_check(self, server_dir):
+    bids_dir, socket_path = server_dir
+    response = srv.send_request(socket_path, { 'action': 'ping' }, timeout=10)
+    assert response['ok'] is True
+
+    response = srv.send_request(socket_path, { 'action': 'check', 'modality': 'bold' }, timeout=10)
+    assert [ check['status'] for check in response['results'] ] == [ in4.CHECK_STALE ] * 4
+
+    request = { 'action': 'update', 'modality': 'bold', 'subjects': ['sub-219'], 'sessions': ['ses-itbs'] }
+    response = srv.send_request(socket_path, request, timeout=10)
+    print(f"RESPONSE={response}")
+    assert response['ok'] is True
+    assert len(response['results']) == 1
+    assert response['results'][0]['status'] == in4.UPDATE_DONE
+    assert response['results'][0]['session'] == 'itbs'
+
+    request = { 'action': 'check', 'modality': 'bold', 'subjects': ['219'] }
+    response = srv.send_request(socket_path, request, timeout=10)
+    statuses = { check['session']: check['status'] for check in response['results'] }
+    assert statuses == { 'ctbs': in4.CHECK_STALE, 'itbs': in4.CHECK_CORRECT }
+
+
+  def test_serve_refreshes_changed_subject(self, server_dir):
+    bids_dir, socket_path = server_dir
+    func_dir = os.path.join(bids_dir, 'sub-188', 'func')
+    new_bold = 'func/sub-188_task-nad1_run-09_bold.nii.gz'
+    open(os.path.join(bids_dir, 'sub-188', new_bold), 'a').close()
+    os.utime(func_dir, ns=(0, 0))        # guarantee a new directory mtime
+
+    request = { 'action': 'update', 'modality': 'bold', 'subjects': ['188'] }
+    response = srv.send_request(socket_path, request, timeout=10)
+    assert response['refreshed'] == ['188']
+    assert new_bold in response['results'][0]['image_paths']
+
+    response = srv.send_request(socket_path, request, timeout=10)
+    assert response['refreshed'] == []
+
+
+  def test_serve_update_failure(self, server_dir, monkeypatch):
+    _, socket_path = server_dir
+    update_sidecar = in4.update_sidecar
+    def failing_update (image_paths, sidecar, args):
+      if ('sub-188' in sidecar):
+        raise OSError('boom')
+      update_sidecar(image_paths, sidecar, args)
+    monkeypatch.setattr(in4, 'update_sidecar', failing_update)
+    response = srv.send_request(socket_path, { 'action': 'update', 'modality': 'bold' }, timeout=10)
+    print(f"RESPONSE={response}")
+    assert response['ok'] is True
+    statuses = { result['subject']: (result['status'], result.get('detail')) for result in response['results'] }
+    assert statuses['078'] == (in4.UPDATE_DONE, None)
+    assert statuses['188'] == (in4.SKIP_FAILED, 'boom')
+
+
+  def test_serve_non_object_request(self, server_dir):
+    _, socket_path = server_dir
+    for request in [ [1, 2], 'ping', None ]:
+      response = srv.send_request(socket_path, request, timeout=10)
+      assert response['ok'] is False
+      assert 'a request must be a JSON object' in response['error']
+    assert srv.send_request(socket_path, { 'action': 'ping' }, timeout=10)['ok'] is True
+
+
+  def test_make_server_socket_path(self, server_dir):
+    bids_dir, socket_path = server_dir
+    layout = ScanLayout(bids_dir)
+    with pytest.raises(FileExistsError, match='Another server is listening'):
+      srv.make_server(socket_path, layout, {})
+    not_socket = os.path.join(bids_dir, 'dataset_description.json')
+    with pytest.raises(FileExistsError, match='is not a socket'):
+      srv.make_server(not_socket, layout, {})
+    assert os.path.exists(not_socket)
+
+    stale_path = os.path.join(os.path.dirname(bids_dir), 'stale.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+      stale.bind(stale_path)             # bound but never listening, as if left by a crash
+    server = srv.make_server(stale_path, layout, {})
+    server.server_close()
+
+
+  def test_serve_shutdown(self, server_dir):
+    _, socket_path = server_dir
+    response = srv.send_request(socket_path, { 'action': 'shutdown' }, timeout=10)
+    assert response['ok'] is True
+
+
+  def test_strip_prefix(self):
+    assert srv.strip_prefix('sub-188', 'sub-') == '188'
+    assert srv.strip_prefix('188', 'sub-') == '188'
@@ -0,0 +1,66 @@
+# Tests for the memory report module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import tracemalloc
+
+import intend4.memory_report as mr
+
+
+class TestMemoryReport(object):
+
+  def test_tracker_phases(self):
+    tracker = mr.MemoryTracker(top_count=3)
+    try:
+      with tracker.phase('allocate'):
+        kept = [ bytearray(1024) for _ in range(1024) ]      # about 1 MiB retained
+      with tracker.phase('temporary'):
+        temp = [ bytearray(1024) for _ in range(2048) ]      # about 2 MiB, then freed
+        del temp
+    finally:
+      tracker.stop()
+    assert not tracemalloc.is_tracing()
+
+    report = tracker.report()
+    print(mr.format_report(report))
+    allocate, temporary = report['phases']
+    assert allocate['phase'] == 'allocate'
+    assert allocate['retained_bytes'] >= mr.MEBIBYTE
+    assert allocate['peak_bytes'] >= allocate['retained_bytes']
+    assert 0 < len(allocate['top_allocations']) <= 3
+    assert 'test_memory_report.py' in allocate['top_allocations'][0]['site']
+    assert temporary['peak_bytes'] >= 2 * mr.MEBIBYTE
+    assert temporary['retained_bytes'] < mr.MEBIBYTE
+    assert report['peak_rss_bytes'] > 0
+    assert len(kept) == 1024
+
+
+  def test_budget_violations(self):
+    report = { 'peak_rss_bytes': 500,
+               'phases': [ { 'phase': 'index', 'peak_bytes': 100, 'retained_bytes': 50 } ] }
+    assert mr.budget_violations(report, {}) == []
+    assert mr.budget_violations(report, { 'index': { 'peak_bytes': 100 } }) == []
+    assert mr.budget_violations(report, { 'run': { 'peak_rss_bytes': 1000 } }) == []
+
+    violations = mr.budget_violations(report, { 'index': { 'peak_bytes': 99, 'retained_bytes': 49 } })
+    assert len(violations) == 2
+    assert "Phase 'index' peak_bytes of 100 exceeds the budget of 99." in violations
+    violations = mr.budget_violations(report, { 'update': { 'peak_bytes': 1 } })
+    assert violations == [ "No memory was recorded for phase 'update'." ]
+
+
+  def test_format_report(self):
+    report = { 'peak_rss_bytes': 3 * mr.MEBIBYTE,
+               'phases': [ { 'phase': 'index', 'peak_bytes': mr.MEBIBYTE, 'retained_bytes': 0,
+                             'peak_rss_bytes': 2 * mr.MEBIBYTE,
+                             'top_allocations': [ { 'site': 'x.py:1', 'size_diff_bytes': 0,
+                                                    'count_diff': 7 } ] } ] }
+    text = mr.format_report(report)
+    assert "Phase 'index': peak 1.0 MiB, retained 0.0 MiB, process peak RSS 2.0 MiB" in text
+    assert '0.0 MiB in 7 blocks: x.py:1' in text
+    assert text.endswith('Process peak RSS: 3.0 MiB')
+
+
+  def test_to_mib(self):
+    assert mr.to_mib(0) == '0.0'
+    assert mr.to_mib(mr.MEBIBYTE // 2) == '0.5'
@@ -0,0 +1,127 @@
+# Tests for the lightweight scanning layout module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Add tests for the compact file records and index.
+#
+import os
+import pytest
+import tempfile
+import tracemalloc
+
+from bids import BIDSLayout
+import intend4.intend4 as in4
+import intend4.scan_layout as sl
+from intend4.file_utils import copy_tree
+from tests import TEST_RESOURCES_DIR
+
+
+class TestScanLayout(object):
+
+  bids_test_dir = f"{TEST_RESOURCES_DIR}/data"
+  bads_test_dir = f"{TEST_RESOURCES_DIR}/baddata"
+
+  def test_matches_bidslayout(self):
+    "The targets found through a scan layout are the same as those found by pybids."
+    for test_dir in [ self.bids_test_dir, self.bads_test_dir ]:
+      scan_layout = sl.ScanLayout(test_dir)
+      bids_layout = BIDSLayout(test_dir, validate=True)
+      assert scan_layout.get_subjects() == bids_layout.get_subjects()
+      assert scan_layout.get_sessions() == bids_layout.get_sessions()
+      for modality in [ 'bold', 'dwi' ]:
+        scan_targets = list(in4.gen_targets(modality, {}, scan_layout, scan_layout.get_subjects()))
+        bids_targets = list(in4.gen_targets(modality, {}, bids_layout, bids_layout.get_subjects()))
+        assert scan_targets == bids_targets
+
+
+  def test_get(self):
+    layout = sl.ScanLayout(self.bids_test_dir)
+    bolds = layout.get(subject='219', session='ctbs', suffix='bold', extension=['.nii.gz', 'nii'])
+    assert [ bold.relpath for bold in bolds ] == [
+      'sub-219/ses-ctbs/func/sub-219_ses-ctbs_task-rest_run-01_bold.nii.gz',
+      'sub-219/ses-ctbs/func/sub-219_ses-ctbs_task-rest_run-02_bold.nii.gz' ]
+    assert bolds[0].entities['datatype'] == 'func'
+    assert bolds[0].path == os.path.join(self.bids_test_dir, bolds[0].relpath)
+    assert layout.get(subject='219', session=None, suffix='bold') == []
+    assert layout.get(return_type='id', target='session', subject='219') == ['ctbs', 'itbs']
+    assert layout.get(return_type='id', target='session', subject='188') == []
+    assert len(layout.get(subject=['078', '188'], suffix='phasediff', extension='json')) == 2
+
+
+  def test_index(self):
+    layout = sl.ScanLayout(self.bids_test_dir)
+    assert set(layout.index['219']) >= { ('ctbs', 'bold'), ('itbs', 'phasediff'), ('ctbs', 'epi') }
+    assert all(scan_file.get('session') is None for scan_files in layout.index['188'].values()
+               for scan_file in scan_files)
+    indexed = layout.get(subject='219', session='itbs', suffix='epi', extension='json')
+    searched = layout.get(subject=['219'], session='itbs', suffix='epi', extension='json')
+    assert indexed == searched
+    assert [ epi.filename for epi in indexed ] == [ 'sub-219_ses-itbs_dir-PA_epi.json' ]
+
+
+  def test_make_file(self):
+    layout = sl.ScanLayout(self.bids_test_dir, scan=False)
+    filename = 'sub-219_ses-ctbs_dir-PA_run-01_epi.json'
+    epi = layout.make_file('219', 'ses-ctbs/fmap', filename)
+    assert epi.filename == filename
+    assert epi.subjpath == in4.subjrelpath(epi.relpath) == f"ses-ctbs/fmap/{filename}"
+    assert epi.entities == {
+      'subject': '219', 'session': 'ctbs', 'direction': 'PA', 'run': '01', 'suffix': 'epi',
+      'extension': 'json', 'datatype': 'fmap' }
+    assert epi.get('acquisition') is None
+    other = layout.make_file('188', 'ses-ctbs/fmap', filename.replace('219', '188'))
+    assert (other.keys is epi.keys) and (other.values is epi.values)   # shared across subjects
+    assert layout.make_file('188', 'fmap', filename) is None             # another subject
+    assert layout.make_file('219', '', 'README') is None
+
+
+  def test_memory_per_file(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      copy_tree(self.bids_test_dir, tmpdir, snapshot=True)
+      tracemalloc.start()
+      try:
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        layout = sl.ScanLayout(tmpdir, max_workers=1)
+        end_bytes, _ = tracemalloc.get_traced_memory()
+      finally:
+        tracemalloc.stop()
+      num_files = len(layout.files_for())
+      print(f"{num_files} files: {(end_bytes - start_bytes) / num_files} bytes per file")
+      assert (end_bytes - start_bytes) / num_files < 512
+
+
+  def test_no_dataset_description(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with pytest.raises(RuntimeError, match='has no dataset_description.json'):
+        sl.ScanLayout(tmpdir)
+
+
+  def test_parse_filename(self):
+    assert sl.parse_filename('sub-188_dir-PA_epi.json') == {
+      'subject': '188', 'direction': 'PA', 'suffix': 'epi', 'extension': 'json' }
+    assert sl.parse_filename('sub-219_ses-ctbs_acq-asl_run-01.nii.gz') == {
+      'subject': '219', 'session': 'ctbs', 'acquisition': 'asl', 'run': '01', 'extension': 'nii.gz' }
+    assert sl.parse_filename('README') is None
+    assert sl.parse_filename('sub-188_bad_bold.nii') is None
+
+
+  def test_refresh(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      copy_tree(self.bids_test_dir, tmpdir, snapshot=True)
+      layout = sl.ScanLayout(tmpdir)
+      assert layout.refresh() == []        # nothing has changed
+
+      func_dir = os.path.join(tmpdir, 'sub-188', 'func')
+      new_bold = os.path.join(func_dir, 'sub-188_task-nad1_run-09_bold.nii.gz')
+      open(new_bold, 'a').close()
+      os.utime(func_dir, ns=(0, 0))        # guarantee a new directory mtime
+      assert layout.refresh() == ['188']
+      assert new_bold in [ bold.path for bold in layout.get(subject='188', suffix='bold') ]
+
+      os.utime(func_dir, ns=(1, 1))
+      assert layout.refresh_subject('188') is True
+      assert layout.refresh_subject('188') is False
+
+      os.rename(os.path.join(tmpdir, 'sub-078'), os.path.join(tmpdir, 'gone-078'))
+      layout.refresh()
+      assert layout.get_subjects() == ['188', '219']
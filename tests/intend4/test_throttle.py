@@ -0,0 +1,78 @@
+# Tests for the I/O throttling module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import threading
+import time
+
+import intend4.throttle as th
+
+
+class TestThrottle(object):
+
+  def test_token_bucket(self):
+    bucket = th.TokenBucket(20)
+    start = time.monotonic()
+    waits = [ bucket.acquire() for _ in range(30) ]
+    elapsed = time.monotonic() - start
+    assert waits[:20] == [0.0] * 20      # a burst of one second's worth
+    assert all(wait > 0 for wait in waits[20:])
+    assert elapsed >= 0.45               # the other 10 tokens come at 20 per second
+
+
+  def test_max_concurrent(self):
+    throttle = th.IOThrottle(max_concurrent=2)
+    lock = threading.Lock()
+    in_progress = [0]
+    peak = [0]
+
+    def operate():
+      with throttle.operation(th.METADATA_OP):
+        with lock:
+          in_progress[0] += 1
+          peak[0] = max(peak[0], in_progress[0])
+        time.sleep(0.02)
+        with lock:
+          in_progress[0] -= 1
+
+    threads = [ threading.Thread(target=operate) for _ in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert peak[0] == 2
+    report = throttle.report()
+    assert report[th.METADATA_OP]['count'] == 8
+    assert report[th.METADATA_OP]['wait_seconds'] > 0
+    assert report[th.WRITE_OP] == { 'count': 0, 'wait_seconds': 0.0 }
+
+
+  def test_rate_limits(self):
+    throttle = th.IOThrottle(metadata_rate=1000, write_rate=10)
+    for _ in range(12):
+      with throttle.operation(th.WRITE_OP):
+        pass
+      with throttle.operation(th.METADATA_OP):
+        pass
+    report = throttle.report()
+    assert report[th.WRITE_OP]['count'] == 12
+    assert report[th.WRITE_OP]['wait_seconds'] >= 0.15
+    assert report[th.METADATA_OP]['wait_seconds'] < 0.05
+
+
+  def test_format_report(self):
+    report = {
+      th.METADATA_OP: { 'count': 12, 'wait_seconds': 1.5 },
+      th.WRITE_OP: { 'count': 3, 'wait_seconds': 0.25 }
+    }
+    assert th.format_report(report) == \
+      '12 metadata operations waited 1.50s, 3 write operations waited 0.25s'
+
+
+  def test_throttled(self):
+    with th.throttled(None, th.WRITE_OP):   # no throttle: nothing to do
+      pass
+    throttle = th.IOThrottle()
+    with th.throttled(throttle, th.WRITE_OP):
+      pass
+    assert throttle.report()[th.WRITE_OP]['count'] == 1
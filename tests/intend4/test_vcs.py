@@ -0,0 +1,82 @@
+# Tests for the version control integration module.
+#   Written by: Tom Hicks. 10/19/2026.
+#   Last Modified: Initial creation.
+#
+import os
+import pytest
+import shutil
+import subprocess
+import tempfile
+
+import intend4.vcs as vcs
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+
+def git (repo_dir, *command):
+  "Run the given git command in the given repository and return its standard output."
+  result = subprocess.run(['git'] + list(command), cwd=repo_dir,
+                          capture_output=True, text=True, check=True)
+  return result.stdout
+
+
+def make_repo (repo_dir):
+  "Create a git repository in the given directory, with two committed files in a subdirectory."
+  git(repo_dir, 'init', '-q')
+  git(repo_dir, 'config', 'user.name', 'Test User')
+  git(repo_dir, 'config', 'user.email', 'test@example.com')
+  os.mkdir(os.path.join(repo_dir, 'fmap'))
+  paths = [ os.path.join(repo_dir, 'fmap', name) for name in ['one.json', 'two.json'] ]
+  for path in paths:
+    with open(path, 'w') as outfile:
+      outfile.write('{}\n')
+  git(repo_dir, 'add', '.')
+  git(repo_dir, 'commit', '-q', '-m', 'Initial commit')
+  return paths
+
+
+class TestVCS(object):
+
+  def test_commit_files(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      print(f"tmpdir={tmpdir}")
+      paths = make_repo(tmpdir)
+      for path in paths:
+        with open(path, 'w') as outfile:
+          outfile.write('{"IntendedFor": []}\n')
+      with open(os.path.join(tmpdir, 'other.txt'), 'w') as outfile:
+        outfile.write('unrelated\n')
+
+      vcs.unlock_files(tmpdir, paths, 'git')      # nothing to unlock in plain git
+      vcs.commit_files(tmpdir, paths, 'Update sidecars', 'git')
+      log = git(tmpdir, 'log', '--format=%s')
+      assert log.splitlines() == ['Update sidecars', 'Initial commit']
+      changed = git(tmpdir, 'show', '--name-only', '--format=', 'HEAD')
+      assert sorted(changed.split()) == ['fmap/one.json', 'fmap/two.json']
+      assert '?? other.txt' in git(tmpdir, 'status', '--porcelain')
+
+      # committing unchanged files does nothing
+      vcs.commit_files(tmpdir, paths, 'Nothing', 'git')
+      assert len(git(tmpdir, 'log', '--format=%s').splitlines()) == 2
+
+
+  def test_commit_files_subdir(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      paths = make_repo(tmpdir)
+      with open(paths[0], 'w') as outfile:
+        outfile.write('{"IntendedFor": []}\n')
+      vcs.commit_files(os.path.join(tmpdir, 'fmap'), paths, 'From a subdirectory', 'git')
+      assert git(tmpdir, 'log', '-1', '--format=%s').strip() == 'From a subdirectory'
+
+
+  def test_repo_relpaths(self):
+    assert vcs.repo_relpaths('/data', ['/data/sub-1/fmap/x.json']) == ['sub-1/fmap/x.json']
+
+
+  def test_run_vcs_fail(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with pytest.raises(RuntimeError, match='failed'):
+        vcs.run_vcs(tmpdir, ['git', 'log'])      # not a repository
+      with pytest.raises(RuntimeError, match='Unable to run'):
+        vcs.run_vcs(tmpdir, ['no-such-vcs-command', 'save'])
+      assert vcs.run_vcs(tmpdir, ['git', 'log'], check=False).returncode != 0